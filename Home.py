@@ -20,6 +20,12 @@ def app():
 
 
     st.write('### Hybrid method: code, embed and cluster')
+    st.caption('Embed and Cluster')
+    st.write('1. Upload the survey data, or the codebook from Generate Codebook')
+    st.write('2. Choose local or OpenAI embeddings and the number of themes')
+    st.write('3. Click on the "Cluster" button')
+    st.write('4. Review the proposed themes and download the theme book')
+    st.write('5. Edit the theme book as needed and apply it with the Theme Encoder')
 
 
 app()
\ No newline at end of file
@@ -0,0 +1,99 @@
+"""
+Collapses duplicate and trivial survey answers before they are sent to the LLM.
+
+Answers are normalized (Unicode NFKC, trimmed, whitespace collapsed, case folded).
+Answers matching a trivial-answer rule ("N/A", "-", "nan", ...) resolve to all-zero
+codes without a request, and answers that normalize to the same text share one
+request whose result is fanned back out to every matching cell.
+"""
+import re
+import unicodedata
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+TRIVIAL = -1
+
+# (pattern, description) rules; a normalized answer fully matching any pattern is trivial.
+DEFAULT_TRIVIAL_RULES = [
+    (r"", "Empty answer"),
+    (r"nan|none|null|nil", "Missing value exported as text"),
+    (r"n\s*/?\s*a|not applicable", "Not applicable"),
+    (r"[-_.?!/\\]+", "Punctuation only"),
+]
+
+DEFAULT_TRIVIAL_PATTERNS = [pattern for pattern, _ in DEFAULT_TRIVIAL_RULES]
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_answer(text: str) -> str:
+    """
+    Normalizes an answer so that whitespace and case variants compare equal.
+    """
+    text = unicodedata.normalize("NFKC", str(text))
+    return _WHITESPACE.sub(" ", text).strip().casefold()
+
+
+def compile_trivial_patterns(patterns: Sequence[str]) -> Optional[re.Pattern]:
+    patterns = [p for p in patterns if p is not None]
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{p})" for p in patterns))
+
+
+def zero_themes(theme_labels: Sequence[str], justification: str = "Trivial answer; no themes present.") -> List[dict]:
+    return [{"label": label, "value": 0, "justification": justification} for label in theme_labels]
+
+
+@dataclass
+class DispatchPlan:
+    """
+    unique_texts are the answers that need a request; cell_to_unique maps every
+    input cell to its entry in unique_texts, or to TRIVIAL.
+    """
+    unique_texts: List[str]
+    cell_to_unique: List[int]
+    trivial_count: int = 0
+    duplicate_count: int = 0
+    cells_by_unique: Dict[int, List[int]] = field(default_factory=dict)
+
+    @property
+    def calls_saved(self) -> int:
+        return self.trivial_count + self.duplicate_count
+
+    def fan_out(self, unique_results: Sequence, trivial_result) -> list:
+        """
+        Expands one result per unique text back to one result per cell.
+        """
+        return [trivial_result if u == TRIVIAL else unique_results[u] for u in self.cell_to_unique]
+
+
+def plan_dispatch(
+    texts: Sequence[str],
+    trivial_patterns: Sequence[str] = DEFAULT_TRIVIAL_PATTERNS,
+    deduplicate: bool = True
+) -> DispatchPlan:
+    """
+    Groups texts by normalized form and flags trivial answers.
+    """
+    trivial_regex = compile_trivial_patterns(trivial_patterns)
+    plan = DispatchPlan(unique_texts=[], cell_to_unique=[])
+    index_by_normalized: Dict[str, int] = {}
+
+    for cell_idx, text in enumerate(texts):
+        normalized = normalize_answer(text)
+        if trivial_regex is not None and trivial_regex.fullmatch(normalized):
+            plan.cell_to_unique.append(TRIVIAL)
+            plan.trivial_count += 1
+            continue
+        unique_idx = index_by_normalized.get(normalized) if deduplicate else None
+        if unique_idx is None:
+            unique_idx = len(plan.unique_texts)
+            plan.unique_texts.append(str(text).strip())
+            if deduplicate:
+                index_by_normalized[normalized] = unique_idx
+        else:
+            plan.duplicate_count += 1
+        plan.cell_to_unique.append(unique_idx)
+        plan.cells_by_unique.setdefault(unique_idx, []).append(cell_idx)
+    return plan
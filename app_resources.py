@@ -0,0 +1,81 @@
+"""
+Resources shared by every page across Streamlit reruns.
+
+Streamlit reruns the page script from the top on every interaction. Objects that
+are expensive to build are cached here instead of being rebuilt on each rerun:
+
+- get_openai_client: one client, and so one keep-alive connection pool, per
+  API key and base URL (st.cache_resource, shared across sessions)
+- load_json_schema: parsed function call schemas (st.cache_data)
+- read_uploaded_csv: uploaded CSVs parsed once per content hash (st.cache_data)
+
+timed_rerun records how long each rerun of a page takes, so the overhead of a
+page can be compared before and after a change.
+"""
+import hashlib
+import io
+import json
+import statistics
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+import pandas as pd
+import streamlit as st
+from openai import OpenAI
+
+# df.attrs key holding the SHA-256 of the uploaded file a DataFrame was parsed from.
+CONTENT_HASH_ATTR = "content_hash"
+RERUN_HISTORY = 20
+
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key: str, base_url: Optional[str] = None, max_retries: int = 0) -> OpenAI:
+    """
+    Returns a shared OpenAI client. Its HTTP connection pool is kept alive across
+    reruns, so later requests skip the TCP and TLS handshakes. Keep the default
+    max_retries=0 when calls go through the rate controller, so it sees every
+    throttling response.
+    """
+    return OpenAI(api_key=api_key, base_url=base_url, max_retries=max_retries)
+
+
+@st.cache_data(show_spinner=False)
+def load_json_schema(path: str) -> dict:
+    """
+    Returns the parsed JSON file at path; each call gets its own copy.
+    """
+    with open(path) as schema_file:
+        return json.load(schema_file)
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _parse_csv(content_hash: str, _content: bytes) -> pd.DataFrame:
+    df = pd.read_csv(io.BytesIO(_content))
+    df.attrs[CONTENT_HASH_ATTR] = content_hash
+    return df
+
+
+def read_uploaded_csv(uploaded_file) -> pd.DataFrame:
+    """
+    Parses an uploaded CSV, reusing the parsed DataFrame while the file content is unchanged.
+    The content hash is kept in df.attrs[CONTENT_HASH_ATTR].
+    """
+    content = uploaded_file.getvalue()
+    return _parse_csv(hashlib.sha256(content).hexdigest(), content)
+
+
+@contextmanager
+def timed_rerun(page_name: str):
+    """
+    Times the rerun of a page script and shows it with the recent median in the sidebar.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        history = st.session_state.setdefault("rerun_seconds", {}).setdefault(page_name, [])
+        history.append(time.perf_counter() - started)
+        del history[:-RERUN_HISTORY]
+        st.sidebar.caption(f"Rerun took {history[-1] * 1000:.0f} ms "
+                           f"(median of the last {len(history)}: {statistics.median(history) * 1000:.0f} ms)")
@@ -0,0 +1,202 @@
+"""
+Streaming JSONL files for batch jobs and results.
+
+Jobs are written one line at a time as they are generated, optionally gzip
+compressed, so building a batch file never holds the whole batch in memory.
+Large batches are split into shards that stay under the provider's per-file
+request and size limits, with a manifest of each shard's ids and checksum.
+"""
+import glob
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import time
+from dataclasses import asdict, dataclass
+from typing import IO, Iterable, Iterator, List, Optional, Sequence
+
+DEFAULT_BATCH_DIR = "batch_job"
+GZIP_SUFFIX = ".gz"
+MANIFEST_NAME = "manifest.json"
+# OpenAI Batch API limits per input file.
+DEFAULT_MAX_SHARD_LINES = 50_000
+DEFAULT_MAX_SHARD_BYTES = 200 * 1024 * 1024
+
+
+@dataclass
+class JsonlWriteStats:
+    path: str
+    line_count: int = 0
+    # Size of the JSONL text before compression.
+    uncompressed_bytes: int = 0
+    file_bytes: int = 0
+    first_record: Optional[dict] = None
+
+
+@dataclass
+class ShardInfo:
+    path: str
+    line_count: int
+    # Size of the JSONL text before compression, which is what the limits apply to.
+    uncompressed_bytes: int
+    file_bytes: int
+    sha256: str
+    first_custom_id: str
+    last_custom_id: str
+
+
+def _open(path: str, mode: str, compress: bool) -> IO[bytes]:
+    return gzip.open(path, mode) if compress else open(path, mode)
+
+
+def write_jsonl(records: Iterable[dict], path: str) -> JsonlWriteStats:
+    """
+    Streams records to path, one JSON object per line, gzip compressed if path ends in .gz.
+    Counts lines and bytes as it goes.
+    """
+    stats = JsonlWriteStats(path)
+    # Write to a temporary name so an interrupted build never leaves a truncated batch file behind.
+    tmp_path = path + ".part"
+    with _open(tmp_path, "wb", path.endswith(GZIP_SUFFIX)) as f:
+        for record in records:
+            line = (json.dumps(record) + "\n").encode("utf-8")
+            f.write(line)
+            stats.line_count += 1
+            stats.uncompressed_bytes += len(line)
+            if stats.first_record is None:
+                stats.first_record = record
+    os.replace(tmp_path, path)
+    stats.file_bytes = os.path.getsize(path)
+    return stats
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def new_shard_dir(prefix: str, directory: str = DEFAULT_BATCH_DIR) -> str:
+    """
+    Returns a fresh timestamped directory for the shards of one batch.
+    """
+    path = os.path.join(directory, f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def write_jsonl_shards(
+    records: Iterable[dict],
+    directory: str,
+    compress: bool = False,
+    max_lines: int = DEFAULT_MAX_SHARD_LINES,
+    max_bytes: int = DEFAULT_MAX_SHARD_BYTES
+) -> dict:
+    """
+    Streams records into shard-000.jsonl, shard-001.jsonl, ... in directory, starting a
+    new shard before one would exceed max_lines or max_bytes (uncompressed).
+    Writes and returns a manifest listing every shard's custom_id range and sha256.
+    """
+    records = iter(records)
+    shards: List[ShardInfo] = []
+    pending = next(records, None)
+    while pending is not None:
+        path = os.path.join(directory, f"shard-{len(shards):03d}.jsonl" + (GZIP_SUFFIX if compress else ""))
+        tmp_path = path + ".part"
+        line_count = uncompressed_bytes = 0
+        first_custom_id = last_custom_id = ""
+        with _open(tmp_path, "wb", compress) as f:
+            while pending is not None:
+                line = (json.dumps(pending) + "\n").encode("utf-8")
+                # A record larger than max_bytes still gets a shard of its own.
+                if line_count and (line_count >= max_lines or uncompressed_bytes + len(line) > max_bytes):
+                    break
+                f.write(line)
+                line_count += 1
+                uncompressed_bytes += len(line)
+                last_custom_id = str(pending.get("custom_id", ""))
+                first_custom_id = first_custom_id or last_custom_id
+                pending = next(records, None)
+        os.replace(tmp_path, path)
+        shards.append(ShardInfo(os.path.basename(path), line_count, uncompressed_bytes,
+                                os.path.getsize(path), file_sha256(path), first_custom_id, last_custom_id))
+
+    manifest = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "max_lines": max_lines,
+        "max_bytes": max_bytes,
+        "line_count": sum(shard.line_count for shard in shards),
+        "shards": [asdict(shard) for shard in shards]
+    }
+    with open(os.path.join(directory, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_manifest(directory: str) -> dict:
+    with open(os.path.join(directory, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def find_manifest_dir(path: str) -> Optional[str]:
+    """
+    The shard folder that path is in, or is a results folder of: path or its parent, whichever has a manifest.
+    """
+    directory = path if os.path.isdir(path) else os.path.dirname(path)
+    for candidate in (directory, os.path.dirname(os.path.abspath(directory))):
+        if os.path.exists(os.path.join(candidate, MANIFEST_NAME)):
+            return candidate
+    return None
+
+
+def verify_manifest(directory: str, paths: Optional[Iterable[str]] = None) -> List[str]:
+    """
+    Returns the shards in directory (or just those in paths) that are missing or
+    no longer match their manifest checksum.
+    """
+    paths = set(paths) if paths is not None else None
+    bad = []
+    for shard in load_manifest(directory)["shards"]:
+        if paths is not None and shard["path"] not in paths:
+            continue
+        path = os.path.join(directory, shard["path"])
+        if not os.path.exists(path) or file_sha256(path) != shard["sha256"]:
+            bad.append(shard["path"])
+    return bad
+
+
+def jsonl_files(path: str) -> List[str]:
+    """
+    Expands a directory into the JSONL files it contains, in name order; a file path is returned as is.
+    """
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(glob.glob(os.path.join(path, "*.jsonl")) + glob.glob(os.path.join(path, "*.jsonl" + GZIP_SUFFIX)))
+
+
+def iter_jsonl_sources(sources: Sequence) -> Iterator[dict]:
+    """
+    Yields the records of several JSONL files (paths or file objects) one after another.
+    """
+    return itertools.chain.from_iterable(iter_jsonl(source) for source in sources)
+
+
+def iter_jsonl(source) -> Iterator[dict]:
+    """
+    Yields the JSON objects in a JSONL file, one line at a time.
+    source is a path or a binary file object; gzip content is detected either way.
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            yield from iter_jsonl(f)
+        return
+    magic = source.read(2)
+    source.seek(0)
+    stream = gzip.GzipFile(fileobj=source) if magic == b"\x1f\x8b" else source
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
@@ -0,0 +1,290 @@
+"""
+Submits sharded batch job files and collects their results.
+
+Each shard is uploaded and submitted as its own batch, with at most
+max_active batches in flight at once. Active batches are polled with backoff,
+and each one's output is downloaded as soon as it finishes. Jobs that failed
+or are missing from the output are written to a retry file and resubmitted,
+up to max_attempts per shard. A packed job whose results leave out some of
+its cells is kept for the cells it covers and retried for the rest. Each
+batch's error file is downloaded to the errors folder, and the error message
+of every job that still failed is kept with its shard. Progress is saved to
+orchestration.json in the shard folder after every step, so an interrupted
+run resumes where it stopped.
+Before anything is submitted, the job files still to be sent are checked
+against the manifest's checksums, so a truncated or edited shard is not run.
+
+The batch service is a pluggable backend with upload/submit/status/download
+methods: OpenAIBatchBackend for OpenAI-compatible APIs, or
+mock_openai_server.FakeBatchBackend to run without network access.
+"""
+import copy
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Set
+
+from batch_jsonl import GZIP_SUFFIX, iter_jsonl, jsonl_files, load_manifest, verify_manifest, write_jsonl
+from batch_results import extract_batch_arguments
+from theme_packing import PACKED_FUNCTION_NAME, build_packed_text_message
+
+STATE_NAME = "orchestration.json"
+RESULTS_DIR = "results"
+RETRIES_DIR = "retries"
+ERRORS_DIR = "errors"
+
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+PENDING, SUBMITTED, DONE = "pending", "submitted", "done"
+
+
+class OpenAIBatchBackend:
+    """
+    Batch backend for the OpenAI (or Azure OpenAI) Batch API.
+    """
+
+    def __init__(self, client, endpoint: str = "/chat/completions", completion_window: str = "24h"):
+        self.client = client
+        self.endpoint = endpoint
+        self.completion_window = completion_window
+
+    def upload(self, path: str) -> str:
+        if not path.endswith(GZIP_SUFFIX):
+            with open(path, "rb") as f:
+                return self.client.files.create(file=f, purpose="batch").id
+        # The Batch API only accepts plain JSONL.
+        with gzip.open(path, "rb") as src, tempfile.NamedTemporaryFile(suffix=".jsonl") as tmp:
+            shutil.copyfileobj(src, tmp)
+            tmp.seek(0)
+            return self.client.files.create(file=(os.path.basename(path[:-len(GZIP_SUFFIX)]), tmp),
+                                            purpose="batch").id
+
+    def submit(self, file_id: str) -> str:
+        return self.client.batches.create(input_file_id=file_id, endpoint=self.endpoint,
+                                          completion_window=self.completion_window).id
+
+    def status(self, batch_id: str) -> dict:
+        batch = self.client.batches.retrieve(batch_id)
+        return {"status": batch.status, "output_file_id": batch.output_file_id, "error_file_id": batch.error_file_id}
+
+    def download(self, file_id: str, path: str):
+        self.client.files.content(file_id).write_to_file(path)
+
+
+def _custom_ids(path: str) -> Set[str]:
+    return {str(job.get("custom_id", "")) for job in iter_jsonl(path)}
+
+
+def _packed_cell_ids(job: dict) -> Optional[List[str]]:
+    """
+    The cell ids a packed job codes, or None if the job codes a single cell.
+    """
+    body = job.get("body") or {}
+    tools = body.get("tools") or [{}]
+    if tools[0].get("function", {}).get("name") != PACKED_FUNCTION_NAME:
+        return None
+    return [str(cell["id"]) for cell in json.loads(body["messages"][-1]["content"])]
+
+
+def _returned_cell_ids(arguments: str) -> Set[str]:
+    try:
+        results = json.loads(arguments).get("results")
+    except (ValueError, AttributeError):
+        return set()
+    if not isinstance(results, list):
+        return set()
+    return {str(item.get("id", "")) for item in results if isinstance(item, dict)}
+
+
+def _error_message(line: dict) -> Optional[str]:
+    """
+    The error message of a failed batch output or error file line, if it has one.
+    """
+    error = line.get("error") or ((line.get("response") or {}).get("body") or {}).get("error")
+    if isinstance(error, dict):
+        return str(error.get("message") or error.get("code") or error)
+    return str(error) if error else None
+
+
+def narrow_packed_job(job: dict, cell_ids: Set[str]) -> dict:
+    """
+    A copy of a packed job that codes only the given cells.
+    """
+    job = copy.deepcopy(job)
+    messages = job["body"]["messages"]
+    cells = [cell for cell in json.loads(messages[-1]["content"]) if str(cell["id"]) in cell_ids]
+    messages[-1]["content"] = build_packed_text_message([(cell["id"], cell["text"]) for cell in cells])
+    if isinstance(job.get("metadata"), dict) and "cells" in job["metadata"]:
+        job["metadata"]["cells"] = [cell for cell in job["metadata"]["cells"] if cell["cell_id"] in cell_ids]
+    return job
+
+
+class BatchOrchestrator:
+    def __init__(
+        self,
+        backend,
+        shard_dir: str,
+        max_active: int = 4,
+        max_attempts: int = 3,
+        poll_interval: float = 5.0,
+        max_poll_interval: float = 300.0,
+        sleep: Callable[[float], None] = time.sleep,
+        on_event: Optional[Callable[[str], None]] = None
+    ):
+        self.backend = backend
+        self.shard_dir = shard_dir
+        self.max_active = max_active
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.sleep = sleep
+        self.on_event = on_event or (lambda message: None)
+        self.state_path = os.path.join(shard_dir, STATE_NAME)
+        self.state = self._load_state()
+
+    def _load_state(self) -> dict:
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                return json.load(f)
+        return {"shards": [
+            {"path": shard["path"], "input_path": shard["path"], "attempt": 0, "status": PENDING,
+             "file_id": None, "batch_id": None, "result_paths": [], "failed_ids": []}
+            for shard in load_manifest(self.shard_dir)["shards"]
+        ]}
+
+    def _save_state(self):
+        tmp_path = self.state_path + ".part"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def _submit(self, shard: dict):
+        shard["file_id"] = self.backend.upload(os.path.join(self.shard_dir, shard["input_path"]))
+        shard["batch_id"] = self.backend.submit(shard["file_id"])
+        shard["status"] = SUBMITTED
+        self._save_state()
+        self.on_event(f"Submitted {shard['input_path']} as batch {shard['batch_id']}")
+
+    def _collect(self, shard: dict, status: dict):
+        """
+        Keeps the successful output lines of a finished batch and schedules a retry of the rest,
+        including the cells a packed job's results left out.
+        """
+        input_path = os.path.join(self.shard_dir, shard["input_path"])
+        stem = shard["path"].split(".")[0]
+        attempt_name = f"{stem}-attempt{shard['attempt']}.jsonl"
+        result_path = os.path.join(self.shard_dir, RESULTS_DIR, attempt_name)
+        os.makedirs(os.path.dirname(result_path), exist_ok=True)
+        # custom_id -> cell ids of every packed job in the batch.
+        packed_ids = {}
+        for job in iter_jsonl(input_path):
+            cell_ids = _packed_cell_ids(job)
+            if cell_ids is not None:
+                packed_ids[str(job.get("custom_id", ""))] = cell_ids
+
+        succeeded = set()
+        # custom_id -> cell ids a packed job's results left out.
+        partial: Dict[str, Set[str]] = {}
+        errors: Dict[str, str] = {}
+        if status.get("output_file_id"):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                raw_path = os.path.join(tmp_dir, "output.jsonl")
+                self.backend.download(status["output_file_id"], raw_path)
+
+                def successful_lines() -> Iterator[dict]:
+                    for line in iter_jsonl(raw_path):
+                        custom_id = str(line.get("custom_id", ""))
+                        arguments = extract_batch_arguments(line)
+                        if arguments is None:
+                            errors[custom_id] = _error_message(line) or "No tool call in the response"
+                            continue
+                        if custom_id in packed_ids:
+                            missing = set(packed_ids[custom_id]) - _returned_cell_ids(arguments)
+                            if len(missing) == len(packed_ids[custom_id]):
+                                errors[custom_id] = "Packed results cover none of the job's cells"
+                                continue
+                            if missing:
+                                partial[custom_id] = missing
+                        succeeded.add(custom_id)
+                        yield line
+                write_jsonl(successful_lines(), result_path)
+            shard["result_paths"].append(os.path.relpath(result_path, self.shard_dir))
+        if status.get("error_file_id"):
+            error_path = os.path.join(self.shard_dir, ERRORS_DIR, attempt_name)
+            os.makedirs(os.path.dirname(error_path), exist_ok=True)
+            self.backend.download(status["error_file_id"], error_path)
+            for line in iter_jsonl(error_path):
+                errors[str(line.get("custom_id", ""))] = _error_message(line) or "Listed in the error file"
+
+        failed = _custom_ids(input_path) - succeeded
+        missing_count = sum(len(cell_ids) for cell_ids in partial.values())
+        message = (f"Batch {shard['batch_id']} {status['status']}: {len(succeeded)} jobs succeeded, "
+                   f"{len(failed)} failed, {missing_count} packed cells missing")
+        first_error = next((errors[custom_id] for custom_id in sorted(failed) if custom_id in errors), None)
+        self.on_event(message + (f" (e.g. {first_error})" if first_error else ""))
+        if (failed or partial) and shard["attempt"] + 1 < self.max_attempts:
+            shard["attempt"] += 1
+            retry_path = os.path.join(RETRIES_DIR, f"{stem}-retry{shard['attempt']}.jsonl")
+            os.makedirs(os.path.join(self.shard_dir, RETRIES_DIR), exist_ok=True)
+
+            def retry_jobs() -> Iterator[dict]:
+                for job in iter_jsonl(input_path):
+                    custom_id = str(job.get("custom_id", ""))
+                    if custom_id in failed:
+                        yield job
+                    elif custom_id in partial:
+                        yield narrow_packed_job(job, partial[custom_id])
+            write_jsonl(retry_jobs(), os.path.join(self.shard_dir, retry_path))
+            shard.update(input_path=retry_path, status=PENDING, file_id=None, batch_id=None)
+        else:
+            failed_ids = sorted(failed) + sorted(f"{custom_id}:{cell_id}"
+                                                 for custom_id, cell_ids in partial.items() for cell_id in cell_ids)
+            shard.update(status=DONE, failed_ids=failed_ids,
+                         errors={custom_id: errors[custom_id] for custom_id in sorted(failed) if custom_id in errors})
+        self._save_state()
+
+    def run(self) -> dict:
+        """
+        Runs until every shard is done, then returns the saved state.
+        Raises ValueError if a shard that is not done is missing or no longer matches the manifest.
+        """
+        shards = self.state["shards"]
+        bad = verify_manifest(self.shard_dir, [shard["path"] for shard in shards if shard["status"] != DONE])
+        if bad:
+            raise ValueError(f"Batch job files are missing or changed since they were built: {', '.join(bad)}")
+        interval = self.poll_interval
+        while True:
+            active = [shard for shard in shards if shard["status"] == SUBMITTED]
+            for shard in [shard for shard in shards if shard["status"] == PENDING][:self.max_active - len(active)]:
+                self._submit(shard)
+                active.append(shard)
+            if not active:
+                return self.state
+
+            changed = False
+            for shard in active:
+                status = self.backend.status(shard["batch_id"])
+                if status["status"] in TERMINAL_STATUSES:
+                    self._collect(shard, status)
+                    changed = True
+            # Poll quickly while batches are finishing, and back off while they are not.
+            if changed:
+                interval = self.poll_interval
+            else:
+                self.sleep(interval)
+                interval = min(interval * 2, self.max_poll_interval)
+
+    def result_files(self) -> List[str]:
+        results_dir = os.path.join(self.shard_dir, RESULTS_DIR)
+        return jsonl_files(results_dir) if os.path.isdir(results_dir) else []
+
+    def summary(self) -> Dict[str, int]:
+        shards = self.state["shards"]
+        return {
+            "shards": len(shards),
+            "done": sum(shard["status"] == DONE for shard in shards),
+            "submitted": sum(shard["status"] == SUBMITTED for shard in shards),
+            "failed_jobs": sum(len(shard["failed_ids"]) for shard in shards),
+        }
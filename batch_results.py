@@ -0,0 +1,142 @@
+"""
+Maps a batch output JSONL file back onto the coded dataset.
+
+The output is streamed one line at a time. Each line's tool-call arguments are
+parsed straight into a results matrix with one row per unique answer, so
+memory is bounded by the number of unique answers and not by the file size.
+The jobs are matched to answers by rebuilding the dispatch plan the job
+builder used (same data, theme book and trivial rules). Single jobs are
+matched by their custom_id (row{i}-col{name}); packed jobs are matched by the
+cell ids in their results. The matrix is then fanned out to every cell in one
+vectorized step, giving the same DataFrame as theme_code_entire_dataframe.
+"""
+import json
+from dataclasses import dataclass, field
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from answer_preprocessing import DEFAULT_TRIVIAL_PATTERNS, TRIVIAL, plan_dispatch, zero_themes
+from response_modes import FULL_MODE, get_response_mode
+from survey_cells import iter_text_cells
+from theme_prompts import validate_themes
+from theme_results import MERGED_VIEW, ThemeResultStore
+from themebook import CompiledThemebook, compile_themebook
+
+
+@dataclass
+class IngestReport:
+    line_count: int = 0
+    coded_answers: int = 0
+    # custom_ids (or packed cell ids) whose request failed or whose response could not be parsed.
+    failed_ids: List[str] = field(default_factory=list)
+    # custom_ids (or packed cell ids) that match no job built from this data.
+    unknown_ids: List[str] = field(default_factory=list)
+    # (row_idx, col_name) of cells left uncoded; rerun their jobs to fill them in.
+    missing_cells: List[Tuple[int, str]] = field(default_factory=list)
+
+
+def job_custom_id(row_idx: int, col_name: str) -> str:
+    """
+    The custom_id the batch job builder gives the job of a single cell.
+    """
+    return f"row{row_idx}-col{col_name}"
+
+
+def extract_batch_arguments(line: dict) -> Optional[str]:
+    """
+    Returns the tool-call arguments of one batch output line, or None if the request failed.
+    """
+    if line.get("error"):
+        return None
+    response = line.get("response") or {}
+    if response.get("status_code", 200) != 200:
+        return None
+    try:
+        return response["body"]["choices"][0]["message"]["tool_calls"][0]["function"]["arguments"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def ingest_batch_results(
+    df: pd.DataFrame,
+    themebook: Union[pd.DataFrame, CompiledThemebook],
+    output_lines: Iterable[dict],
+    response_mode: str = FULL_MODE,
+    trivial_patterns: Sequence[str] = DEFAULT_TRIVIAL_PATTERNS,
+    view: str = MERGED_VIEW
+) -> Tuple[pd.DataFrame, IngestReport]:
+    """
+    Codes df from the batch output lines (e.g. batch_jsonl.iter_jsonl(path)).
+    df, themebook, response_mode and trivial_patterns must match the ones the jobs were built with.
+    Returns the coded DataFrame and a report of failed, unknown and missing ids.
+    """
+    compiled = compile_themebook(themebook)
+    mode = get_response_mode(response_mode)
+    cells = list(iter_text_cells(df, compiled.labels))
+    plan = plan_dispatch([text for _, _, text in cells], trivial_patterns)
+    unique_count = len(plan.unique_texts)
+
+    unique_by_custom_id = {
+        job_custom_id(*cells[cell_indices[0]][:2]): unique_idx
+        for unique_idx, cell_indices in plan.cells_by_unique.items()
+    }
+    # One row per unique answer, plus a last row holding the trivial answers' result.
+    unique_store = ThemeResultStore([cells[plan.cells_by_unique[u][0]][:2] for u in range(unique_count)]
+                                    + [(-1, "")], compiled)
+    unique_store.record(unique_count, zero_themes(compiled.labels))
+    coded = np.zeros(unique_count + 1, dtype=bool)
+    coded[unique_count] = True
+
+    report = IngestReport()
+    for line in output_lines:
+        report.line_count += 1
+        custom_id = str(line.get("custom_id", ""))
+        arguments = extract_batch_arguments(line)
+        if arguments is None:
+            report.failed_ids.append(custom_id)
+            continue
+
+        unique_idx = unique_by_custom_id.get(custom_id)
+        if unique_idx is not None:
+            try:
+                themes = validate_themes(arguments, mode.name, compiled.labels)
+            except ValueError:
+                report.failed_ids.append(custom_id)
+                continue
+            unique_store.record(unique_idx, themes)
+            coded[unique_idx] = True
+            continue
+
+        if not custom_id.startswith("pack"):
+            report.unknown_ids.append(custom_id)
+            continue
+        # Packed job: each result carries the unique answer's index as its id.
+        try:
+            results = json.loads(arguments).get("results")
+        except (ValueError, AttributeError):
+            results = None
+        if not isinstance(results, list) or not results:
+            report.failed_ids.append(custom_id)
+            continue
+        for item in results:
+            cell_id = str(item.get("id", "")) if isinstance(item, dict) else ""
+            if not cell_id.isdigit() or int(cell_id) >= unique_count:
+                report.unknown_ids.append(f"{custom_id}:{cell_id}")
+                continue
+            themes = mode.to_themes(item, compiled.labels)
+            if themes is None:
+                report.failed_ids.append(f"{custom_id}:{cell_id}")
+                continue
+            unique_store.record(int(cell_id), themes)
+            coded[int(cell_id)] = True
+
+    rows = np.asarray(plan.cell_to_unique, dtype=np.int64)
+    rows[rows == TRIVIAL] = unique_count
+    store = unique_store.take(rows, [(row_idx, col_name) for row_idx, col_name, _ in cells])
+
+    report.coded_answers = int(coded[:unique_count].sum())
+    missing = np.nonzero(~coded[rows])[0]
+    report.missing_cells = [(cells[i][0], cells[i][1]) for i in missing]
+    return store.to_dataframe(df, view), report
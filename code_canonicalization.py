@@ -0,0 +1,130 @@
+"""
+Canonicalization of near-duplicate code labels.
+
+Per-cell code extraction names the same idea many ways ("Grammar check",
+"grammar checking", "Grammar-checks"). Labels are normalized (case,
+punctuation, common suffixes) and then shingled into character n-grams.
+MinHash LSH blocking finds candidate duplicates without comparing every pair:
+only labels that share a band of their MinHash signature are compared, by
+exact n-gram Jaccard similarity. Each new label either joins the most similar
+canonical code above the threshold or becomes a canonical code itself, so the
+index can be built incrementally while results stream in.
+"""
+import re
+import zlib
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+DEFAULT_THRESHOLD = 0.6
+DEFAULT_NUM_PERM = 128
+DEFAULT_BANDS = 32
+DEFAULT_NGRAM = 3
+
+
+def _stem(token: str) -> str:
+    for suffix, min_length in (("ing", 6), ("ed", 5), ("es", 5), ("s", 4)):
+        if token.endswith(suffix) and len(token) >= min_length and not token.endswith("ss"):
+            return token[:-len(suffix)]
+    return token
+
+
+def normalize_label(label: str) -> str:
+    """
+    Lowercases, drops punctuation and strips common suffixes: "Grammar-checking" -> "grammar check".
+    """
+    tokens = re.sub(r"[^0-9a-z]+", " ", str(label).lower()).split()
+    return " ".join(_stem(token) for token in tokens)
+
+
+def label_shingles(normalized: str, ngram: int = DEFAULT_NGRAM) -> FrozenSet[str]:
+    padded = f" {normalized} "
+    if len(padded) <= ngram:
+        return frozenset([padded])
+    return frozenset(padded[i:i + ngram] for i in range(len(padded) - ngram + 1))
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+class CodeCanonicalizer:
+    """
+    Incremental alias -> canonical code index. The canonical label of a group is
+    the first spelling added; later spellings map to it when their n-gram
+    Jaccard similarity reaches threshold.
+    """
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, num_perm: int = DEFAULT_NUM_PERM,
+                 bands: int = DEFAULT_BANDS, ngram: int = DEFAULT_NGRAM, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.ngram = ngram
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.aliases: Dict[str, str] = {}
+        self.similarity: Dict[str, float] = {}
+        self._by_normalized: Dict[str, str] = {}
+        self._shingles: Dict[str, FrozenSet[str]] = {}
+        self._buckets: List[Dict[bytes, List[str]]] = [{} for _ in range(bands)]
+
+    def _signature(self, shingles: FrozenSet[str]) -> np.ndarray:
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+        # Overflowing uint64 arithmetic wraps, which is fine for hashing.
+        with np.errstate(over="ignore"):
+            permuted = (np.outer(hashes, self._a) + self._b) % MERSENNE_PRIME
+        return permuted.min(axis=0)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def _best_match(self, shingles: FrozenSet[str], band_keys: List[bytes]) -> Tuple[Optional[str], float]:
+        candidates = {code for band, key in enumerate(band_keys) for code in self._buckets[band].get(key, ())}
+        best, best_similarity = None, 0.0
+        for code in candidates:
+            similarity = jaccard(shingles, self._shingles[code])
+            if similarity > best_similarity or (similarity == best_similarity and best is not None and code < best):
+                best, best_similarity = code, similarity
+        if best_similarity >= self.threshold:
+            return best, best_similarity
+        return None, 0.0
+
+    def canonical(self, label: str) -> str:
+        """
+        Returns the canonical code for label, adding it to the index if it is new.
+        """
+        canonical = self.aliases.get(label)
+        if canonical is None:
+            normalized = normalize_label(label) or str(label)
+            canonical, similarity = self._by_normalized.get(normalized), 1.0
+            if canonical is None:
+                shingles = label_shingles(normalized, self.ngram)
+                band_keys = self._band_keys(self._signature(shingles))
+                canonical, similarity = self._best_match(shingles, band_keys)
+                if canonical is None:
+                    canonical, similarity = label, 1.0
+                    self._shingles[label] = shingles
+                    for band, key in enumerate(band_keys):
+                        self._buckets[band].setdefault(key, []).append(label)
+                self._by_normalized[normalized] = canonical
+            self.aliases[label] = canonical
+            self.similarity[label] = similarity
+        return canonical
+
+    @property
+    def codes(self) -> List[str]:
+        return list(self._shingles)
+
+    def alias_table(self) -> pd.DataFrame:
+        """
+        One row per raw label that was merged into a different canonical code.
+        """
+        rows = [{"Alias": alias, "Code": code, "Similarity": round(self.similarity[alias], 3)}
+                for alias, code in self.aliases.items() if alias != code]
+        return pd.DataFrame(rows, columns=["Alias", "Code", "Similarity"])
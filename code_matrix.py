@@ -0,0 +1,79 @@
+"""
+Sparse storage for extracted codes.
+
+A coded survey is mostly zeros: each cell has a handful of codes out of a
+codebook that can run to thousands. Codes are kept as a long-format table
+with one (row_idx, col_name, code) entry per present code, with categorical
+columns, and widened into '<col>_<code>' 0/1 columns only on demand, e.g. for
+a display preview or a wide CSV export.
+"""
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+LONG_COLUMNS = ["row_idx", "col_name", "code"]
+DEFAULT_COLUMN_FORMAT = "{column}_{code}"
+
+
+class SparseCodeMatrix:
+    def __init__(self, entries: pd.DataFrame, n_rows: int):
+        """
+        entries has one row per present code, in the order the wide columns should appear.
+        """
+        self.entries = entries
+        self.n_rows = n_rows
+
+    @classmethod
+    def from_triplets(cls, triplets: Iterable[Tuple[int, str, str]], n_rows: int) -> "SparseCodeMatrix":
+        entries = pd.DataFrame(list(triplets), columns=LONG_COLUMNS)
+        entries["row_idx"] = entries["row_idx"].astype(np.int32)
+        entries["col_name"] = entries["col_name"].astype("category")
+        entries["code"] = entries["code"].astype("category")
+        return cls(entries.drop_duplicates(ignore_index=True), n_rows)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _pairs(self, column_format: str) -> Tuple[np.ndarray, pd.Index]:
+        """
+        Wide column index of every entry, and the wide column names in first-occurrence order.
+        """
+        names = [column_format.format(column=column, code=code)
+                 for column, code in zip(self.entries["col_name"], self.entries["code"])]
+        pair_ids, pair_names = pd.factorize(pd.Series(names, dtype=object))
+        return pair_ids, pair_names
+
+    def widen(self, df: Optional[pd.DataFrame] = None, max_rows: Optional[int] = None,
+              column_format: str = DEFAULT_COLUMN_FORMAT) -> pd.DataFrame:
+        """
+        Dense 0/1 '<col>_<code>' columns for the first max_rows rows (all by default),
+        appended to the matching rows of df if given.
+        """
+        n_rows = self.n_rows if max_rows is None else min(max_rows, self.n_rows)
+        pair_ids, pair_names = self._pairs(column_format)
+        dense = np.zeros((n_rows, len(pair_names)), dtype=np.int8)
+        rows = self.entries["row_idx"].to_numpy()
+        keep = rows < n_rows
+        dense[rows[keep], pair_ids[keep]] = 1
+        wide = pd.DataFrame(dense, columns=pair_names)
+        if df is None:
+            return wide
+        base = df.iloc[:n_rows]
+        wide.index = base.index
+        return pd.concat([base, wide], axis=1)
+
+    def to_long(self, df: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+        """
+        The (row_idx, col_name, code) table; with df, row_idx is replaced by df's index labels.
+        """
+        long_df = self.entries.copy()
+        if df is not None:
+            long_df["row_idx"] = df.index[long_df["row_idx"].to_numpy()]
+        return long_df
+
+    def to_parquet(self, path_or_buffer):
+        """
+        Writes the long table to Parquet (needs pyarrow).
+        """
+        self.entries.to_parquet(path_or_buffer, index=False)
@@ -0,0 +1,340 @@
+"""
+Concurrent codebook extraction.
+
+Workers ask the model for the qualitative codes in every unique answer, with
+the same rate limiting, retries, cache and run journal as the theme coding
+engine. Each result is put on a queue as soon as it arrives, and a single
+merge stage folds it into the codebook and a sparse code matrix (see
+code_matrix), so results are merged while requests are still in flight.
+
+For codebook discovery alone, answers can instead be sampled in random,
+column-stratified batches until new codes stop appearing (SaturationConfig).
+"""
+import asyncio
+import copy
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import pandas as pd
+from openai import AsyncOpenAI
+
+from answer_preprocessing import plan_dispatch
+from code_canonicalization import CodeCanonicalizer
+from code_matrix import SparseCodeMatrix
+from llm_cache import LLMCache, get_default_cache, make_cache_key
+from rate_limit_controller import AdaptiveRateController
+from run_journal import RunJournal, item_key, settings_context
+from survey_cells import iter_text_cells
+from theme_coding_engine import EngineConfig, ProgressCallback, RateLimiter, request_function_arguments
+
+CODING_SYSTEM_PROMPT = "You are a helpful assistant that extracts short qualitative codes from text."
+CODES_FUNCTION_NAME = "extract_codes_from_text"
+# Rough completion size of a code list, used to reserve tokens-per-minute capacity.
+EXPECTED_CODES_TOKENS = 150
+
+CODES_FUNCTION_SCHEMA = {
+    "name": CODES_FUNCTION_NAME,
+    "description": "Extract qualitative codes and their definitions from a piece of text.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "codes": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "label": {"type": "string"},
+                        "definition": {"type": "string"}
+                    },
+                    "required": ["label", "definition"]
+                },
+                "description": "A list of code objects with label and definition."
+            }
+        },
+        "required": ["codes"]
+    }
+}
+
+
+def build_codes_request(cell_value: str, model_name: str = "gpt-4o-mini") -> dict:
+    """
+    The chat completion request that asks for the codes in one cell.
+    """
+    messages = [
+        {
+            "role": "system",
+            "content": CODING_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": f"Extract codes from this text:\n\n{cell_value}\n\n"
+                       f"Return each code as an object with 'label' and 'definition'. "
+                       f"Short definitions are fine."
+        }
+    ]
+    return {
+        "model": model_name,
+        "messages": messages,
+        "tools": [{"type": "function", "function": CODES_FUNCTION_SCHEMA}],
+        "tool_choice": {"type": "function", "function": {"name": CODES_FUNCTION_NAME}}
+    }
+
+
+def parse_codes(function_args: str) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Returns the code labels and a dict of label -> definition from the function call arguments.
+    Raises if the arguments are not valid JSON.
+    """
+    parsed = json.loads(function_args)  # e.g. { "codes": [ { "label": "X", "definition": "Y" }, ...] }
+    codes_list = []
+    code_definitions = {}
+    for obj in parsed.get("codes", []):
+        label = str(obj.get("label", "")).strip()
+        definition = str(obj.get("definition", "")).strip()
+        if label:
+            codes_list.append(label)
+            code_definitions.setdefault(label, definition)
+    return codes_list, code_definitions
+
+
+class CodebookBuilder:
+    """
+    Incrementally merges extracted codes into a codebook and a sparse code matrix.
+    The first definition seen for a code is kept. With a canonicalizer, near-duplicate
+    labels share one code. Codes, their canonical spellings and matrix entries are
+    decided in the order of the first cell they appear in, so the output does not
+    depend on arrival order.
+    """
+
+    def __init__(self, n_rows: int, canonicalizer: Optional[CodeCanonicalizer] = None):
+        self.n_rows = n_rows
+        # Maps near-duplicate labels onto one code, fed in cell order when the output is built.
+        self.canonicalizer = canonicalizer
+        # A copy fed in arrival order, only to count the codes found so far.
+        self._discovery = copy.deepcopy(canonicalizer)
+        self.definitions: Dict[str, str] = {}
+        # Raw label -> (cell_idx, position in that cell) of its first appearance.
+        self._code_order: Dict[str, Tuple[int, int]] = {}
+        # (cell_idx, position, row_idx, col_name, raw label) for every present code.
+        self._entries: List[Tuple[int, int, int, str, str]] = []
+
+    def add(self, cell_idx: int, row_idx: int, col_name: str, codes: List[str], definitions: Dict[str, str]):
+        # Positions come from one deduplicated sequence, so the codebook and the matrix agree on order.
+        labels = list(dict.fromkeys(codes))
+        for position, code_label in enumerate(labels):
+            if code_label not in self.definitions or (cell_idx, position) < self._code_order[code_label]:
+                self.definitions[code_label] = definitions.get(code_label, "")
+                self._code_order[code_label] = (cell_idx, position)
+            if self._discovery is not None:
+                self._discovery.canonical(code_label)
+        self._entries.extend((cell_idx, position, row_idx, col_name, code_label)
+                             for position, code_label in enumerate(labels))
+
+    @property
+    def code_count(self) -> int:
+        """
+        Codes found so far, after merging near-duplicates.
+        """
+        return len(self._discovery.codes) if self._discovery is not None else len(self.definitions)
+
+    def _canonical_labels(self) -> Dict[str, str]:
+        """
+        Raw label -> code, canonicalized in order of first appearance.
+        """
+        ordered = sorted(self.definitions, key=self._code_order.get)
+        if self.canonicalizer is None:
+            return {label: label for label in ordered}
+        return {label: self.canonicalizer.canonical(label) for label in ordered}
+
+    def code_matrix(self) -> SparseCodeMatrix:
+        canonical = self._canonical_labels()
+        return SparseCodeMatrix.from_triplets(
+            ((row_idx, col_name, canonical.get(code_label, code_label))
+             for _, _, row_idx, col_name, code_label in sorted(self._entries, key=lambda e: e[:2])),
+            self.n_rows
+        )
+
+    def codebook_dataframe(self) -> pd.DataFrame:
+        merged: Dict[str, str] = {}
+        for label, code in self._canonical_labels().items():
+            merged.setdefault(code, self.definitions[label])
+        return pd.DataFrame([{"Code": code, "Definition": definition} for code, definition in merged.items()],
+                            columns=["Code", "Definition"])
+
+
+@dataclass
+class ExtractionRun:
+    # Present codes as (row_idx, col_name, code) entries; widen() for '<col>_<code>' columns.
+    code_matrix: SparseCodeMatrix
+    codebook_df: pd.DataFrame
+    # Unique answers that failed; resume the journaled run to retry them.
+    failures: Dict[int, str] = field(default_factory=dict)
+    elapsed_seconds: float = 0.0
+    request_count: int = 0
+    cache_hits: int = 0
+    calls_saved: int = 0
+    resumed: int = 0
+    # (answers coded, codes found so far) after each batch, for saturation sampling.
+    discovery_curve: List[Tuple[int, int]] = field(default_factory=list)
+    saturated: bool = False
+    # Unique answers never sent because the codebook saturated first.
+    skipped: int = 0
+
+
+@dataclass
+class SaturationConfig:
+    """
+    Codes answers in random, column-stratified batches and stops once new codes
+    appear at fewer than new_code_rate per answer for patience batches in a row.
+    """
+    batch_size: int = 50
+    new_code_rate: float = 0.02
+    patience: int = 2
+    # Answers coded before saturation can be declared.
+    min_answers: int = 100
+    seed: int = 0
+
+
+def stratified_order(columns: Sequence[str], seed: int = 0) -> List[int]:
+    """
+    Returns a random order of the items whose column is given by columns, in which every
+    column is spread evenly in proportion to its size, so any prefix samples all columns.
+    """
+    rng = random.Random(seed)
+    by_column: Dict[str, List[int]] = {}
+    for index, column in enumerate(columns):
+        by_column.setdefault(column, []).append(index)
+    keyed = []
+    for indices in by_column.values():
+        rng.shuffle(indices)
+        keyed.extend(((position + rng.random()) / len(indices), index) for position, index in enumerate(indices))
+    return [index for _, index in sorted(keyed)]
+
+
+def is_saturated(curve: List[Tuple[int, int]], saturation: SaturationConfig) -> bool:
+    """
+    True once the last patience batches each found new codes below the configured rate.
+    """
+    if len(curve) <= saturation.patience or curve[-1][0] < saturation.min_answers:
+        return False
+    recent = curve[-saturation.patience - 1:]
+    return all((codes - prev_codes) < saturation.new_code_rate * (answers - prev_answers)
+               for (prev_answers, prev_codes), (answers, codes) in zip(recent, recent[1:]))
+
+
+async def extract_codebook_async(
+    df: pd.DataFrame,
+    openai_api_key: str,
+    config: Optional[EngineConfig] = None,
+    journal: Optional[RunJournal] = None,
+    on_progress: Optional[ProgressCallback] = None,
+    canonicalizer: Optional[CodeCanonicalizer] = None,
+    saturation: Optional[SaturationConfig] = None
+) -> ExtractionRun:
+    """
+    Extracts codes from every non-empty cell of df concurrently and merges them as they arrive.
+    Trivial and duplicate answers are handled as in the theme coding engine.
+    With a canonicalizer, near-duplicate code labels are merged into one code.
+    With saturation, answers are sampled in batches until new codes stop appearing;
+    cells of answers that were never sampled get no codes.
+    """
+    config = config or EngineConfig()
+    client = AsyncOpenAI(api_key=openai_api_key, base_url=config.base_url, max_retries=0)
+    controller = AdaptiveRateController(
+        initial_concurrency=config.max_concurrency,
+        max_concurrency=config.max_concurrency,
+        max_retries=config.max_retries
+    )
+    limiter = RateLimiter(config.requests_per_minute, config.tokens_per_minute)
+    cache: Optional[LLMCache] = get_default_cache() if config.use_cache else None
+    cells = list(iter_text_cells(df, ()))
+    plan = plan_dispatch([text for _, _, text in cells], config.trivial_patterns, config.deduplicate)
+    builder = CodebookBuilder(len(df), canonicalizer)
+    run = ExtractionRun(code_matrix=builder.code_matrix(), codebook_df=builder.codebook_dataframe(),
+                        calls_saved=plan.calls_saved)
+    results: asyncio.Queue = asyncio.Queue()
+    unique_count = len(plan.unique_texts)
+    merged_count = 0
+    started = time.monotonic()
+    context = settings_context(model=config.model_name)
+
+    async def extract(unique_idx: int):
+        text = plan.unique_texts[unique_idx]
+        key = item_key(text, context)
+        entry = journal.get(key) if journal else None
+        try:
+            if entry is not None:
+                run.resumed += 1
+                codes, definitions = entry["codes"], entry["definitions"]
+            else:
+                request = build_codes_request(text, config.model_name)
+                cache_key = make_cache_key(request) if cache else None
+                arguments = cache.get_valid(cache_key, parse_codes) if cache else None
+                if arguments is None:
+                    run.request_count += 1
+                    arguments, _ = await request_function_arguments(
+                        client, request, EXPECTED_CODES_TOKENS, controller, limiter
+                    )
+                    # Parsed before caching, so a malformed response is requested again next time.
+                    codes, definitions = parse_codes(arguments)
+                    if cache:
+                        cache.put(cache_key, arguments)
+                else:
+                    run.cache_hits += 1
+                    codes, definitions = parse_codes(arguments)
+                if journal:
+                    journal.record(key, {"codes": codes, "definitions": definitions})
+        except Exception as exc:
+            run.failures[unique_idx] = str(exc)
+            codes, definitions = [], {}
+        await results.put((unique_idx, codes, definitions))
+
+    async def merge(count: int):
+        nonlocal merged_count
+        for _ in range(count):
+            unique_idx, codes, definitions = await results.get()
+            for cell_idx in plan.cells_by_unique[unique_idx]:
+                row_idx, col_name, _ = cells[cell_idx]
+                builder.add(cell_idx, row_idx, col_name, codes, definitions)
+            merged_count += 1
+            if on_progress:
+                on_progress(merged_count, unique_count)
+
+    if saturation is None:
+        batches = [list(range(unique_count))]
+    else:
+        order = stratified_order([cells[plan.cells_by_unique[u][0]][1] for u in range(unique_count)], saturation.seed)
+        batches = [order[i:i + saturation.batch_size] for i in range(0, unique_count, saturation.batch_size)]
+    try:
+        for batch in batches:
+            await asyncio.gather(merge(len(batch)), *(extract(u) for u in batch))
+            run.discovery_curve.append((merged_count, builder.code_count))
+            if saturation is not None and is_saturated(run.discovery_curve, saturation):
+                run.saturated = True
+                break
+    finally:
+        await client.close()
+    run.skipped = unique_count - merged_count
+    run.code_matrix = builder.code_matrix()
+    run.codebook_df = builder.codebook_dataframe()
+    run.elapsed_seconds = time.monotonic() - started
+    return run
+
+
+def extract_codebook(
+    df: pd.DataFrame,
+    openai_api_key: str,
+    config: Optional[EngineConfig] = None,
+    journal: Optional[RunJournal] = None,
+    on_progress: Optional[ProgressCallback] = None,
+    canonicalizer: Optional[CodeCanonicalizer] = None,
+    saturation: Optional[SaturationConfig] = None
+) -> ExtractionRun:
+    """
+    Blocking wrapper around extract_codebook_async for Streamlit pages and scripts.
+    """
+    return asyncio.run(extract_codebook_async(df, openai_api_key, config, journal, on_progress,
+                                              canonicalizer, saturation))
@@ -0,0 +1,116 @@
+"""
+Token-budgeted conversation history for the theme-set chat.
+
+Resending the whole chat on every turn makes each turn slower and more
+expensive, especially when an early message carries the survey data. Before
+a request, the history is compacted to a token budget:
+
+- a digest of the survey data (size, columns and a stratified sample of
+  representative quotes), built once per dataset, is always sent, pinned
+  next to the latest message, which carries the current theme set; raw
+  survey data in earlier messages is replaced by it;
+- the most recent messages are kept verbatim, newest first, while they fit;
+- older turns are folded into one short extractive summary, so no extra
+  model call is needed and the prompt size stays flat as the chat grows.
+"""
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+import pandas as pd
+
+from answer_preprocessing import plan_dispatch
+from codebook_extraction import stratified_order
+from survey_cells import iter_text_cells
+from token_counting import TOKENS_PER_MESSAGE, TokenCounter, estimate_tokens
+
+DATA_MARKER = "This is the data to be coded:"
+DIGEST_HEADER = "About the survey data being coded:"
+DEFAULT_HISTORY_TOKENS = 4000
+DIGEST_QUOTES = 25
+QUOTE_CHARS = 300
+SUMMARY_LINE_CHARS = 160
+
+
+@dataclass
+class CompactedConversation:
+    messages: List[dict]
+    tokens: int
+    # Earlier messages folded into the summary instead of being sent verbatim.
+    summarized_messages: int
+
+
+def _shorten(text: str, max_chars: int) -> str:
+    text = " ".join(str(text).split())
+    return text if len(text) <= max_chars else text[:max_chars - 3] + "..."
+
+
+def build_data_digest(survey_data: pd.DataFrame, max_quotes: int = DIGEST_QUOTES,
+                      quote_chars: int = QUOTE_CHARS) -> str:
+    """
+    A compact stand-in for the survey data: its size, columns and representative quotes
+    sampled evenly across columns.
+    """
+    cells = list(iter_text_cells(survey_data, ()))
+    plan = plan_dispatch([text for _, _, text in cells])
+    columns = [cells[plan.cells_by_unique[u][0]][1] for u in range(len(plan.unique_texts))]
+    quotes = [_shorten(plan.unique_texts[u], quote_chars) for u in stratified_order(columns)[:max_quotes]]
+    column_list = "\n".join(f"- {column}" for column in survey_data.columns)
+    quote_list = "\n".join(f"- \"{quote}\"" for quote in quotes)
+    return (f"The survey has {len(survey_data)} responses and {len(plan.unique_texts)} distinct answers "
+            f"to these questions:\n{column_list}\n\nRepresentative answers:\n{quote_list}")
+
+
+def _message_tokens(message: dict, count_tokens: TokenCounter) -> int:
+    return TOKENS_PER_MESSAGE + count_tokens(str(message.get("content", "")))
+
+
+def _summary_message(messages: Sequence[dict]) -> dict:
+    lines = [f"- {message['role']}: {_shorten(str(message['content']).split(chr(10), 1)[0], SUMMARY_LINE_CHARS)}"
+             for message in messages]
+    return {"role": "user", "content": "Summary of the earlier conversation:\n" + "\n".join(lines)}
+
+
+def compact_conversation(
+    messages: Sequence[dict],
+    data_digest: Optional[str] = None,
+    budget_tokens: int = DEFAULT_HISTORY_TOKENS,
+    count_tokens: TokenCounter = estimate_tokens
+) -> CompactedConversation:
+    """
+    Returns the messages to send for the conversation within budget_tokens (best effort:
+    the data digest and the latest message are always sent).
+    """
+    messages = list(messages)
+    pinned = []
+    if data_digest is not None:
+        pinned = [{"role": "user", "content": f"{DIGEST_HEADER}\n\n{data_digest}"}]
+        for index, message in enumerate(messages):
+            content = str(message.get("content", ""))
+            if DATA_MARKER in content:
+                instruction = content.split(DATA_MARKER, 1)[0].strip()
+                messages[index] = {"role": message["role"], "content": instruction or "(survey data, see digest)"}
+
+    if not messages:
+        return CompactedConversation(pinned, sum(_message_tokens(m, count_tokens) for m in pinned), 0)
+    used = sum(_message_tokens(m, count_tokens) for m in pinned) + _message_tokens(messages[-1], count_tokens)
+    first_recent = len(messages) - 1
+    while first_recent > 0:
+        tokens = _message_tokens(messages[first_recent - 1], count_tokens)
+        if used + tokens > budget_tokens:
+            break
+        used += tokens
+        first_recent -= 1
+
+    older = messages[:first_recent]
+    summary = []
+    while older:
+        summary = [_summary_message(older)]
+        summary_tokens = _message_tokens(summary[0], count_tokens)
+        if used + summary_tokens <= budget_tokens or len(older) == 1:
+            used += summary_tokens
+            break
+        # Drop the oldest turns from the summary until it fits.
+        older = older[1:]
+    # The digest goes just before the latest message, next to the theme set it carries.
+    compacted = summary + messages[first_recent:-1] + pinned + messages[-1:]
+    return CompactedConversation(compacted, used, first_recent)
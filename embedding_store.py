@@ -0,0 +1,220 @@
+"""
+Persistent, memory-mapped store of text embeddings.
+
+The same survey answers are embedded again on every run. The store keeps each
+embedder's vectors in one .npy file under DEFAULT_EMBEDDING_DIR, so a rerun
+only embeds answers it has not seen:
+
+    <directory>/<embedder name>/vectors.npy   (rows, dim) float32 or float16
+    <directory>/<embedder name>/keys.u64      one 64-bit text hash per row
+    <directory>/<embedder name>/store.json    embedder name, dim and dtype
+
+Both files only grow: new vectors are appended and the row count in the .npy
+header, which is written with fixed padding, is updated in place. The keys
+file is written last and is authoritative, so an interrupted append is
+ignored on the next open. Opening a store memory-maps both files, so loading a
+million vectors is near-instant, and vectors is a zero-copy view that NumPy
+can search directly. Lookups are batched: texts are hashed and matched
+against the sorted keys with one searchsorted call.
+
+Vectors are stored without data-dependent weights (such as the hashed
+embedder's IDF), under a name that does not depend on the data, and the
+weights are applied as they are read. So one store serves every dataset
+instead of a new one being started per fit.
+"""
+import hashlib
+import json
+import os
+import re
+import struct
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from embeddings import Embedder, embed_texts
+from theme_coding_engine import ProgressCallback
+
+DEFAULT_EMBEDDING_DIR = ".embeddings"
+VECTORS_NAME = "vectors.npy"
+KEYS_NAME = "keys.u64"
+META_NAME = "store.json"
+MISSING = -1
+# Fixed .npy header size, so the row count can be rewritten in place as the file grows.
+NPY_HEADER_BYTES = 128
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+SEARCH_CHUNK_ROWS = 65_536
+
+
+def text_keys(texts: Sequence[str]) -> np.ndarray:
+    """
+    64-bit BLAKE2b hashes of texts, as stored in the keys file.
+    """
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little") for text in texts),
+        dtype=np.uint64, count=len(texts)
+    )
+
+
+def _npy_header(dtype: np.dtype, rows: int, dim: int) -> bytes:
+    header = {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (rows, dim)}
+    body = repr(header).encode("latin1")
+    padding = NPY_HEADER_BYTES - len(NPY_MAGIC) - 2 - len(body) - 1
+    if padding < 0:
+        raise ValueError(f"Shape {(rows, dim)} does not fit in the .npy header")
+    return NPY_MAGIC + struct.pack("<H", NPY_HEADER_BYTES - len(NPY_MAGIC) - 2) + body + b" " * padding + b"\n"
+
+
+def store_directory(root: str, embedder_name: str) -> str:
+    return os.path.join(root, re.sub(r"[^0-9A-Za-z._-]+", "_", embedder_name))
+
+
+class EmbeddingStore:
+    """
+    Append-only store of the vectors of one embedder. dim is taken from the first
+    vectors added; dtype float16 halves the file size at some precision cost.
+    """
+
+    def __init__(self, directory: str, embedder_name: str, dtype=np.float32):
+        self.directory = directory
+        self.embedder_name = embedder_name
+        self.dtype = np.dtype(dtype)
+        self.dim: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self._vectors: Optional[np.ndarray] = None
+        self._keys = np.zeros(0, dtype=np.uint64)
+        self._sorted_keys = self._keys
+        self._sorted_rows = np.zeros(0, dtype=np.int64)
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, META_NAME)
+        if os.path.exists(meta_path):
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            if meta["embedder"] != embedder_name:
+                raise ValueError(f"{directory} holds vectors of {meta['embedder']}, not {embedder_name}")
+            self.dim, self.dtype = meta["dim"], np.dtype(meta["dtype"])
+            self._open()
+
+    @classmethod
+    def for_embedder(cls, embedder: Embedder, root: str = DEFAULT_EMBEDDING_DIR, dtype=np.float32) -> "EmbeddingStore":
+        return cls(store_directory(root, embedder.name), embedder.name, dtype)
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.directory, VECTORS_NAME)
+
+    @property
+    def _keys_path(self) -> str:
+        return os.path.join(self.directory, KEYS_NAME)
+
+    def _open(self):
+        """
+        Memory-maps the stored rows. Rows written after the last key (an interrupted append) are dropped.
+        """
+        rows = os.path.getsize(self._keys_path) // 8 if os.path.exists(self._keys_path) else 0
+        row_bytes = self.dim * self.dtype.itemsize
+        with open(self._vectors_path, "r+b") as vectors_file:
+            vectors_file.seek(0, os.SEEK_END)
+            rows = min(rows, (vectors_file.tell() - NPY_HEADER_BYTES) // row_bytes)
+            vectors_file.truncate(NPY_HEADER_BYTES + rows * row_bytes)
+            vectors_file.seek(0)
+            vectors_file.write(_npy_header(self.dtype, rows, self.dim))
+        self._vectors = np.load(self._vectors_path, mmap_mode="r") if rows else np.zeros((0, self.dim), self.dtype)
+        self._keys = np.memmap(self._keys_path, dtype=np.uint64, mode="r", shape=(rows,)) if rows \
+            else np.zeros(0, dtype=np.uint64)
+        self._sorted_rows = np.argsort(self._keys, kind="stable")
+        self._sorted_keys = self._keys[self._sorted_rows]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """
+        All stored vectors as a read-only memory-mapped (rows, dim) array.
+        """
+        return self._vectors if self._vectors is not None else np.zeros((0, self.dim or 0), self.dtype)
+
+    def lookup(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        The row of each text in the store, or MISSING.
+        """
+        return self._lookup_keys(text_keys(texts))
+
+    def _lookup_keys(self, keys: np.ndarray) -> np.ndarray:
+        if not len(self._sorted_keys):
+            return np.full(len(keys), MISSING, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._sorted_keys, keys), len(self._sorted_keys) - 1)
+        found = self._sorted_keys[positions] == keys
+        return np.where(found, self._sorted_rows[positions], MISSING)
+
+    def add(self, texts: Sequence[str], vectors: np.ndarray) -> int:
+        """
+        Appends the vectors of texts not already stored. Returns how many were added.
+        """
+        keys = text_keys(texts)
+        _, first = np.unique(keys, return_index=True)
+        new = np.sort(first[self._lookup_keys(keys[first]) == MISSING])
+        if not len(new):
+            return 0
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+            with open(self._vectors_path, "wb") as vectors_file:
+                vectors_file.write(_npy_header(self.dtype, 0, self.dim))
+            with open(os.path.join(self.directory, META_NAME), "w") as meta_file:
+                json.dump({"embedder": self.embedder_name, "dim": self.dim, "dtype": self.dtype.name}, meta_file)
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-dimensional vectors, got {vectors.shape[1]}")
+        rows = len(self) + len(new)
+        with open(self._vectors_path, "r+b") as vectors_file:
+            vectors_file.seek(0, os.SEEK_END)
+            vectors_file.write(np.ascontiguousarray(vectors[new], dtype=self.dtype.newbyteorder("<")).tobytes())
+            vectors_file.seek(0)
+            vectors_file.write(_npy_header(self.dtype, rows, self.dim))
+        with open(self._keys_path, "ab") as keys_file:
+            keys_file.write(keys[new].astype("<u8").tobytes())
+        self._open()
+        return len(new)
+
+    def get(self, rows: np.ndarray) -> np.ndarray:
+        """
+        The stored vectors at rows as float32.
+        """
+        return np.asarray(self.vectors[rows], dtype=np.float32)
+
+    def embed(self, embedder: Embedder, texts: Sequence[str],
+              on_progress: Optional[ProgressCallback] = None) -> np.ndarray:
+        """
+        Returns float32 vectors for texts, embedding and storing only the texts not stored yet.
+        Vectors are stored unweighted and weighted with the embedder's current weights on return.
+        """
+        rows = self.lookup(texts)
+        missing = np.flatnonzero(rows == MISSING)
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if len(missing):
+            missing_texts = list(dict.fromkeys(texts[i] for i in missing))
+            self.add(missing_texts, embed_texts(embedder, missing_texts, on_progress, unweighted=True))
+            rows = self.lookup(texts)
+        elif on_progress:
+            on_progress(len(texts), len(texts))
+        weight = getattr(embedder, "weight", None)
+        return weight(self.get(rows)) if weight else self.get(rows)
+
+    def most_similar(self, queries: np.ndarray, top_k: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Rows and cosine similarities of the top_k stored (unweighted) vectors for each
+        unit-length query, scanning the memory-mapped vectors in chunks.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        best_rows = np.full((len(queries), 0), MISSING, dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self), SEARCH_CHUNK_ROWS):
+            scores = queries @ np.asarray(self.vectors[start:start + SEARCH_CHUNK_ROWS], dtype=np.float32).T
+            rows = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_rows = np.concatenate([best_rows, rows], axis=1)
+            keep = np.argsort(-best_scores, axis=1)[:, :top_k]
+            best_scores = np.take_along_axis(best_scores, keep, axis=1)
+            best_rows = np.take_along_axis(best_rows, keep, axis=1)
+        return best_rows, best_scores
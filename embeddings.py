@@ -0,0 +1,173 @@
+"""
+Pluggable text embedders.
+
+An embedder turns a batch of texts into L2-normalized float32 vectors, so
+cosine similarity is a dot product. Two backends are provided:
+
+- HashedTfidfEmbedder: local and offline. Words and word bigrams are hashed
+  into a fixed number of signed buckets (the hashing trick), weighted by
+  sublinear term frequency and, once fitted, by inverse document frequency.
+  The IDF weights depend on the data, so the embedding store keeps the
+  unweighted vectors (embed_unweighted) and applies them on read (weight).
+- OpenAIEmbedder: the embeddings endpoint, called through the shared rate
+  controller.
+
+embed_texts embeds any number of texts in batches into one preallocated array.
+"""
+import zlib
+from functools import lru_cache
+from typing import List, Optional, Protocol, Sequence
+
+import numpy as np
+
+from code_canonicalization import normalize_label
+from rate_limit_controller import AdaptiveRateController, get_default_controller
+from theme_coding_engine import ProgressCallback
+
+DEFAULT_HASH_DIM = 512
+DEFAULT_EMBEDDING_MODEL = "text-embedding-3-small"
+# The embeddings endpoint accepts at most 2048 inputs per request.
+OPENAI_BATCH_SIZE = 1024
+
+
+class Embedder(Protocol):
+    # Identifies the embedder and the settings its stored vectors depend on;
+    # vectors from different names are not comparable.
+    name: str
+    dim: int
+    batch_size: int
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        ...
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scales each row to unit length in place (zero rows are left as zeros).
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    return vectors
+
+
+@lru_cache(maxsize=1 << 18)
+def _feature_hash(feature: str) -> int:
+    # crc32 rather than hash(): Python's string hash changes between processes.
+    return zlib.crc32(feature.encode("utf-8"))
+
+
+def text_features(text: str) -> List[str]:
+    """
+    Normalized words and word bigrams of text.
+    """
+    tokens = normalize_label(text).split()
+    return tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+
+
+class HashedTfidfEmbedder:
+    """
+    Offline embedder: signed feature hashing with sublinear TF and optional IDF weights.
+    Call fit on the corpus (or a sample of it) to learn the IDF weights.
+    """
+
+    def __init__(self, dim: int = DEFAULT_HASH_DIM, batch_size: int = 4096):
+        self.dim = dim
+        self.batch_size = batch_size
+        self.idf: Optional[np.ndarray] = None
+
+    @property
+    def name(self) -> str:
+        # The same for any fit: it names the unweighted vectors, which do not depend on the data.
+        return f"hashed-tf-{self.dim}"
+
+    def _term_frequencies(self, texts: Sequence[str]) -> np.ndarray:
+        rows, hashes = [], []
+        for row, text in enumerate(texts):
+            for feature in text_features(text):
+                rows.append(row)
+                hashes.append(_feature_hash(feature))
+        hashes = np.asarray(hashes, dtype=np.uint32)
+        buckets = (hashes % self.dim).astype(np.int64)
+        # The top bit picks the sign, so colliding features tend to cancel instead of adding up.
+        signs = np.where(hashes >> 31, -1.0, 1.0)
+        counts = np.bincount(np.asarray(rows, dtype=np.int64) * self.dim + buckets, weights=signs,
+                             minlength=len(texts) * self.dim)
+        counts = counts.reshape(len(texts), self.dim).astype(np.float32)
+        return np.sign(counts) * np.log1p(np.abs(counts))
+
+    def fit(self, texts: Sequence[str]) -> "HashedTfidfEmbedder":
+        document_frequency = np.zeros(self.dim, dtype=np.int64)
+        for start in range(0, len(texts), self.batch_size):
+            document_frequency += (self._term_frequencies(texts[start:start + self.batch_size]) != 0).sum(axis=0)
+        self.idf = (np.log((1 + len(texts)) / (1 + document_frequency)) + 1).astype(np.float32)
+        return self
+
+    def embed_unweighted(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Unit-length sublinear TF vectors, without the fitted IDF weights.
+        """
+        return normalize_rows(self._term_frequencies(texts))
+
+    def weight(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Applies the IDF weights to embed_unweighted vectors and renormalizes them.
+        """
+        if self.idf is None:
+            return vectors
+        return normalize_rows(vectors * self.idf)
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        return self.weight(self.embed_unweighted(texts))
+
+
+class OpenAIEmbedder:
+    """
+    Embeds through the OpenAI embeddings endpoint. Build the client with
+    max_retries=0 so the rate controller sees every throttling response.
+    """
+
+    def __init__(self, client, model_name: str = DEFAULT_EMBEDDING_MODEL, dim: Optional[int] = None,
+                 batch_size: int = OPENAI_BATCH_SIZE, controller: Optional[AdaptiveRateController] = None):
+        self.client = client
+        self.model_name = model_name
+        # The requested size; None keeps the model's native size.
+        self.dimensions = dim
+        # Known once the first response arrives when no size is requested.
+        self.dim = dim
+        self.batch_size = batch_size
+        self.controller = controller or get_default_controller()
+
+    @property
+    def name(self) -> str:
+        return f"openai-{self.model_name}" + (f"-{self.dimensions}" if self.dimensions else "")
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        request = {"model": self.model_name, "input": list(texts)}
+        if self.dimensions:
+            request["dimensions"] = self.dimensions
+        response = self.controller.call(self.client.embeddings.with_raw_response.create, request)
+        data = sorted(response.data, key=lambda item: item.index)
+        vectors = np.asarray([item.embedding for item in data], dtype=np.float32)
+        self.dim = self.dim or vectors.shape[1]
+        return normalize_rows(vectors)
+
+
+def embed_texts(embedder: Embedder, texts: Sequence[str], on_progress: Optional[ProgressCallback] = None,
+                batch_size: Optional[int] = None, unweighted: bool = False) -> np.ndarray:
+    """
+    Embeds texts in batches of the embedder's batch size and returns an (n, dim) float32 array.
+    With unweighted, embedders with data-dependent weights return vectors without them.
+    """
+    batch_size = batch_size or embedder.batch_size
+    embed = getattr(embedder, "embed_unweighted", embedder.embed) if unweighted else embedder.embed
+    vectors: Optional[np.ndarray] = None
+    for start in range(0, len(texts), batch_size):
+        batch = embed(texts[start:start + batch_size])
+        if vectors is None:
+            vectors = np.empty((len(texts), batch.shape[1]), dtype=np.float32)
+        vectors[start:start + len(batch)] = batch
+        if on_progress:
+            on_progress(start + len(batch), len(texts))
+    if vectors is None:
+        return np.zeros((0, embedder.dim or 0), dtype=np.float32)
+    return vectors
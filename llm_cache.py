@@ -0,0 +1,198 @@
+"""
+Persistent, content-addressed cache of LLM function call responses.
+
+Entries are keyed by a SHA-256 of the full request (model, messages, tools and
+tool choice), so the system prompt, tool schema, theme book and cell text are
+all part of the key. The cache lives in a SQLite file shared by every page and
+survives Streamlit reruns and crashes. Least recently used entries are evicted
+once the stored responses exceed max_bytes.
+
+Only responses that parse are cached: callers pass a validate function that
+raises on a malformed payload, and cached entries it rejects are dropped, so
+a bad tool call is requested again instead of being replayed.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Callable, Iterator, Optional
+
+DEFAULT_CACHE_PATH = ".llm_cache.sqlite3"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Parses function call arguments and raises if they are malformed.
+Validator = Callable[[str], object]
+
+
+def make_cache_key(request: dict) -> str:
+    """
+    Hashes a chat completion request into a stable cache key.
+    """
+    canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """
+    SQLite-backed response cache with size-based LRU eviction and hit/miss counters.
+    Safe to share between threads.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key: str, value: str):
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            previous = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time())
+            )
+            self._total_bytes += size - (previous[0] if previous else 0)
+            self._evict()
+            self._conn.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            previous = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if previous is None:
+                return
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._total_bytes -= previous[0]
+            self._conn.commit()
+
+    def get_valid(self, key: str, validate: Optional[Validator] = None) -> Optional[str]:
+        """
+        Returns the cached value if validate accepts it; entries it rejects are deleted.
+        """
+        value = self.get(key)
+        if value is None or validate is None:
+            return value
+        try:
+            validate(value)
+        except Exception:
+            self.delete(key)
+            return None
+        return value
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes:
+            oldest = self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 1"
+            ).fetchone()
+            if oldest is None:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (oldest[0],))
+            self._total_bytes -= oldest[1]
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": self._total_bytes}
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._total_bytes = 0
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache() -> LLMCache:
+    """
+    Returns the process-wide cache used by all pages.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = LLMCache()
+        return _default_cache
+
+
+def extract_function_arguments(response) -> str:
+    """
+    Returns the arguments of the first tool call in a chat completion.
+    """
+    tool_calls = response.choices[0].message.tool_calls
+    if not tool_calls:
+        raise ValueError("Model response did not contain a function call")
+    return tool_calls[0].function.arguments
+
+
+def cached_function_arguments(create: Callable, request: dict, cache: Optional[LLMCache] = None,
+                              validate: Optional[Validator] = None) -> str:
+    """
+    Returns the function call arguments for request, calling
+    create(**request) (e.g. client.chat.completions.create) only on a cache miss.
+    Arguments that validate rejects raise and are not cached.
+    """
+    cache = cache or get_default_cache()
+    key = make_cache_key(request)
+    cached = cache.get_valid(key, validate)
+    if cached is not None:
+        return cached
+    arguments = extract_function_arguments(create(**request))
+    if validate:
+        validate(arguments)
+    cache.put(key, arguments)
+    return arguments
+
+
+def stream_function_arguments(create: Callable, request: dict, cache: Optional[LLMCache] = None,
+                              validate: Optional[Validator] = None) -> Iterator[str]:
+    """
+    Yields the function call arguments for request as text deltas while the model
+    streams them, calling create(**request, stream=True). A cache hit is yielded
+    whole; the full arguments are cached once the stream completes and validate
+    accepts them (otherwise it raises after the last delta).
+    """
+    cache = cache or get_default_cache()
+    key = make_cache_key(request)
+    cached = cache.get_valid(key, validate)
+    if cached is not None:
+        yield cached
+        return
+    parts = []
+    for chunk in create(**request, stream=True):
+        if not chunk.choices:
+            continue
+        for tool_call in chunk.choices[0].delta.tool_calls or []:
+            # Only the first tool call is used, as in extract_function_arguments.
+            if tool_call.index == 0 and tool_call.function and tool_call.function.arguments:
+                parts.append(tool_call.function.arguments)
+                yield tool_call.function.arguments
+    if not parts:
+        raise ValueError("Model response did not contain a function call")
+    arguments = "".join(parts)
+    if validate:
+        validate(arguments)
+    cache.put(key, arguments)
@@ -0,0 +1,324 @@
+"""
+A local stand-in for the OpenAI chat completions endpoint.
+
+Answers every POST to .../chat/completions with a forced function call whose
+arguments come from a responder callable, so the coding engines can be
+exercised without network access or an API key. It can also enforce a
+requests-per-minute limit (429 with Retry-After and x-ratelimit-* headers) and
+inject random 429/500 errors to exercise the rate controller. Requests with
+"stream": true are answered as server-sent events, a few characters of the
+arguments per chunk:
+
+    with MockChatCompletionsServer(zero_theme_responder(["Translation"])) as server:
+        code_cells(texts, themebook, "test-key", EngineConfig(base_url=server.url))
+
+FakeBatchBackend does the same for the batch orchestrator: it stands in for a
+batch service, answering each submitted file with the responder after a
+number of status polls, and can fail a fraction of the jobs.
+"""
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque
+from typing import Callable, List, Optional, Tuple
+
+from batch_jsonl import iter_jsonl, write_jsonl
+from token_counting import estimate_message_tokens, estimate_tokens
+
+Responder = Callable[[dict], dict]
+
+
+def empty_responder(body: dict) -> dict:
+    return {}
+
+
+def zero_theme_responder(theme_labels: List[str]) -> Responder:
+    """
+    Responder that marks every theme as absent, in whichever response mode the
+    request's tool schema asks for, for single and packed requests.
+    """
+    def zero_result(properties: dict) -> dict:
+        if "themes" in properties:
+            return {"themes": [{"label": label, "value": 0, "justification": "Not mentioned."}
+                               for label in theme_labels]}
+        if "codes" in properties:
+            return {"codes": {label: False for label in theme_labels}}
+        return {"present": []}
+
+    def respond(body: dict) -> dict:
+        parameters = body["tools"][0]["function"]["parameters"]["properties"]
+        if "results" not in parameters:
+            return zero_result(parameters)
+        item_properties = parameters["results"]["items"]["properties"]
+        cells = json.loads(body["messages"][-1]["content"])
+        return {"results": [{"id": cell["id"], **zero_result(item_properties)} for cell in cells]}
+    return respond
+
+
+def _forced_function_name(body: dict) -> str:
+    tool_choice = body.get("tool_choice")
+    if isinstance(tool_choice, dict):
+        return tool_choice.get("function", {}).get("name", "")
+    tools = body.get("tools") or [{}]
+    return tools[0].get("function", {}).get("name", "")
+
+
+def build_completion(body: dict, arguments: dict) -> dict:
+    """
+    Wraps function call arguments in a chat.completion response object.
+    """
+    arguments_json = json.dumps(arguments)
+    prompt_tokens = estimate_message_tokens(body.get("messages", []))
+    completion_tokens = estimate_tokens(arguments_json)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": [{
+            "index": 0,
+            "finish_reason": "tool_calls",
+            "message": {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{
+                    "id": f"call_{uuid.uuid4().hex[:24]}",
+                    "type": "function",
+                    "function": {"name": _forced_function_name(body), "arguments": arguments_json}
+                }]
+            }
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    }
+
+
+def build_completion_chunks(body: dict, arguments: dict, chunk_chars: int = 16) -> List[dict]:
+    """
+    Splits function call arguments into chat.completion.chunk objects, as sent when streaming.
+    """
+    arguments_json = json.dumps(arguments)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+
+    def chunk(delta: dict, finish_reason: Optional[str] = None) -> dict:
+        return {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                "model": body.get("model", "mock"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+    chunks = [chunk({"role": "assistant", "content": None, "tool_calls": [{
+        "index": 0, "id": f"call_{uuid.uuid4().hex[:24]}", "type": "function",
+        "function": {"name": _forced_function_name(body), "arguments": ""}
+    }]})]
+    chunks.extend(chunk({"tool_calls": [{"index": 0, "function": {"arguments": arguments_json[i:i + chunk_chars]}}]})
+                  for i in range(0, len(arguments_json), chunk_chars))
+    chunks.append(chunk({}, "tool_calls"))
+    return chunks
+
+
+class _BurstHTTPServer(ThreadingHTTPServer):
+    # Queue bursts of concurrent connections like a real API; the default backlog is 5.
+    request_queue_size = 128
+
+
+class MockChatCompletionsServer:
+    """
+    Threaded HTTP server on localhost; use as a context manager and pass `url`
+    as the client's base_url.
+    """
+
+    def __init__(self, responder: Optional[Responder] = None, latency_seconds: float = 0.0,
+                 requests_per_minute: Optional[int] = None, failure_rate: float = 0.0,
+                 seed: Optional[int] = None, host: str = "127.0.0.1", port: int = 0,
+                 chunk_delay_seconds: float = 0.0, window_seconds: float = 60.0):
+        self.responder = responder or empty_responder
+        self.latency_seconds = latency_seconds
+        # Length of the requests_per_minute window; shorten it to exercise throttling quickly.
+        self.window_seconds = window_seconds
+        # Pause between streamed chunks, to make streaming visible.
+        self.chunk_delay_seconds = chunk_delay_seconds
+        self.requests_per_minute = requests_per_minute
+        self.failure_rate = failure_rate
+        self.request_count = 0
+        self.throttled_count = 0
+        self.failed_count = 0
+        self._random = random.Random(seed)
+        self._window = deque()
+        self._lock = threading.Lock()
+        self._httpd = _BurstHTTPServer((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                    return
+                status, headers = server._admit()
+                if status != 200:
+                    message = "Rate limit reached" if status == 429 else "Injected server error"
+                    self._send_json(status, {"error": {"message": message, "type": "mock_error"}}, headers)
+                    return
+                if server.latency_seconds:
+                    time.sleep(server.latency_seconds)
+                if body.get("stream"):
+                    self._send_stream(build_completion_chunks(body, server.responder(body)), headers)
+                    return
+                self._send_json(200, build_completion(body, server.responder(body)), headers)
+
+            def _send_stream(self, chunks: List[dict], headers: dict):
+                self.send_response(200)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for chunk in chunks + ["[DONE]"]:
+                    data = chunk if isinstance(chunk, str) else json.dumps(chunk)
+                    self.wfile.write(f"data: {data}\n\n".encode())
+                    self.wfile.flush()
+                    if server.chunk_delay_seconds:
+                        time.sleep(server.chunk_delay_seconds)
+
+            def _send_json(self, status: int, payload: dict, headers: Optional[dict] = None):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _admit(self) -> Tuple[int, dict]:
+        """
+        Decides whether a request succeeds, is throttled or fails, and builds the rate-limit headers.
+        """
+        with self._lock:
+            self.request_count += 1
+            now = time.monotonic()
+            while self._window and now - self._window[0] >= self.window_seconds:
+                self._window.popleft()
+            headers = {}
+            if self.requests_per_minute:
+                reset = self.window_seconds - (now - self._window[0]) if self._window else 0.0
+                if len(self._window) >= self.requests_per_minute:
+                    self.throttled_count += 1
+                    return 429, {"retry-after-ms": str(int(reset * 1000)),
+                                 "x-ratelimit-limit-requests": str(self.requests_per_minute),
+                                 "x-ratelimit-remaining-requests": "0",
+                                 "x-ratelimit-reset-requests": f"{reset:.3f}s"}
+                self._window.append(now)
+                headers = {"x-ratelimit-limit-requests": str(self.requests_per_minute),
+                           "x-ratelimit-remaining-requests": str(self.requests_per_minute - len(self._window)),
+                           "x-ratelimit-reset-requests": f"{self.window_seconds - (now - self._window[0]):.3f}s"}
+            if self.failure_rate and self._random.random() < self.failure_rate:
+                self.failed_count += 1
+                return self._random.choice([429, 500]), {}
+            return 200, headers
+
+    def start(self) -> "MockChatCompletionsServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class FakeBatchBackend:
+    """
+    In-process batch service with the upload/submit/status/download interface of
+    batch_orchestrator.OpenAIBatchBackend. Batches complete after polls_to_complete
+    status calls; each job then fails with probability failure_rate. As with the
+    Batch API, failed jobs are written to the error file, not the output file.
+    """
+
+    def __init__(self, responder: Optional[Responder] = None, polls_to_complete: int = 2,
+                 failure_rate: float = 0.0, seed: Optional[int] = None, directory: Optional[str] = None):
+        self.responder = responder or empty_responder
+        self.polls_to_complete = polls_to_complete
+        self.failure_rate = failure_rate
+        self.directory = directory or tempfile.mkdtemp(prefix="fake-batch-")
+        self.submitted_count = 0
+        self.job_count = 0
+        self._random = random.Random(seed)
+        self._files = {}
+        self._batches = {}
+
+    def _new_file(self) -> Tuple[str, str]:
+        file_id = f"file-{uuid.uuid4().hex[:12]}"
+        return file_id, os.path.join(self.directory, file_id + ".jsonl")
+
+    def upload(self, path: str) -> str:
+        file_id, stored_path = self._new_file()
+        write_jsonl(iter_jsonl(path), stored_path)
+        self._files[file_id] = stored_path
+        return file_id
+
+    def submit(self, file_id: str) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+        self._batches[batch_id] = {"input_file_id": file_id, "polls": 0, "status": "in_progress",
+                                   "output_file_id": None, "error_file_id": None}
+        self.submitted_count += 1
+        return batch_id
+
+    def _run_job(self, job: dict) -> dict:
+        self.job_count += 1
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            return {"id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": job["custom_id"],
+                    "response": {"status_code": 500, "body": {"error": {"message": "Injected server error"}}},
+                    "error": None}
+        return {"id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": job["custom_id"],
+                "response": {"status_code": 200, "body": build_completion(job["body"], self.responder(job["body"]))},
+                "error": None}
+
+    def status(self, batch_id: str) -> dict:
+        batch = self._batches[batch_id]
+        batch["polls"] += 1
+        if batch["status"] == "in_progress" and batch["polls"] >= self.polls_to_complete:
+            lines = [self._run_job(job) for job in iter_jsonl(self._files[batch["input_file_id"]])]
+            for key, batch_lines in (
+                ("output_file_id", [line for line in lines if line["response"]["status_code"] == 200]),
+                ("error_file_id", [line for line in lines if line["response"]["status_code"] != 200]),
+            ):
+                if batch_lines:
+                    file_id, path = self._new_file()
+                    write_jsonl(batch_lines, path)
+                    self._files[file_id] = path
+                    batch[key] = file_id
+            batch["status"] = "completed"
+        return {"status": batch["status"], "output_file_id": batch["output_file_id"],
+                "error_file_id": batch["error_file_id"]}
+
+    def download(self, file_id: str, path: str):
+        shutil.copyfile(self._files[file_id], path)
@@ -1,138 +1,64 @@
 import streamlit as st
 import pandas as pd
-import openai
-import json
-from io import StringIO
-from typing import List
-
-CODING_SYSTEM_PROMPT = "You are a helpful assistant that extracts short qualitative codes from text."
-
-
-def get_codes_for_cell(cell_value: str, openai_api_key: str) -> List[str]:
+from io import BytesIO, StringIO
+from typing import Optional
+
+from app_resources import read_uploaded_csv, timed_rerun
+from code_canonicalization import DEFAULT_THRESHOLD, CodeCanonicalizer
+from codebook_extraction import ExtractionRun, SaturationConfig, extract_codebook
+from run_journal import RunJournal, list_runs, new_run_id
+from theme_coding_engine import EngineConfig, ProgressCallback
+
+CODEBOOK_RUN_KIND = "codebook"
+PREVIEW_ROWS = 200
+# Largest rows x code columns matrix offered as a wide CSV download.
+WIDE_EXPORT_MAX_CELLS = 5_000_000
+
+
+def code_entire_dataframe(
+    df: pd.DataFrame,
+    openai_api_key: str,
+    journal: Optional[RunJournal] = None,
+    config: Optional[EngineConfig] = None,
+    on_progress: Optional[ProgressCallback] = None,
+    canonicalizer: Optional[CodeCanonicalizer] = None,
+    saturation: Optional[SaturationConfig] = None
+) -> ExtractionRun:
     """
-    Sends cell_value to OpenAI with a 'function call' that returns a list of qualitative codes.
-    Returns a list of code strings extracted from the content.
-    """
-    openai.api_key = openai_api_key
-    
-    # Example function schema for extracting codes from text
-    functions = {
-            "name": "extract_codes_from_text",
-            "description": "Extract qualitative codes and their definitions from a piece of text.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "codes": {
-                        "type": "array",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "label": {"type": "string"},
-                                "definition": {"type": "string"}
-                            },
-                            "required": ["label", "definition"]
-                        },
-                        "description": "A list of code objects with label and definition."
-                    }
-                },
-                "required": ["codes"]
-            }
-        }
-    
-    
-    # We craft a basic message to ask GPT for codes
-    messages = [
-        {
-            "role": "system",
-            "content": CODING_SYSTEM_PROMPT
-        },
-        {
-            "role": "user",
-            "content": f"Extract codes from this text:\n\n{cell_value}\n\n"
-                       f"Return each code as an object with 'label' and 'definition'. "
-                       f"Short definitions are fine."
-        }
-    ]
-    
-    # We explicitly request the function call
-    response = openai.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages,
-        tools=[
-            {
-                "type": "function",
-                "function": functions
-            }
-        ],
-        tool_choice={"type": "function", "function": {"name": "extract_codes_from_text"}}
-    )
-    
-    # The assistant should return a JSON payload that matches our function schema
-    try:
-        function_args = response.choices[0].message.tool_calls[0].function.arguments
-        parsed = json.loads(function_args)  # e.g. { "codes": [ { "label": "X", "definition": "Y" }, ...] }
-        code_objects = parsed.get("codes", [])
-        
-    except Exception:
-        # If anything unexpected happens, just return an empty list
-        st.warning("Failed to extract codes from the text. You may need to restart the process.")
-        return []
-    
-    # Convert objects into a list of labels + dict of definitions
-    codes_list = []
-    code_definitions = {}
-    for obj in code_objects:
-        label = obj.get("label", "").strip()
-        definition = obj.get("definition", "").strip()
-        if label: 
-            codes_list.append(label)
-            code_definitions[label] = definition
-
-    return codes_list, code_definitions
-
-def code_entire_dataframe(df: pd.DataFrame, openai_api_key: str):
-    """
-    Iterates over each cell, extracts codes+definitions from OpenAI,
+    Extracts codes+definitions from every cell concurrently (see codebook_extraction),
     adds columns for each code, and accumulates the definitions in a codebook.
+    With a journal, each answer's codes are saved as they arrive and answers the
+    journaled run already coded are not sent again. With a canonicalizer,
+    near-duplicate code labels share one code and one column. With saturation,
+    answers are sampled until new codes stop appearing and only sampled cells are coded.
 
-    Returns:
-        coded_df (pd.DataFrame): DataFrame with additional columns <colName>_<codeLabel>.
+    Returns an ExtractionRun with:
+        code_matrix (SparseCodeMatrix): (row, column, code) entries; widen() gives <colName>_<codeLabel> columns.
         codebook_df (pd.DataFrame): DataFrame with columns ['Code', 'Definition'].
     """
-    coded_df = df.copy()
-    code_definitions_global = {}  # code_label -> definition
-
-    # We'll store new columns in a dict-of-lists to avoid DataFrame fragmentation
-    new_cols_dict = {}
-
-    for row_idx in range(len(coded_df)):
-        for col_name in coded_df.columns:
-            cell_value = str(coded_df.iat[row_idx, coded_df.columns.get_loc(col_name)])
-            codes_list, local_definitions = get_codes_for_cell(cell_value, openai_api_key)
-
-            # Update global codebook
-            for code_label, definition in local_definitions.items():
-                if code_label not in code_definitions_global:
-                    code_definitions_global[code_label] = definition
+    return extract_codebook(df, openai_api_key, config, journal, on_progress, canonicalizer, saturation)
 
-            # Prepare columns for codes
-            for code_label in codes_list:
-                new_col = f"{col_name}_{code_label}"
-                if new_col not in new_cols_dict:
-                    new_cols_dict[new_col] = [0]*len(coded_df)
-                new_cols_dict[new_col][row_idx] = 1
 
-    # Now that we have all new columns in memory, add them at once
-    if new_cols_dict:
-        new_cols_df = pd.DataFrame(new_cols_dict)
-        coded_df = pd.concat([coded_df, new_cols_df], axis=1)
-
-    # Build the codebook DataFrame
-    codebook_records = [{"Code": lbl, "Definition": defn} 
-                        for lbl, defn in code_definitions_global.items()]
-    codebook_df = pd.DataFrame(codebook_records)
-
-    return coded_df, codebook_df
+def display_saturation_settings() -> Optional[SaturationConfig]:
+    """
+    Lets the user code every answer or sample until the codebook saturates.
+    """
+    sample = st.radio(
+        "Answers to code",
+        [False, True],
+        format_func={False: "Every answer", True: "Sample until no new codes appear (codebook only)"}.get,
+        help="New codes usually stop appearing after a few hundred answers; sampling stops there."
+    )
+    if not sample:
+        return None
+    cols = st.columns(3)
+    batch_size = cols[0].number_input("Answers per batch", min_value=5, max_value=1000,
+                                      value=SaturationConfig.batch_size)
+    new_code_rate = cols[1].number_input("Stop below new codes per answer", min_value=0.0, max_value=1.0,
+                                         value=SaturationConfig.new_code_rate, step=0.01, format="%.3f")
+    patience = cols[2].number_input("For this many batches in a row", min_value=1, max_value=20,
+                                    value=SaturationConfig.patience)
+    return SaturationConfig(batch_size=int(batch_size), new_code_rate=new_code_rate, patience=int(patience))
 
 
 def main():
@@ -151,33 +77,110 @@ def main():
         return
 
     # Read and display the data as a DataFrame
-    df = pd.read_csv(uploaded_file).head(3) # for testing
+    df = read_uploaded_csv(uploaded_file)
     st.write("### Uploaded Data")
     st.dataframe(df, use_container_width=True)
 
+    runs = dict(list_runs(CODEBOOK_RUN_KIND))
+    resume_run_id = st.selectbox(
+        "Resume a previous run",
+        [None] + list(runs),
+        format_func=lambda run_id: "Start a new run" if run_id is None else f"{run_id} ({runs[run_id]} answers done)",
+        help="Each answer's codes are journaled as they arrive; resuming only codes the rest."
+    )
+    max_concurrency = st.number_input("Concurrent requests", min_value=1, max_value=256,
+                                      value=EngineConfig.max_concurrency)
+    merge_codes = st.checkbox("Merge near-duplicate codes", value=True,
+                              help="Spellings like 'Grammar check' and 'grammar checking' become one code and one column.")
+    similarity = st.slider("Merge similarity", min_value=0.3, max_value=1.0, value=DEFAULT_THRESHOLD, step=0.05,
+                           disabled=not merge_codes,
+                           help="Minimum character n-gram similarity between labels that are merged.")
+    saturation = display_saturation_settings()
+
     # 3. Code the data upon button click
     if st.button("Code Data"):
-        with st.spinner("Coding data. Please wait..."):
-            coded_df, codebook_df = code_entire_dataframe(df, api_key)
-
-        st.success("Data coded successfully!")
+        journal = RunJournal(resume_run_id or new_run_id(CODEBOOK_RUN_KIND))
+        st.caption(f"Run ID: {journal.run_id}. If coding is interrupted, select it above to resume.")
+        progress_bar = st.progress(0.0, text="Coding data...")
+        canonicalizer = CodeCanonicalizer(similarity) if merge_codes else None
+        try:
+            run = code_entire_dataframe(
+                df, api_key, journal, EngineConfig(max_concurrency=int(max_concurrency)),
+                on_progress=lambda done, total: progress_bar.progress(done / total, text=f"Coded {done}/{total} answers"),
+                canonicalizer=canonicalizer,
+                saturation=saturation
+            )
+        finally:
+            journal.close()
+        code_matrix, codebook_df = run.code_matrix, run.codebook_df
+
+        st.success(f"Data coded with {run.request_count} requests in {run.elapsed_seconds:.1f}s!")
+        st.caption(f"{run.calls_saved} calls saved by skipping trivial and duplicate answers, "
+                   f"{run.cache_hits} responses reused from cache, {run.resumed} answers restored from the run journal.")
+        if run.failures:
+            st.warning(f"{len(run.failures)} answers failed to code. Resume run {journal.run_id} to retry them.")
+        if saturation is not None:
+            answers_coded = run.discovery_curve[-1][0] if run.discovery_curve else 0
+            if run.saturated:
+                st.info(f"The codebook saturated after {answers_coded} answers; "
+                        f"{run.skipped} answers were not sent, saving {run.skipped} calls. "
+                        f"Only the sampled answers are coded below.")
+            else:
+                st.info(f"The codebook did not saturate; all {answers_coded} answers were coded.")
+            st.write("### Code Discovery Curve")
+            st.line_chart(pd.DataFrame(run.discovery_curve, columns=["Answers coded", "Codes found"]),
+                          x="Answers coded", y="Codes found")
         st.write("### Coded DataFrame")
-        st.dataframe(coded_df, use_container_width=True)
+        st.caption(f"{len(code_matrix)} codes assigned. Showing the first {PREVIEW_ROWS} rows.")
+        st.dataframe(code_matrix.widen(df, PREVIEW_ROWS), use_container_width=True)
 
         # Display the codebook
         st.write("### Codebook")
         st.dataframe(codebook_df, use_container_width=True)
+        if canonicalizer is not None:
+            alias_df = canonicalizer.alias_table()
+            st.write(f"### Merged Codes ({len(alias_df)} labels merged into other codes)")
+            st.dataframe(alias_df, use_container_width=True)
+            st.download_button(
+                label="Download Alias Table CSV",
+                data=alias_df.to_csv(index=False),
+                file_name="code_aliases.csv",
+                mime="text/csv"
+            )
 
         # 4. Download buttons
-        # For the coded DataFrame
-        csv_buffer_coded = StringIO()
-        coded_df.to_csv(csv_buffer_coded, index=False)
+        # For the coded data: a long (row, column, code) table, plus the wide layout when it is small enough
+        long_df = code_matrix.to_long(df)
         st.download_button(
-            label="Download Coded CSV",
-            data=csv_buffer_coded.getvalue(),
-            file_name="coded_data.csv",
+            label="Download Codes CSV (one row per assigned code)",
+            data=long_df.to_csv(index=False),
+            file_name="coded_data_long.csv",
             mime="text/csv"
         )
+        parquet_buffer = BytesIO()
+        try:
+            code_matrix.to_parquet(parquet_buffer)
+        except ImportError:
+            st.caption("Install pyarrow to download the codes as Parquet.")
+        else:
+            st.download_button(
+                label="Download Codes Parquet",
+                data=parquet_buffer.getvalue(),
+                file_name="coded_data_long.parquet",
+                mime="application/octet-stream"
+            )
+        wide_columns = code_matrix.entries.groupby(["col_name", "code"], observed=True).ngroups
+        if len(df) * wide_columns <= WIDE_EXPORT_MAX_CELLS:
+            csv_buffer_coded = StringIO()
+            code_matrix.widen(df).to_csv(csv_buffer_coded, index=False)
+            st.download_button(
+                label="Download Coded CSV",
+                data=csv_buffer_coded.getvalue(),
+                file_name="coded_data.csv",
+                mime="text/csv"
+            )
+        else:
+            st.caption(f"The wide layout would have {wide_columns} code columns; use the long CSV or Parquet instead.")
 
         # For the codebook
         csv_buffer_codebook = StringIO()
@@ -190,4 +193,5 @@ def main():
         )
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    with timed_rerun("Generate Codebook"):
+        main()
\ No newline at end of file
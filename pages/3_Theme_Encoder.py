@@ -1,169 +1,160 @@
 import streamlit as st
 import pandas as pd
-import openai
-import json
+import re
 from io import StringIO
+from typing import Optional, Tuple
 
-# ---------- 1. Define the helper function for calling GPT with a function schema ----------
-
-def get_themes_for_text(
-    text: str, 
-    themebook: pd.DataFrame, 
-    openai_api_key: str, 
-    model_name: str = "gpt-4o-mini"
-):
-    """
-    Sends the input text + theme definitions to OpenAI, requests a structured JSON 
-    with label, value, and justification for each theme.
-    """
-    openai.api_key = openai_api_key
-    
-    # Define the function schema
-    function_schema = {
-        "name": "extract_themes_from_text",
-        "description": "Given a text, identify whether each theme in the theme book applies. Return 0 or 1, plus a justification.",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "themes": {
-                    "type": "array",
-                    "items": {
-                        "type": "object",
-                        "properties": {
-                            "label": {
-                                "type": "string", 
-                                "description": "The theme label from the theme book."
-                            },
-                            "value": {
-                                "type": "integer", 
-                                "description": "1 if theme is present, 0 if not."
-                            },
-                            "justification": {
-                                "type": "string", 
-                                "description": "A brief explanation of why the theme was assigned 0 or 1."
-                            }
-                        },
-                        "required": ["label", "value", "justification"]
-                    }
-                }
-            },
-            "required": ["themes"]
-        }
-    }
-
-    # Build a user-friendly message enumerating the themes and definitions
-    # so GPT knows what to look for
-    theme_lines = []
-    for _, row in themebook.iterrows():
-        theme_label = str(row["theme"])
-        theme_def = str(row["definition"])
-        theme_lines.append(f"- {theme_label}: {theme_def}")
-    themes_str = "\n".join(theme_lines)
-
-    user_message = f"""
-Text to analyze:
-{text}
-
-You have a theme book containing:
-{themes_str}
-
-Return JSON in this structure:
-{{
-  "themes": [
-    {{
-      "label": "<ThemeLabel>",
-      "value": 0 or 1,
-      "justification": "Short reason"
-    }},
-    ...
-  ]
-}}
-Make sure to include each theme from the theme book exactly once.
-"""
-
-    # Prepare the messages for GPT
-    messages = [
-        {"role": "system", "content": "You are a helpful theme identification assistant."},
-        {"role": "user", "content": user_message}
-    ]
-
-    # Call ChatCompletion with a function call request
-    response = openai.chat.completions.create(
-        model=model_name,
-        messages=messages,
-        tools=[
-            {
-                "type": "function",
-                "function": function_schema
-            }
-        ],
-        tool_choice={"type": "function", "function": {"name": "extract_themes_from_text"}}
-    )
-
-    # If GPT returns the JSON via a function call, parse it
-    
-    function_args = response.choices[0].message.tool_calls[0].function.arguments
-    try:
-        parsed = json.loads(function_args)
-        # Should have a "themes" list
-        return parsed.get("themes", [])
-    except:
-        return []
+from app_resources import read_uploaded_csv, timed_rerun
+from answer_preprocessing import DEFAULT_TRIVIAL_RULES, compile_trivial_patterns
+from llm_cache import get_default_cache
+from run_planner import SYNC_ROUTE, estimate_strategies, estimates_to_dataframe, measure_run, route_run
+from run_journal import list_runs, new_run_id
+from theme_coding_engine import CodingRun, EngineConfig, ProgressCallback, theme_code_dataframe
+from response_modes import RESPONSE_MODES
+from theme_results import MERGED_VIEW, PER_COLUMN_VIEW
 
+THEME_RUN_KIND = "themes"
 
-# ---------- 2. Define a helper function to apply the theme-coding across your entire dataset ----------
+# ---------- 1. Define a helper function to apply the theme-coding across your entire dataset ----------
 
 def theme_code_entire_dataframe(
     df: pd.DataFrame, 
     themebook: pd.DataFrame, 
-    openai_api_key: str
-) -> pd.DataFrame:
+    openai_api_key: str,
+    config: Optional[EngineConfig] = None,
+    on_progress: Optional[ProgressCallback] = None,
+    view: str = MERGED_VIEW
+) -> Tuple[pd.DataFrame, CodingRun]:
     """
-    For each text cell in df, calls get_themes_for_text(...) to retrieve 0/1 + justification,
-    then populates new columns for each theme and its justification.
+    Codes every text cell in df concurrently (see theme_coding_engine) and
+    populates new columns for each theme and its justification, either
+    OR-merged across text columns or one set per text column.
     """
+    return theme_code_dataframe(df, themebook, openai_api_key, config, on_progress, view)
 
-    coded_df = df.copy()
 
-    # Get the unique themes from the themebook
-    theme_labels = themebook["theme"].tolist()
-
-    # Pre-create columns for each theme + justification
-    # so we have columns to store the 0/1 values and short text
-    for theme in theme_labels:
-        # If these columns already exist in df, you might rename them to avoid clashes
-        coded_df[theme] = 0
-        coded_df[f"{theme}_justification"] = ""
-
-    # For each row/col in the original data, request theme presence from GPT
-    for row_idx in range(len(coded_df)):
-        for col_name in df.columns:
-            # We only code original columns. (Exclude newly added theme columns.)
-            if col_name in theme_labels or col_name.endswith("_justification"):
-                continue
+def display_trivial_rules_editor() -> list:
+    """
+    Renders the editable table of trivial-answer rules. Answers fully matching
+    a pattern (after normalization) are coded as all zeros without a request.
+    Returns the valid patterns.
+    """
+    st.caption("Trivial answer rules (regular expressions matched against the lower-cased, trimmed answer)")
+    rules_df = st.data_editor(
+        pd.DataFrame(DEFAULT_TRIVIAL_RULES, columns=["pattern", "description"]),
+        num_rows="dynamic",
+        use_container_width=True,
+        key="trivial_rules"
+    )
+    patterns = []
+    for pattern in rules_df["pattern"].dropna():
+        try:
+            compile_trivial_patterns([pattern])
+            patterns.append(pattern)
+        except re.error as exc:
+            st.error(f"Ignoring invalid pattern {pattern!r}: {exc}")
+    return patterns
 
-            cell_value = str(coded_df.iat[row_idx, coded_df.columns.get_loc(col_name)])
-            if not cell_value.strip():
-                # Skip empty cells
-                continue
 
-            # Call GPT to get the theme presence
-            themes_result = get_themes_for_text(cell_value, themebook, openai_api_key)
-            # Each item is: { "label": "...", "value": 0 or 1, "justification": "..." }
-            for t_obj in themes_result:
-                label = t_obj.get("label", "").strip()
-                val = t_obj.get("value", 0)
-                just = t_obj.get("justification", "").strip()
+def display_run_selector() -> Optional[str]:
+    """
+    Lets the user resume an earlier (interrupted) run from the run journal.
+    Returns the selected run ID, or None to start a new run.
+    """
+    runs = dict(list_runs(THEME_RUN_KIND))
+    return st.selectbox(
+        "Resume a previous run",
+        [None] + list(runs),
+        format_func=lambda run_id: "Start a new run" if run_id is None else f"{run_id} ({runs[run_id]} answers done)",
+        help="Completed answers are journaled as they finish; resuming only codes the rest."
+    )
 
-                # Store these values if label is recognized
-                if label in theme_labels:
-                    coded_df.at[row_idx, label] = val
-                    coded_df.at[row_idx, f"{label}_justification"] = just
 
-    return coded_df
+def display_engine_settings() -> EngineConfig:
+    """
+    Renders the concurrency and rate limit settings for the coding engine.
+    """
+    with st.expander("Run settings"):
+        max_concurrency = st.number_input("Concurrent requests", min_value=1, max_value=256,
+                                          value=EngineConfig.max_concurrency)
+        requests_per_minute = st.number_input("Requests per minute limit", min_value=1,
+                                              value=EngineConfig.requests_per_minute)
+        tokens_per_minute = st.number_input("Tokens per minute limit", min_value=1000,
+                                            value=EngineConfig.tokens_per_minute, step=1000)
+        use_cache = st.checkbox("Reuse cached responses", value=True,
+                                help="Cells already coded with the same model, prompt and theme book are not sent again.")
+        deduplicate = st.checkbox("Code identical answers once", value=True,
+                                  help="Answers that differ only in whitespace or case share one request.")
+        trivial_patterns = display_trivial_rules_editor()
+        response_mode = st.selectbox(
+            "Model output",
+            list(RESPONSE_MODES),
+            format_func=lambda name: RESPONSE_MODES[name].title,
+            help="Sparse outputs list only the present themes; absent themes are filled in as 0 locally."
+        )
+        pack_size = st.number_input("Cells per request (1 = no packing)", min_value=1, max_value=100,
+                                    value=EngineConfig.pack_size,
+                                    help="Sends the theme book once for several cells; pack sizes shrink to fit the model's limits.")
+    return EngineConfig(
+        pack_size=int(pack_size),
+        response_mode=response_mode,
+        use_cache=use_cache,
+        deduplicate=deduplicate,
+        trivial_patterns=trivial_patterns,
+        max_concurrency=int(max_concurrency),
+        requests_per_minute=int(requests_per_minute),
+        tokens_per_minute=int(tokens_per_minute)
+    )
 
 
-# ---------- 3. Define the main Streamlit app ----------
+def display_run_plan(df: pd.DataFrame, themebook: pd.DataFrame, config: EngineConfig) -> pd.DataFrame:
+    """
+    Shows the projected requests, tokens, cost and time of the run for each strategy,
+    and routes the run to this page, to batch, or splits it between the two.
+    Returns the rows to code on this page.
+    """
+    with st.expander("Estimate tokens, cost and time"):
+        cols = st.columns(2)
+        deadline_hours = cols[0].number_input("Deadline in hours (0 = none)", min_value=0.0, value=0.0)
+        max_cost_usd = cols[1].number_input("Cost ceiling in USD (0 = none)", min_value=0.0, value=0.0)
+        plan_key = (len(df), tuple(df.columns), len(themebook), config.model_name, config.response_mode,
+                    config.pack_size, config.max_concurrency, config.requests_per_minute, config.tokens_per_minute)
+        if st.button("Estimate run"):
+            shape = measure_run(df, themebook, config.model_name, config.response_mode,
+                                config.pack_size, config.trivial_patterns)
+            estimates = estimate_strategies(shape, config.model_name, config.max_concurrency,
+                                            config.requests_per_minute, config.tokens_per_minute)
+            st.session_state["run_plan"] = (plan_key, shape, estimates)
+
+        plan = st.session_state.get("run_plan")
+        if plan is None or plan[0] != plan_key:
+            return df
+        _, shape, estimates = plan
+        st.write(f"{shape.cells} text cells, {shape.calls_saved} skipped as trivial or duplicate answers.")
+        st.dataframe(estimates_to_dataframe(estimates), use_container_width=True)
+        st.caption("Estimates use the configured rate limits and list prices. "
+                   "Batch jobs are billed at a discount but may take up to the full completion window.")
+
+        decision = route_run(estimates, config.pack_size > 1, deadline_hours * 60 or None, max_cost_usd or None)
+        sync_rows = decision.sync_rows(len(df))
+        st.info(f"Recommended route: {decision.route}. {decision.reason} "
+                f"Predicted ${decision.cost_usd:.4f}, first results in {decision.first_results_minutes:.1f} min, "
+                f"all results in {decision.minutes:.1f} min.")
+        if decision.route == SYNC_ROUTE:
+            return df
+        st.download_button(
+            label=f"Download the {len(df) - sync_rows} rows to code in batch (CSV)",
+            data=df.iloc[sync_rows:].to_csv(index=False),
+            file_name="batch_rows.csv",
+            mime="text/csv",
+            help="Upload this file on the Theme Encoder Batch Job page."
+        )
+        if sync_rows and st.checkbox(f"Only code the first {sync_rows} rows here", value=True):
+            return df.iloc[:sync_rows].reset_index(drop=True)
+    return df
+
+
+# ---------- 2. Define the main Streamlit app ----------
 
 def main():
     st.title("Theme-Based Coder")
@@ -177,22 +168,65 @@ def main():
     # Step 2. Upload Theme Book CSV
     theme_file = st.file_uploader("Upload your Theme Book CSV (with columns: Theme, Definition)")
     if theme_file is not None:
-        df_themebook = pd.read_csv(theme_file)
+        df_themebook = read_uploaded_csv(theme_file)
         st.write("### Theme Book Preview")
         st.dataframe(df_themebook, use_container_width=True)
 
         # Step 3. Upload Data CSV
         data_file = st.file_uploader("Upload the CSV data you want to theme-code")
         if data_file is not None:
-            df_data = pd.read_csv(data_file)
+            df_data = read_uploaded_csv(data_file)
             st.write("### Uploaded Data (Preview)")
             st.dataframe(df_data, use_container_width=True)
 
+            config = display_engine_settings()
+            df_data = display_run_plan(df_data, df_themebook, config)
+            resume_run_id = display_run_selector()
+            view = st.radio(
+                "Output layout",
+                [MERGED_VIEW, PER_COLUMN_VIEW],
+                format_func={
+                    MERGED_VIEW: "One set of theme columns (present if any text column has the theme)",
+                    PER_COLUMN_VIEW: "Theme columns for each text column"
+                }.get
+            )
+
             # Step 4. Code the Data
             if st.button("Code Data"):
-                with st.spinner("Coding data..."):
-                    coded_df = theme_code_entire_dataframe(df_data, df_themebook, api_key)
-                st.success("Data coded successfully!")
+                config.run_id = resume_run_id or new_run_id(THEME_RUN_KIND)
+                st.caption(f"Run ID: {config.run_id}. If coding is interrupted, select it above to resume.")
+                progress_bar = st.progress(0.0, text="Coding data...")
+                coded_df, run = theme_code_entire_dataframe(
+                    df_data, df_themebook, api_key, config,
+                    on_progress=lambda done, total: progress_bar.progress(done / total, text=f"Coded {done}/{total} cells"),
+                    view=view
+                )
+                st.success(f"Data coded with {run.request_count} requests in {run.elapsed_seconds:.1f}s!")
+                if run.calls_saved:
+                    st.caption(f"{run.calls_saved} calls saved by skipping trivial and duplicate answers")
+                cache_stats = get_default_cache().stats()
+                st.caption(f"{run.cache_hits} responses reused from cache "
+                           f"(cache: {cache_stats['entries']} entries, {cache_stats['bytes'] / 1e6:.1f} MB)")
+                if run.failures:
+                    st.warning(f"{len(run.failures)} cells failed to code and were left as 0. "
+                               f"Resume run {config.run_id} to retry them.")
+                if run.resumed:
+                    st.caption(f"{run.resumed} answers restored from the run journal")
+                metrics = run.metrics_summary()
+                if metrics:
+                    st.caption(
+                        f"Per cell: {metrics['seconds_per_cell']:.2f}s request latency, "
+                        f"{metrics['prompt_tokens_per_cell']:.0f} prompt tokens, "
+                        f"{metrics['completion_tokens_per_cell']:.0f} completion tokens "
+                        f"({RESPONSE_MODES[config.response_mode].title.lower()})."
+                    )
+                rate_stats = run.rate_stats
+                if rate_stats:
+                    st.caption(
+                        f"Last minute: {rate_stats['requests_per_minute']} requests, "
+                        f"{rate_stats['tokens_per_minute']} tokens. {rate_stats['throttled']} throttled responses, "
+                        f"{rate_stats['retries']} retries, final concurrency {rate_stats['concurrency_limit']}."
+                    )
                 st.write("### Coded DataFrame")
                 st.dataframe(coded_df, use_container_width=True)
 
@@ -211,4 +245,5 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    with timed_rerun("Theme Encoder"):
+        main()
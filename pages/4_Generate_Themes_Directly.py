@@ -1,7 +1,17 @@
 import streamlit as st
 import pandas as pd
-from openai import OpenAI
 import json
+import time
+
+from app_resources import CONTENT_HASH_ATTR, get_openai_client, load_json_schema, read_uploaded_csv, timed_rerun
+from conversation_budget import DATA_MARKER, DEFAULT_HISTORY_TOKENS, build_data_digest, compact_conversation
+from llm_cache import stream_function_arguments
+from partial_json import PartialJsonParser
+from rate_limit_controller import resilient_create
+from theme_mapreduce import generate_theme_set as generate_theme_set_map_reduce, parse_theme_set
+from token_counting import get_token_counter
+
+THEME_SET_MODEL = 'gpt-4o'
 
 def app():
     """
@@ -59,7 +69,7 @@ def display_upload_container():
     """
     uploaded_file = st.file_uploader('Upload a new dataset')
     if uploaded_file is not None:
-        return pd.read_csv(uploaded_file)
+        return read_uploaded_csv(uploaded_file)
     return None
 
 def display_theme_set_container(survey_data):
@@ -70,17 +80,30 @@ def display_theme_set_container(survey_data):
     """
     st.write('## Generate a theme set')
     st.write('and/or direct edit below')
+    update_data_digest(survey_data)
+    # Streamed codes are shown here until the editable table replaces them.
+    table_placeholder = st.empty()
 
     chat_input = ''
     with st.session_state["input_container"]:
         chat_input = st.chat_input('Ask for modifications to the theme set')
         if chat_input:
-            codes = handle_user_input(chat_input, survey_data)
+            codes = handle_user_input(chat_input, survey_data, table_placeholder)
 
     with st.session_state["chat_container"]:
         display_chat_messages()
 
-    display_theme_set_table(survey_data)
+    display_theme_set_table(survey_data, table_placeholder)
+
+def update_data_digest(survey_data: pd.DataFrame):
+    """
+    Keeps a digest of the survey data in session_state, rebuilt only when the data changes.
+    It stands in for the raw data in the conversation sent to the model.
+    """
+    data_hash = survey_data.attrs.get(CONTENT_HASH_ATTR) or int(pd.util.hash_pandas_object(survey_data).sum())
+    if st.session_state.get("data_digest_hash") != data_hash:
+        st.session_state["data_digest"] = build_data_digest(survey_data)
+        st.session_state["data_digest_hash"] = data_hash
 
 def display_chat_messages():
     """
@@ -100,12 +123,13 @@ def display_chat_messages():
             st.chat_message("assistant").write(message["content"])
         i += 1
 
-def display_theme_set_table(survey_data: pd.DataFrame):
+def display_theme_set_table(survey_data: pd.DataFrame, table_placeholder):
     """
     Renders and edits the theme set (codes) in a Streamlit data editor.
     If the theme set doesn't exist yet, it generates an initial one.
     Args:
         survey_data (pd.DataFrame): The survey data for generating the initial theme set.
+        table_placeholder: The st.empty slot the editor is rendered in.
     """
     theme_set_df = st.session_state['theme_set']
 
@@ -114,7 +138,7 @@ def display_theme_set_table(survey_data: pd.DataFrame):
             theme_set_df = generate_initial_theme_set(survey_data)
             st.session_state['theme_set'] = theme_set_df
 
-    st.session_state['theme_set'] = st.data_editor(
+    st.session_state['theme_set'] = table_placeholder.data_editor(
         data=theme_set_df,
         use_container_width=True,
         num_rows="dynamic"
@@ -122,37 +146,62 @@ def display_theme_set_table(survey_data: pd.DataFrame):
 
 def generate_initial_theme_set(survey_data):
     """
-    Generates the initial theme set by prompting the OpenAI API with a default input.
+    Generates the initial theme set by prompting the OpenAI API with a default input,
+    map-reducing over the data (see theme_mapreduce).
     Args:
         survey_data (pd.DataFrame): The survey data to be passed to the model.
     Returns:
         pd.DataFrame: Generated DataFrame of codes (the theme set).
     """
     initial_user_input = 'Generate an initial theme set'
-    codes, assistant_message = generate_theme_set(initial_user_input, survey_data)
+    # The data can be larger than one prompt, so themes are proposed chunk by chunk and merged.
+    result = generate_theme_set_map_reduce(survey_data, st.session_state['api_key'], initial_user_input)
+    st.caption(f"Themes proposed from {result.chunk_count} chunks of the data "
+               f"and merged in {result.reduce_levels} rounds ({result.request_count} requests).")
+    if result.failures:
+        st.warning(f"{len(result.failures)} of {result.chunk_count} chunks failed and were left out of the themes: "
+                   f"{next(iter(result.failures.values()))}")
+    if result.reduce_failures:
+        st.warning(f"{result.reduce_failures} merge requests failed; their themes were merged locally instead.")
+    codes, assistant_message = result.codes, result.message
+    # Keeps the conversation in step with the theme set; the first user message is not displayed.
+    # The digest stands in for the data the themes were proposed from.
+    add_message(f"{initial_user_input}\n\n{DATA_MARKER}\n\n{st.session_state['data_digest']}", 'user')
     if assistant_message:
         st.session_state["messages"].append({"role": "assistant", "content": assistant_message})
         st.chat_message("assistant").write(assistant_message)
     st.write(codes)
     return generate_theme_set_df(codes)
 
-def handle_user_input(chat_input, survey_data):
+def handle_user_input(chat_input, survey_data, table_placeholder):
     """
     Handles user input for editing the theme set. Calls the OpenAI API to get new codes,
     updates the theme set, and displays any message from the assistant.
+    Codes and the message are shown as they stream in.
     Args:
         chat_input (str): The user's message regarding the theme set.
         survey_data (pd.DataFrame): The survey data for context.
+        table_placeholder: The st.empty slot of the theme set table.
     Returns:
         pd.DataFrame: The updated codes from the model.
     """
     st.write("DEBUG: Called handle_user_input")
     # with st.session_state['chat_container']:
         # st.chat_message("user").markdown(chat_input)
+    with st.session_state['chat_container']:
+        message_placeholder = st.empty()
+
+    def show_partial(codes, message):
+        if codes:
+            table_placeholder.dataframe(generate_theme_set_df(codes), use_container_width=True)
+        if message:
+            message_placeholder.chat_message("assistant").write(message)
 
     with st.status("Editing theme set"):
-        codes, assistant_message = generate_theme_set(chat_input, survey_data)
+        codes, assistant_message = generate_theme_set(chat_input, survey_data, show_partial)
         st.session_state['theme_set'] = generate_theme_set_df(codes)
+    # The finished message is rendered with the rest of the chat history.
+    message_placeholder.empty()
 
     if assistant_message:
         # with st.session_state["chat_container"]:
@@ -186,21 +235,21 @@ def generate_theme_set_df(codes):
         columns=['Codes', 'Description', 'Use']
     )
 
-def generate_theme_set(user_input, survey_data):
+def generate_theme_set(user_input, survey_data, on_partial=None):
     """
     Sends a prompt to OpenAI to generate or modify the theme set codes. 
     Parses the JSON response for codes and an optional message from the assistant.
     Args:
         user_input (str): The prompt or instruction from the user.
         survey_data (pd.DataFrame): The data used for context in generating themes.
+        on_partial (callable, optional): Called with (codes, message) as the response streams in.
     Returns:
         (list, str): A tuple where the first element is a list of codes 
                      and the second is a message from the assistant (if any).
     """
     st.write("DEBUG: Called generate_theme_set")
     prompt = merge_context(user_input, survey_data)
-    theme_set_response = get_theme_set_response(prompt)
-    theme_set_data = json.loads(theme_set_response.choices[0].message.tool_calls[0].function.arguments)
+    theme_set_data = json.loads(get_theme_set_response(prompt, on_partial))
     codes = theme_set_data["codes"]
     message = theme_set_data["message"]
     return codes, message
@@ -220,32 +269,72 @@ def merge_context(user_input, survey_data):
         theme_set_csv = st.session_state['theme_set'].to_csv(index=False)
         return f"{user_input}\nThis is the current theme_set:\n{theme_set_csv}"
 
-def get_theme_set_response(prompt):
+def get_theme_set_response(prompt, on_partial=None):
     """
     Calls the OpenAI API to generate a theme set based on the given prompt.
     Expects to find a JSON schema for the function call in 'analyse_themes_from_data.json'.
+    The conversation is compacted to a token budget (see conversation_budget).
+    Identical conversations are answered from the shared response cache, and
+    rate limits and transient errors are retried with backoff.
+    The response is streamed; on_partial receives the complete codes and the
+    message so far whenever they change.
     Args:
         prompt (str): The user prompt or merged context to send to OpenAI.
+        on_partial (callable, optional): Called with (codes, message) while streaming.
     Returns:
-        openai.openai_object.OpenAIObject: The raw response from the OpenAI API.
+        str: The JSON arguments of the model's function call.
     """
-    client = OpenAI(api_key=st.session_state['api_key'])
+    client = get_openai_client(st.session_state['api_key'])
     add_message(prompt, 'user')
-    messages = get_messages()
+    # The full history stays in session_state for display; only a compacted copy is sent.
+    compacted = compact_conversation(get_messages(), st.session_state.get("data_digest"),
+                                     DEFAULT_HISTORY_TOKENS, get_token_counter(THEME_SET_MODEL))
+    messages = compacted.messages
 
     # Load the function call schema for the GPT model
-    function_call_schema = json.load(open('analyse_themes_from_data.json'))
-    return client.chat.completions.create(
-        model='gpt-4o',
-        messages=messages,
-        tools=[
+    function_call_schema = load_json_schema('analyse_themes_from_data.json')
+    request = {
+        "model": THEME_SET_MODEL,
+        "messages": messages,
+        "tools": [
             {
                 "type": "function",
                 "function": function_call_schema
             }
         ],
-        tool_choice={"type": "function", "function": {"name": "analyse_themes_from_data"}}
-    )
+        "tool_choice": {"type": "function", "function": {"name": "analyse_themes_from_data"}}
+    }
+    started = time.monotonic()
+    first_result_seconds = None
+    parser = PartialJsonParser()
+    shown = None
+    for delta in stream_function_arguments(resilient_create(client), request, validate=parse_theme_set):
+        partial = parser.feed(delta)
+        if not isinstance(partial, dict):
+            continue
+        codes = [code for code in partial.get("codes", []) if isinstance(code, str)]
+        if parser.open_array_item():
+            codes = codes[:-1]  # the last code is still arriving
+        # Like parse_theme_set, so the streamed list matches the final one.
+        codes = [code.strip() for code in codes if code.strip()]
+        current = (codes, partial.get("message", ""))
+        if current != shown and (current[0] or current[1]):
+            if first_result_seconds is None:
+                first_result_seconds = time.monotonic() - started
+            shown = current
+            if on_partial:
+                on_partial(*current)
+    total_seconds = time.monotonic() - started
+
+    st.session_state.setdefault("turn_stats", []).append({
+        "prompt_tokens": compacted.tokens,
+        "first_result_seconds": first_result_seconds or total_seconds,
+        "total_seconds": total_seconds
+    })
+    st.caption(f"Sent {compacted.tokens} prompt tokens"
+               + (f" ({compacted.summarized_messages} earlier messages summarized)" if compacted.summarized_messages else "")
+               + f"; first result after {first_result_seconds or total_seconds:.1f}s, complete after {total_seconds:.1f}s.")
+    return parser.text
 
 def add_message(content, role):
     """
@@ -281,4 +370,5 @@ def get_trimmed_messages():
     return trimmed_messages
 
 # Run the app
-app()
+with timed_rerun("Generate Themes Directly"):
+    app()
@@ -2,6 +2,8 @@ import streamlit as st
 import pandas as pd
 from io import StringIO
 
+from app_resources import read_uploaded_csv, timed_rerun
+
 def compare_gold_vs_test(generated_df: pd.DataFrame, test_df: pd.DataFrame) -> pd.DataFrame:
     """
     1. Take the first column of the gold_df (the 'text' column).
@@ -79,8 +81,8 @@ def main():
         return
 
     # Read them as DataFrames
-    gold_df = pd.read_csv(gold_file)
-    test_df = pd.read_csv(test_file)
+    gold_df = read_uploaded_csv(gold_file)
+    test_df = read_uploaded_csv(test_file)
     # Show the user a preview
     st.write("### Generated CSV (Preview)")
     st.dataframe(gold_df, use_container_width=True)
@@ -109,4 +111,5 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    with timed_rerun("Theme Comparer"):
+        main()
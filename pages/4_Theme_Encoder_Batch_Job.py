@@ -1,88 +1,35 @@
 import streamlit as st
 import pandas as pd
-import json
-from io import StringIO
 import os
+from openai import DEFAULT_MAX_RETRIES
+from typing import Iterator, Union
+
+from app_resources import get_openai_client, read_uploaded_csv, timed_rerun
+from answer_preprocessing import DEFAULT_TRIVIAL_PATTERNS, plan_dispatch
+from batch_jsonl import (DEFAULT_MAX_SHARD_BYTES, DEFAULT_MAX_SHARD_LINES, GZIP_SUFFIX, MANIFEST_NAME, iter_jsonl,
+                         load_manifest, new_shard_dir, write_jsonl_shards)
+from batch_orchestrator import RESULTS_DIR, BatchOrchestrator, OpenAIBatchBackend
+from survey_cells import iter_text_cells
+from theme_coding_engine import EngineConfig
+from run_planner import BATCH_ROUTE, estimate_strategies, estimates_to_dataframe, measure_run, route_run
+from response_modes import FULL_MODE, RESPONSE_MODES, get_response_mode
+from theme_packing import pack_cells
+from themebook import CompiledThemebook, compile_themebook
 
 # ---------- 1. Define functions to prepare jobs for batch processing ----------
 
 def prepare_theme_job(
     text: str, 
-    themebook: pd.DataFrame, 
+    themebook: Union[pd.DataFrame, CompiledThemebook], 
     model_name: str = "gpt-4o-mini",
-    task_id: str = "task-0"
+    task_id: str = "task-0",
+    response_mode: str = FULL_MODE
 ):
     """
     Creates a chat completion job for theme identification without executing it.
     Returns a JSON representation of the job in the required format for batch processing.
     """
-    # Define the function schema (same as original)
-    function_schema = {
-        "name": "extract_themes_from_text",
-        "description": "Given a text, identify whether each theme in the theme book applies. Return 0 or 1, plus a justification.",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "themes": {
-                    "type": "array",
-                    "items": {
-                        "type": "object",
-                        "properties": {
-                            "label": {
-                                "type": "string", 
-                                "description": "The theme label from the theme book."
-                            },
-                            "value": {
-                                "type": "integer", 
-                                "description": "1 if theme is present, 0 if not."
-                            },
-                            "justification": {
-                                "type": "string", 
-                                "description": "A brief explanation of why the theme was assigned 0 or 1."
-                            }
-                        },
-                        "required": ["label", "value", "justification"]
-                    }
-                }
-            },
-            "required": ["themes"]
-        }
-    }
-
-    # Build a user-friendly message enumerating the themes and definitions
-    theme_lines = []
-    for _, row in themebook.iterrows():
-        theme_label = str(row["theme"])
-        theme_def = str(row["definition"])
-        theme_lines.append(f"- {theme_label}: {theme_def}")
-    themes_str = "\n".join(theme_lines)
-
-    user_message = f"""
-Text to analyze:
-{text}
-
-You have a theme book containing:
-{themes_str}
-
-Return JSON in this structure:
-{{
-  "themes": [
-    {{
-      "label": "<ThemeLabel>",
-      "value": 0 or 1,
-      "justification": "Short reason"
-    }},
-    ...
-  ]
-}}
-Make sure to include each theme from the theme book exactly once.
-"""
-
-    # Prepare the messages for GPT
-    messages = [
-        {"role": "system", "content": "You are a helpful theme identification assistant."},
-        {"role": "user", "content": user_message}
-    ]
+    prompt = compile_themebook(themebook).prompt(response_mode)
 
     # Create the job request format in the required format
     job_request = {
@@ -91,63 +38,160 @@ Make sure to include each theme from the theme book exactly once.
         "url": "/chat/completions",
         "body": {
             "model": model_name,
-            "messages": messages,
-            "tools": [
-                {
-                    "type": "function",
-                    "function": function_schema
-                }
-            ],
-            "tool_choice": {"type": "function", "function": {"name": "extract_themes_from_text"}}
+            "messages": prompt.messages(text),
+            "tools": prompt.tools,
+            "tool_choice": prompt.tool_choice
         }
     }
     
     return job_request
 
 
+def prepare_packed_theme_job(
+    cells: list,
+    themebook: Union[pd.DataFrame, CompiledThemebook],
+    model_name: str = "gpt-4o-mini",
+    task_id: str = "pack-0",
+    response_mode: str = FULL_MODE
+):
+    """
+    Creates one chat completion job that codes several cells at once.
+    cells is a list of (cell_id, text); the response holds one result per cell_id.
+    """
+    prompt = compile_themebook(themebook).prompt(response_mode, packed=True)
+    return {
+        "custom_id": task_id,
+        "method": "POST",
+        "url": "/chat/completions",
+        "body": {
+            "model": model_name,
+            "messages": prompt.packed_messages(cells),
+            "tools": prompt.tools,
+            "tool_choice": prompt.tool_choice
+        }
+    }
+
+
+def iter_packed_jobs_for_dataframe(
+    df: pd.DataFrame,
+    themebook: pd.DataFrame,
+    model_name: str = "gpt-4o-mini",
+    pack_size: int = 10,
+    trivial_patterns: list = DEFAULT_TRIVIAL_PATTERNS,
+    response_mode: str = FULL_MODE
+) -> Iterator[dict]:
+    """
+    Yields batch jobs that each code up to pack_size unique answers.
+    Each job's metadata lists the cell id, row and column of every cell it covers;
+    duplicate answers share a cell id.
+    """
+    compiled = compile_themebook(themebook)
+    cells = list(iter_text_cells(df, compiled.labels))
+    plan = plan_dispatch([text for _, _, text in cells], trivial_patterns)
+    mode = get_response_mode(response_mode)
+    packs = pack_cells([(str(u), text) for u, text in enumerate(plan.unique_texts)],
+                       compiled.prompt(mode.name, packed=True).token_count, len(compiled.labels),
+                       model_name, pack_size, mode)
+
+    for pack_idx, pack in enumerate(packs):
+        job = prepare_packed_theme_job(pack, compiled, model_name, f"pack{pack_idx}", response_mode)
+        job["metadata"] = {
+            "response_mode": response_mode,
+            "cells": [
+                {"cell_id": cell_id, "row_idx": cells[cell_idx][0], "col_name": cells[cell_idx][1]}
+                for cell_id, _ in pack
+                for cell_idx in plan.cells_by_unique[int(cell_id)]
+            ]
+        }
+        yield job
+
+
+def iter_jobs_for_dataframe(
+    df: pd.DataFrame,
+    themebook: pd.DataFrame,
+    model_name: str = "gpt-4o-mini",
+    pack_size: int = 1,
+    trivial_patterns: list = DEFAULT_TRIVIAL_PATTERNS,
+    response_mode: str = FULL_MODE
+) -> Iterator[dict]:
+    """
+    Yields one theme coding job per unique non-trivial answer in df, building each job only when it is consumed.
+    Trivial answers ("nan", "N/A", ...) get no job and should be coded as all zeros;
+    cells repeating an earlier answer are listed in that job's metadata["duplicates"].
+    With pack_size > 1, answers are packed into shared jobs instead.
+    response_mode selects the output format (see response_modes) and is stored in each job's metadata.
+    """
+    if pack_size > 1:
+        yield from iter_packed_jobs_for_dataframe(df, themebook, model_name, pack_size, trivial_patterns, response_mode)
+        return
+
+    compiled = compile_themebook(themebook)
+    cells = list(iter_text_cells(df, compiled.labels))
+    plan = plan_dispatch([text for _, _, text in cells], trivial_patterns)
+
+    for unique_idx, cell_value in enumerate(plan.unique_texts):
+        first_cell, *duplicate_cells = plan.cells_by_unique[unique_idx]
+        row_idx, col_name, _ = cells[first_cell]
+        # Create task ID with the row and column information
+        task_id = f"row{row_idx}-col{col_name}"
+        job = prepare_theme_job(cell_value, compiled, model_name, task_id, response_mode)
+        job["metadata"] = {
+            "row_idx": row_idx,
+            "col_name": col_name,
+            "response_mode": response_mode
+        }
+        if duplicate_cells:
+            job["metadata"]["duplicates"] = [
+                {"row_idx": cells[i][0], "col_name": cells[i][1]} for i in duplicate_cells
+            ]
+        yield job
+
+
 def prepare_jobs_for_dataframe(
-    df: pd.DataFrame, 
-    themebook: pd.DataFrame, 
-    model_name: str = "gpt-4o-mini"
+    df: pd.DataFrame,
+    themebook: pd.DataFrame,
+    model_name: str = "gpt-4o-mini",
+    pack_size: int = 1,
+    trivial_patterns: list = DEFAULT_TRIVIAL_PATTERNS,
+    response_mode: str = FULL_MODE
 ) -> list:
     """
-    For each text cell in df, prepares a theme coding job for batch processing.
-    Returns a list of jobs with the required format for batch processing.
+    Returns the jobs of iter_jobs_for_dataframe as a list with the required format for batch processing.
+    Prefer iter_jobs_for_dataframe with write_jsonl for large datasets.
     """
-    jobs = []
-    
-    # Get the unique themes from the themebook
-    theme_labels = themebook["theme"].tolist()
-    
-    # For each row/col in the original data, prepare a theme coding job
-    job_count = 0
-    for row_idx in range(len(df)):
-        for col_name in df.columns:
-            # We only code original columns. (Exclude columns that match theme names or justifications)
-            if col_name in theme_labels or col_name.endswith("_justification"):
-                continue
-
-            cell_value = str(df.iat[row_idx, df.columns.get_loc(col_name)])
-            if not cell_value.strip():
-                # Skip empty cells
-                continue
-
-            # Create task ID with the job number, row and column information
-            task_id = f"row{row_idx}-col{col_name}"
-            job_count += 1
-            
-            # Prepare the job for this cell
-            job = prepare_theme_job(cell_value, themebook, model_name, task_id)
-            
-            # Store metadata in the custom_id field
-            job["metadata"] = {
-                "row_idx": row_idx,
-                "col_name": col_name
-            }
-            
-            jobs.append(job)
-    
-    return jobs
+    return list(iter_jobs_for_dataframe(df, themebook, model_name, pack_size, trivial_patterns, response_mode))
+
+
+# ---------- 2. Submit the batch jobs ----------
+
+def display_batch_submission(shard_dir: str):
+    """
+    Submits the shards in shard_dir to the Batch API and waits for their results.
+    Progress is saved in the shard folder, so clicking the button again resumes an interrupted run.
+    """
+    st.write("### Submit Batches")
+    api_key = st.text_input("Enter your OpenAI API Key", type="password")
+    base_url = st.text_input("API base URL (optional)", help="Leave empty for OpenAI.")
+    cols = st.columns(2)
+    max_active = cols[0].number_input("Batches in flight", min_value=1, max_value=50, value=4)
+    max_attempts = cols[1].number_input("Attempts per job", min_value=1, max_value=10, value=3,
+                                        help="Failed jobs are collected into a retry file and resubmitted.")
+    if st.button("Submit and wait for results", disabled=not api_key):
+        client = get_openai_client(api_key, base_url or None, max_retries=DEFAULT_MAX_RETRIES)
+        orchestrator = BatchOrchestrator(OpenAIBatchBackend(client), shard_dir, int(max_active), int(max_attempts),
+                                         on_event=st.write)
+        with st.spinner("Waiting for batches to complete..."):
+            try:
+                orchestrator.run()
+            except ValueError as exc:
+                st.error(str(exc))
+                return
+        summary = orchestrator.summary()
+        st.success(f"All {summary['shards']} batches finished. "
+                   f"Results are in {os.path.abspath(os.path.join(shard_dir, RESULTS_DIR))}; "
+                   f"open the Theme Encoder Batch Results page with that folder to code your data.")
+        if summary["failed_jobs"]:
+            st.warning(f"{summary['failed_jobs']} jobs or packed cells still failed after {int(max_attempts)} attempts.")
 
 
 # ---------- 3. Define the main Streamlit app ----------
@@ -156,7 +200,7 @@ def main():
     st.title("Theme Encoder Batch Job Creator")
     st.write("""
     This tool prepares LLM jobs for theme encoding that can be run in batch mode.
-    It will generate a JSONL file with all the jobs but won't execute them.
+    It will generate JSONL files with all the jobs, which you can download or submit to the Batch API from here.
     """)
 
     # Step 1. Model Selection
@@ -169,14 +213,14 @@ def main():
     # Step 2. Upload Theme Book CSV
     theme_file = st.file_uploader("Upload your Theme Book CSV (with columns: Theme, Definition)")
     if theme_file is not None:
-        df_themebook = pd.read_csv(theme_file)
+        df_themebook = read_uploaded_csv(theme_file)
         st.write("### Theme Book Preview")
         st.dataframe(df_themebook, use_container_width=True)
 
         # Step 3. Upload Data CSV
         data_file = st.file_uploader("Upload the CSV data you want to theme-code")
         if data_file is not None:
-            df_data = pd.read_csv(data_file)
+            df_data = read_uploaded_csv(data_file)
             st.write("### Uploaded Data (Preview)")
             st.dataframe(df_data.head(), use_container_width=True)
             
@@ -186,44 +230,93 @@ def main():
             total_cells = num_rows * num_cols
             
             st.write(f"Your dataset has {num_rows} rows and {num_cols} columns, for a total of {total_cells} cells.")
-            st.write("Note: Only non-empty text cells will be processed.")
+            cell_texts = [text for _, _, text in iter_text_cells(df_data, compile_themebook(df_themebook).labels)]
+            plan = plan_dispatch(cell_texts)
+            st.write(f"{len(cell_texts)} non-empty text cells need {len(plan.unique_texts)} jobs: "
+                     f"{plan.trivial_count} trivial answers (e.g. 'N/A', 'nan') are coded as all zeros and "
+                     f"{plan.duplicate_count} duplicate answers reuse another cell's job, saving {plan.calls_saved} calls.")
+
+            pack_size = st.number_input(
+                "Cells per job (1 = one job per cell)", min_value=1, max_value=100, value=1,
+                help="Packed jobs send the theme book once for several cells. Their metadata lists the packed cells."
+            )
+
+            response_mode = st.selectbox(
+                "Model output",
+                list(RESPONSE_MODES),
+                format_func=lambda name: RESPONSE_MODES[name].title,
+                help="Sparse outputs list only the present themes, cutting completion tokens."
+            )
+
+            with st.expander("Estimate tokens, cost and time"):
+                cols = st.columns(2)
+                deadline_hours = cols[0].number_input("Deadline in hours (0 = none)", min_value=0.0, value=0.0)
+                max_cost_usd = cols[1].number_input("Cost ceiling in USD (0 = none)", min_value=0.0, value=0.0)
+                if st.button("Estimate run"):
+                    shape = measure_run(df_data, df_themebook, model_name, response_mode, int(pack_size))
+                    # Batch jobs are not rate limited client-side; the sync rows assume the engine defaults.
+                    estimates = estimate_strategies(shape, model_name, EngineConfig.max_concurrency,
+                                                    EngineConfig.requests_per_minute, EngineConfig.tokens_per_minute)
+                    st.dataframe(estimates_to_dataframe(estimates), use_container_width=True)
+                    decision = route_run(estimates, pack_size > 1, deadline_hours * 60 or None, max_cost_usd or None)
+                    st.info(f"Recommended route: {decision.route}. {decision.reason} "
+                            f"Predicted ${decision.cost_usd:.4f}, all results in {decision.minutes:.1f} min.")
+                    if decision.route != BATCH_ROUTE:
+                        st.caption("Use the Theme Encoder page to code the sync share; "
+                                   "it can export the remaining rows for batch.")
+
+            compress = st.checkbox("Compress with gzip (.jsonl.gz)",
+                                   help="Most batch APIs need plain JSONL; compress for storage or transfer.")
+            limit_cols = st.columns(2)
+            max_lines = limit_cols[0].number_input("Max jobs per file", min_value=1, value=DEFAULT_MAX_SHARD_LINES,
+                                                   help="Batch endpoints cap the number of requests in one file.")
+            max_megabytes = limit_cols[1].number_input("Max file size (MB)", min_value=1,
+                                                       value=DEFAULT_MAX_SHARD_BYTES // (1024 * 1024),
+                                                       help="Limit on the uncompressed size of each file.")
 
             # Step 4. Prepare the Batch Jobs
             if st.button("Generate Batch Jobs"):
+                # Jobs are streamed straight to disk, so memory use does not grow with the dataset.
+                shard_dir = new_shard_dir("theme_coding_jobs")
                 with st.spinner("Preparing batch jobs..."):
-                    jobs = prepare_jobs_for_dataframe(df_data, df_themebook, model_name)
-                
-                st.success(f"Successfully prepared {len(jobs)} theme coding jobs!")
-                
-                # Create the JSONL content
-                jsonl_content = StringIO()
-                for job in jobs:
-                    jsonl_content.write(json.dumps(job) + "\n")
-                
-                # Let user download the JSONL file
-                st.download_button(
-                    label="Download Batch Jobs (JSONL)",
-                    data=jsonl_content.getvalue(),
-                    file_name="theme_coding_jobs.jsonl",
-                    mime="application/jsonl"
-                )
-                
-                # Also save locally if desired
-                if st.checkbox("Save to local file"):
-                    local_path = "theme_coding_jobs.jsonl"
-                    with open(local_path, "w") as f:
-                        for job in jobs:
-                            f.write(json.dumps(job) + "\n")
-                    st.success(f"Saved batch jobs to {os.path.abspath(local_path)}")
-                
+                    write_jsonl_shards(
+                        iter_jobs_for_dataframe(df_data, df_themebook, model_name, int(pack_size),
+                                                response_mode=response_mode),
+                        shard_dir, compress, int(max_lines), int(max_megabytes) * 1024 * 1024
+                    )
+                st.session_state["batch_jobs_dir"] = shard_dir
+
+            shard_dir = st.session_state.get("batch_jobs_dir")
+            if shard_dir is not None:
+                manifest = load_manifest(shard_dir)
+                shards = manifest["shards"]
+                st.success(f"Successfully prepared {manifest['line_count']} theme coding jobs in {len(shards)} files!")
+                st.write(f"Saved batch jobs and {MANIFEST_NAME} to {os.path.abspath(shard_dir)}. "
+                         f"Each file can be submitted as its own batch, in parallel.")
+                st.dataframe(pd.DataFrame(shards), use_container_width=True)
+
+                # Let user download the JSONL files
+                for shard in shards:
+                    with open(os.path.join(shard_dir, shard["path"]), "rb") as f:
+                        st.download_button(
+                            label=f"Download {shard['path']} ({shard['line_count']} jobs)",
+                            data=f,
+                            file_name=shard["path"],
+                            mime="application/gzip" if shard["path"].endswith(GZIP_SUFFIX) else "application/jsonl",
+                            key=f"download-{shard['path']}"
+                        )
+                with open(os.path.join(shard_dir, MANIFEST_NAME), "rb") as f:
+                    st.download_button("Download manifest", data=f, file_name=MANIFEST_NAME, mime="application/json")
+
+                display_batch_submission(shard_dir)
+
                 # Display job summary
                 st.write("### Job Summary")
-                st.write(f"Total jobs prepared: {len(jobs)}")
-                if len(jobs) > 0:
-                    sample_job = jobs[0]
+                st.write(f"Total jobs prepared: {manifest['line_count']}")
+                if shards:
                     st.write("Sample job format:")
-                    st.json(sample_job)
-                    
+                    st.json(next(iter_jsonl(os.path.join(shard_dir, shards[0]["path"]))))
+
                     st.write("### Example of the batch job format:")
                     st.code('''
 {
@@ -246,7 +339,7 @@ def main():
                 # Instructions for processing
                 st.write("### Next Steps")
                 st.write("""
-                1. Download the JSONL file containing all jobs
+                1. Download the JSONL files containing all jobs
                 2. Process these jobs using your preferred batch processing system
                 3. Each job has a custom_id and metadata to help map results back to your original data
                 4. Use the task_id in the custom_id field to identify which responses belong to which cells
@@ -254,14 +347,14 @@ def main():
                 
                 st.write("### Processing Results")
                 st.write("""
-                When you get the results back, you'll need to:
-                1. Parse the function calls from each response
-                2. Extract the themes data
-                3. Use the metadata to map the themes back to the correct row and column in your dataset
+                When you get the results back, open the Theme Encoder Batch Results page and upload
+                the output JSONL with the same data, theme book and model output setting.
+                It maps every result back to its row and column and reports failed or missing jobs.
                 """)
     else:
         st.info("Please upload a Theme Book CSV to begin.")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    with timed_rerun("Theme Encoder Batch Job"):
+        main()
\ No newline at end of file
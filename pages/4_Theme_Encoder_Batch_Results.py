@@ -0,0 +1,92 @@
+import streamlit as st
+import pandas as pd
+import os
+
+from app_resources import read_uploaded_csv, timed_rerun
+from batch_jsonl import find_manifest_dir, iter_jsonl_sources, jsonl_files, verify_manifest
+from batch_results import ingest_batch_results
+from response_modes import RESPONSE_MODES
+from theme_results import MERGED_VIEW, PER_COLUMN_VIEW
+
+
+def main():
+    st.title("Theme Encoder Batch Results")
+    st.write("""
+    This tool maps the output of a batch job run back onto your data.
+    Upload the same theme book and data you built the batch jobs from, then the batch output JSONL of every shard.
+    """)
+
+    theme_file = st.file_uploader("Upload your Theme Book CSV (with columns: Theme, Definition)")
+    data_file = st.file_uploader("Upload the CSV data the batch jobs were built from")
+    if theme_file is None or data_file is None:
+        st.info("Please upload the Theme Book and data CSVs to begin.")
+        return
+    df_themebook = read_uploaded_csv(theme_file)
+    df_data = read_uploaded_csv(data_file)
+
+    output_files = st.file_uploader("Upload the batch output files (JSONL or JSONL.gz)", accept_multiple_files=True,
+                                    help="Upload the output of every shard together.")
+    output_path = st.text_input("...or enter the path of a local batch output file or folder",
+                                help="Large outputs can be read from disk instead of uploaded. "
+                                     "A folder is read as all of the JSONL files in it.")
+    response_mode = st.selectbox(
+        "Model output the jobs were built with",
+        list(RESPONSE_MODES),
+        format_func=lambda name: RESPONSE_MODES[name].title
+    )
+    view = st.radio(
+        "Output layout",
+        [MERGED_VIEW, PER_COLUMN_VIEW],
+        format_func={
+            MERGED_VIEW: "One set of theme columns (present if any text column has the theme)",
+            PER_COLUMN_VIEW: "Theme columns for each text column"
+        }.get
+    )
+
+    if output_path and not os.path.exists(output_path):
+        st.warning(f"{output_path} does not exist.")
+        return
+    sources = jsonl_files(output_path) if output_path else output_files
+    if not sources:
+        st.info("Please upload the batch output.")
+        return
+
+    if st.button("Ingest Results"):
+        manifest_dir = find_manifest_dir(output_path) if output_path else None
+        changed_shards = verify_manifest(manifest_dir) if manifest_dir else []
+        if changed_shards:
+            st.error(f"The batch job files in {manifest_dir} no longer match their manifest "
+                     f"({', '.join(changed_shards)}), so these results may not match your data. "
+                     f"Rebuild the batch jobs before ingesting.")
+            return
+        with st.spinner("Reading batch output..."):
+            coded_df, report = ingest_batch_results(df_data, df_themebook, iter_jsonl_sources(sources),
+                                                    response_mode, view=view)
+
+        st.success(f"Read {report.line_count} output lines from {len(sources)} files and coded {report.coded_answers} unique answers.")
+        if report.failed_ids:
+            st.warning(f"{len(report.failed_ids)} jobs failed or returned unreadable output: "
+                       f"{', '.join(report.failed_ids[:20])}")
+        if report.unknown_ids:
+            st.warning(f"{len(report.unknown_ids)} results match no job built from this data "
+                       f"(check the data, theme book and model output match the batch): "
+                       f"{', '.join(report.unknown_ids[:20])}")
+        if report.missing_cells:
+            st.warning(f"{len(report.missing_cells)} cells have no result and were left as 0. "
+                       f"Rerun their jobs to fill them in.")
+            st.dataframe(pd.DataFrame(report.missing_cells, columns=["row_idx", "col_name"]),
+                         use_container_width=True)
+
+        st.write("### Coded Data")
+        st.dataframe(coded_df, use_container_width=True)
+        st.download_button(
+            label="Download Coded CSV",
+            data=coded_df.to_csv(index=False),
+            file_name="theme_coded_data.csv",
+            mime="text/csv"
+        )
+
+
+if __name__ == "__main__":
+    with timed_rerun("Theme Encoder Batch Results"):
+        main()
@@ -0,0 +1,151 @@
+import streamlit as st
+import pandas as pd
+from typing import Optional
+
+from app_resources import CONTENT_HASH_ATTR, get_openai_client, read_uploaded_csv, timed_rerun
+from embedding_store import EmbeddingStore
+from embeddings import DEFAULT_EMBEDDING_MODEL, DEFAULT_HASH_DIM, Embedder, HashedTfidfEmbedder, OpenAIEmbedder
+from theme_clustering import (AGGLOMERATIVE_METHOD, DEFAULT_CLUSTERS, KMEANS_METHOD, cluster_themes, code_texts,
+                              label_responses, response_texts)
+
+RESPONSES_INPUT = "responses"
+CODES_INPUT = "codes"
+LOCAL_EMBEDDER = "local"
+OPENAI_EMBEDDER = "openai"
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def cached_response_texts(content_hash: str, _df: pd.DataFrame):
+    """
+    response_texts for an uploaded file, computed once per file content.
+    """
+    return response_texts(_df)
+
+
+def display_embedder_settings(api_key: str) -> Optional[Embedder]:
+    """
+    Renders the embedder choice and returns the embedder, or None if it needs a missing API key.
+    """
+    backend = st.radio(
+        "Embeddings",
+        [LOCAL_EMBEDDER, OPENAI_EMBEDDER],
+        format_func={
+            LOCAL_EMBEDDER: "Local hashed TF-IDF (offline, no API calls)",
+            OPENAI_EMBEDDER: "OpenAI embeddings"
+        }.get,
+        help="The local embedder matches shared words and phrases; OpenAI embeddings also match paraphrases."
+    )
+    if backend == OPENAI_EMBEDDER:
+        if not api_key:
+            st.warning("Please enter an API key to use OpenAI embeddings.")
+            return None
+        model_name = st.text_input("Embedding model", value=DEFAULT_EMBEDDING_MODEL)
+        return OpenAIEmbedder(get_openai_client(api_key), model_name)
+    dim = st.number_input("Vector size", min_value=64, max_value=4096, value=DEFAULT_HASH_DIM, step=64)
+    return HashedTfidfEmbedder(int(dim))
+
+
+def main():
+    st.title("Hybrid Themes: Embed and Cluster")
+    st.write("""
+    Groups similar responses, or the codes from the Generate Codebook page, and proposes one theme per group.
+    The proposed theme book can be edited and then applied with the Theme Encoder.
+    """)
+
+    api_key = st.text_input("Enter your OpenAI API Key (optional with local embeddings)", type="password")
+    source = st.radio(
+        "What to cluster",
+        [RESPONSES_INPUT, CODES_INPUT],
+        format_func={
+            RESPONSES_INPUT: "Survey responses",
+            CODES_INPUT: "Codes from a codebook CSV (columns: Code, Definition)"
+        }.get
+    )
+    uploaded_file = st.file_uploader("Upload the survey data CSV" if source == RESPONSES_INPUT else "Upload the codebook CSV")
+    if uploaded_file is None:
+        st.info("Please upload a CSV file.")
+        return
+    df = read_uploaded_csv(uploaded_file)
+    st.dataframe(df, use_container_width=True)
+
+    if source == RESPONSES_INPUT:
+        texts, cells, cell_to_text = cached_response_texts(df.attrs[CONTENT_HASH_ATTR], df)
+        st.caption(f"{len(texts)} distinct answers to cluster (trivial and duplicate answers are skipped).")
+    else:
+        texts = code_texts(df)
+    if not texts:
+        st.warning("There is nothing to cluster in this file.")
+        return
+
+    embedder = display_embedder_settings(api_key)
+    if embedder is None:
+        return
+    cols = st.columns(2)
+    n_clusters = cols[0].number_input("Number of themes", min_value=2, max_value=200, value=DEFAULT_CLUSTERS)
+    method = cols[1].radio(
+        "Clustering",
+        [KMEANS_METHOD, AGGLOMERATIVE_METHOD],
+        format_func={
+            KMEANS_METHOD: "k-means",
+            AGGLOMERATIVE_METHOD: "k-means, then merge similar clusters"
+        }.get
+    )
+    reuse_embeddings = st.checkbox("Reuse stored embeddings", value=True,
+                                   help="Vectors are kept on disk per embedder; only answers not seen before are embedded.")
+    name_with_model = st.checkbox("Name themes with the model", value=bool(api_key), disabled=not api_key,
+                                  help="Otherwise themes are named after their most distinctive terms.")
+
+    if st.button("Cluster"):
+        progress_bar = st.progress(0.0, text="Embedding...")
+        with st.spinner("Embedding and clustering..."):
+            if isinstance(embedder, HashedTfidfEmbedder):
+                # Fitted here rather than on every rerun; the IDF weights come from the texts being clustered.
+                embedder.fit(texts)
+            store = EmbeddingStore.for_embedder(embedder) if reuse_embeddings else None
+            run = cluster_themes(
+                texts, embedder, int(n_clusters), method,
+                client=get_openai_client(api_key) if name_with_model else None,
+                on_progress=lambda done, total: progress_bar.progress(done / total, text=f"Embedded {done}/{total}"),
+                store=store
+            )
+        throughput = run.throughput()
+        st.success(f"{len(texts)} texts grouped into {len(run.clusters_df)} themes.")
+        st.caption(f"Embedding: {run.embed_seconds:.1f}s ({throughput['embed']:,.0f} texts/s with {run.embedder_name}). "
+                   f"Clustering: {run.cluster_seconds:.1f}s ({throughput['cluster']:,.0f} texts/s). "
+                   f"Naming: {run.name_seconds:.1f}s.")
+        if store is not None:
+            st.caption(f"{store.hits} vectors reused from the embedding store, {store.misses} embedded "
+                       f"({len(store)} stored for {run.embedder_name}).")
+        if run.naming_failures:
+            st.warning(f"{len(run.naming_failures)} themes could not be named by the model "
+                       f"and are named after their terms.")
+
+        st.write("### Proposed Themes")
+        st.dataframe(run.clusters_df, use_container_width=True)
+        st.download_button(
+            label="Download Theme Book CSV",
+            data=run.themebook_df.to_csv(index=False),
+            file_name="themebook.csv",
+            mime="text/csv",
+            help="Upload this on the Theme Encoder page to code the data with these themes."
+        )
+        if source == RESPONSES_INPUT:
+            labeled_df = label_responses(df, run, cells, cell_to_text)
+            st.download_button(
+                label="Download Data with Proposed Themes CSV",
+                data=labeled_df.to_csv(index=False),
+                file_name="clustered_data.csv",
+                mime="text/csv"
+            )
+        else:
+            st.download_button(
+                label="Download Codebook with Themes CSV",
+                data=df.assign(Theme=run.clusters_df["Theme"].to_numpy()[run.labels]).to_csv(index=False),
+                file_name="codebook_themes.csv",
+                mime="text/csv"
+            )
+
+
+if __name__ == "__main__":
+    with timed_rerun("Embed and Cluster"):
+        main()
@@ -0,0 +1,73 @@
+"""
+Best-effort parsing of JSON that is still being streamed.
+
+Streamed tool-call arguments arrive a few characters at a time. PartialJsonParser
+keeps track of open strings, arrays and objects as text is fed in, so each
+snapshot is parsed by closing them rather than rescanning the text for its
+structure. A snapshot that still cannot be parsed (e.g. it ends inside a key or
+a number) keeps the last value that could.
+"""
+import json
+from typing import Any, List
+
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+class PartialJsonParser:
+
+    def __init__(self):
+        self.text = ""
+        self.value: Any = None
+        # Open containers ("{" or "["), innermost last.
+        self.stack: List[str] = []
+        # True while the text ends inside a string, e.g. a code label that is still arriving.
+        self.in_string = False
+        self._escaped = False
+
+    def _scan(self, delta: str):
+        for char in delta:
+            if self.in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in _CLOSERS:
+                self.stack.append(char)
+            elif char in "]}" and self.stack:
+                self.stack.pop()
+
+    def snapshot(self) -> str:
+        """
+        The text so far with its open string and containers closed.
+        """
+        text = self.text
+        if self.in_string:
+            # A dangling escape cannot be closed; drop it until the next delta completes it.
+            text = text[:-1] if self._escaped else text
+            text += '"'
+        text = text.rstrip()
+        if text.endswith(","):
+            text = text[:-1]
+        return text + "".join(_CLOSERS[opener] for opener in reversed(self.stack))
+
+    def feed(self, delta: str) -> Any:
+        """
+        Adds delta and returns the best parse of the text so far.
+        """
+        self.text += delta
+        self._scan(delta)
+        try:
+            self.value = json.loads(self.snapshot())
+        except json.JSONDecodeError:
+            pass
+        return self.value
+
+    def open_array_item(self) -> bool:
+        """
+        True while the last item of the innermost array is a string still being streamed.
+        """
+        return self.in_string and bool(self.stack) and self.stack[-1] == "["
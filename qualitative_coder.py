@@ -1,8 +1,8 @@
 from openai import OpenAI
 from dotenv import load_dotenv
-import pandas as pd
 import os
 import json
+from code_matrix import SparseCodeMatrix
 from data_ingester import ingest_survey_data
 
 
@@ -14,36 +14,21 @@ function_call_schema = json.load(open('function_call_schema.json'))
 client = OpenAI(api_key=api_key)
 
 def get_codes():
+    """
+    Codes every cell of the survey data. Returns the data and the codes as a sparse
+    (row, column, code) matrix instead of one dense column per code.
+    """
     df = ingest_survey_data()
-    
-    new_columns = pd.DataFrame(index=df.index)
-    
+
+    triplets = []
     for column in df.columns:
-        codes_per_column = get_column_codes(df[column])
-        
-        for code_name, binary_values in codes_per_column.items():
-            new_column_name = f"{code_name}_{column}" 
-            new_columns[new_column_name] = binary_values
-    
-    df_with_codes = pd.concat([df, new_columns], axis=1)
-    return df_with_codes
+        for row_idx, data in enumerate(df[column]):
+            # codes maps every code to true or false; only the present ones are kept.
+            for code, present in get_code(data).items():
+                if present:
+                    triplets.append((row_idx, column, code))
 
-def get_column_codes(column):
-    codes_dict = {}
-    
-    for data in column:
-        row_codes = get_code(data)
-        
-        for code in row_codes:
-            if code not in codes_dict:
-                codes_dict[code] = []
-            codes_dict[code].append(1)
-    
-    for code in codes_dict.keys():
-        while len(codes_dict[code]) < len(column):
-            codes_dict[code].append(0)
-    
-    return codes_dict
+    return df, SparseCodeMatrix.from_triplets(triplets, len(df))
 
 def get_code(text):
     response = client.chat.completions.create(
@@ -63,10 +48,10 @@ def get_code(text):
         tool_choice={"type": "function", "function": {"name": "add_qualitative_data_codes"}}
     )
 
-    # Extract and return the list of codes
-    return response.choices[0].message.tool_calls[0].function.arguments["codes"]
+    # Extract and return the {code: present} object
+    return json.loads(response.choices[0].message.tool_calls[0].function.arguments)["codes"]
 
 # Example usage
-df_with_codes = get_codes()
-df_with_codes.to_csv("survey_data/survey_data_with_codes.csv", index=False)
-print(df_with_codes)
+df, code_matrix = get_codes()
+code_matrix.to_parquet("survey_data/survey_data_codes.parquet")
+print(code_matrix.to_long(df))
@@ -0,0 +1,311 @@
+"""
+Adaptive rate-limit controller shared by every OpenAI call site.
+
+- Retries 429s, transient 5xx errors and connection failures with jittered
+  exponential backoff, honouring Retry-After when the server sends it.
+- Reads the x-ratelimit-* response headers and pauses new requests until the
+  window resets once the account's remaining requests or tokens run out.
+- Adjusts concurrency with AIMD: +1 slot per window of successful requests,
+  halved on throttling.
+- Tracks the achieved requests and tokens per minute.
+"""
+import asyncio
+import random
+import re
+import threading
+import time
+from collections import deque
+from typing import Callable, Mapping, Optional, Tuple
+
+import openai
+
+RATE_WINDOW_SECONDS = 60.0
+# Throttles this close together are treated as one congestion event.
+DECREASE_COOLDOWN_SECONDS = 2.0
+# How often a waiting caller rechecks for a free slot released by the other (sync or async) side.
+SLOT_POLL_SECONDS = 0.05
+THROTTLE_STATUS_CODES = {429, 503}
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """
+    Parses OpenAI reset durations such as "20ms", "1.5s" or "6m0s" into seconds.
+    """
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def parse_retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    return parse_reset_duration(headers.get("retry-after"))
+
+
+def is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, openai.APIConnectionError):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code in RETRYABLE_STATUS_CODES
+
+
+def _error_headers(exc: Exception) -> Optional[Mapping[str, str]]:
+    response = getattr(exc, "response", None)
+    return getattr(response, "headers", None)
+
+
+class AdaptiveRateController:
+    """
+    Concurrency gate plus throttling feedback. The synchronous and asyncio
+    entry points share state, so one controller can serve both kinds of caller:
+    both wait out pauses and count against the same concurrency limit.
+    """
+
+    def __init__(
+        self,
+        initial_concurrency: int = 8,
+        min_concurrency: int = 1,
+        max_concurrency: int = 64,
+        max_retries: int = 6,
+        base_delay: float = 0.5,
+        max_delay: float = 60.0,
+        decrease_factor: float = 0.5
+    ):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.decrease_factor = decrease_factor
+        self.throttle_count = 0
+        self.retry_count = 0
+        self._limit = float(min(max(initial_concurrency, min_concurrency), max_concurrency))
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._completions = deque()  # (timestamp, total tokens)
+        self._lock = threading.Lock()
+        # Wakes synchronous callers when a slot frees up; shares _lock with the feedback methods.
+        self._sync_condition = threading.Condition(self._lock)
+        self._condition: Optional[asyncio.Condition] = None
+        self._condition_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def concurrency_limit(self) -> int:
+        return int(self._limit)
+
+    # ----- feedback -----
+
+    def on_success(self, headers: Optional[Mapping[str, str]], total_tokens: int = 0):
+        now = time.monotonic()
+        with self._lock:
+            self._limit = min(self.max_concurrency, self._limit + 1 / self._limit)
+            self._completions.append((now, total_tokens))
+            self._pause_for_exhausted_window(headers, now)
+
+    def on_throttle(self, headers: Optional[Mapping[str, str]]):
+        now = time.monotonic()
+        with self._lock:
+            self.throttle_count += 1
+            if now - self._last_decrease >= DECREASE_COOLDOWN_SECONDS:
+                self._limit = max(self.min_concurrency, self._limit * self.decrease_factor)
+                self._last_decrease = now
+            retry_after = parse_retry_after(headers)
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+
+    def _pause_for_exhausted_window(self, headers: Optional[Mapping[str, str]], now: float):
+        if not headers:
+            return
+        for remaining_header, reset_header in (
+            ("x-ratelimit-remaining-requests", "x-ratelimit-reset-requests"),
+            ("x-ratelimit-remaining-tokens", "x-ratelimit-reset-tokens"),
+        ):
+            remaining = headers.get(remaining_header)
+            reset = parse_reset_duration(headers.get(reset_header))
+            if remaining is not None and reset and remaining.strip() == "0":
+                self._paused_until = max(self._paused_until, now + reset)
+
+    def backoff_delay(self, attempt: int, headers: Optional[Mapping[str, str]] = None) -> float:
+        """
+        Retry-After if the server sent one, otherwise full-jitter exponential backoff.
+        """
+        retry_after = parse_retry_after(headers)
+        if retry_after is not None:
+            return min(self.max_delay, retry_after + random.uniform(0, self.base_delay))
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _handle_failure(self, exc: Exception, attempt: int) -> float:
+        """
+        Records a failed attempt and returns how long to wait, or re-raises if it should not be retried.
+        """
+        if not is_retryable(exc) or attempt >= self.max_retries:
+            raise exc
+        headers = _error_headers(exc)
+        if isinstance(exc, openai.APIStatusError) and exc.status_code in THROTTLE_STATUS_CODES:
+            self.on_throttle(headers)
+        with self._lock:
+            self.retry_count += 1
+        return self.backoff_delay(attempt, headers)
+
+    # ----- reporting -----
+
+    def achieved_rates(self) -> Tuple[int, int]:
+        """
+        Requests and tokens completed in the last minute.
+        """
+        now = time.monotonic()
+        with self._lock:
+            while self._completions and now - self._completions[0][0] > RATE_WINDOW_SECONDS:
+                self._completions.popleft()
+            return len(self._completions), sum(tokens for _, tokens in self._completions)
+
+    def stats(self) -> dict:
+        rpm, tpm = self.achieved_rates()
+        return {
+            "requests_per_minute": rpm,
+            "tokens_per_minute": tpm,
+            "concurrency_limit": self.concurrency_limit,
+            "throttled": self.throttle_count,
+            "retries": self.retry_count,
+        }
+
+    # ----- asyncio gate -----
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        # The condition belongs to one event loop; a controller reused by a later asyncio.run gets a new one.
+        if self._condition is None or self._condition_loop is not loop:
+            self._condition, self._condition_loop = asyncio.Condition(), loop
+        async with self._condition:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), pause)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                with self._lock:
+                    if self._in_flight < self.concurrency_limit:
+                        self._in_flight += 1
+                        return
+                # Synchronous callers release slots without notifying the asyncio condition.
+                try:
+                    await asyncio.wait_for(self._condition.wait(), SLOT_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self):
+        async with self._condition:
+            with self._sync_condition:
+                self._in_flight -= 1
+                self._sync_condition.notify_all()
+            self._condition.notify(max(1, self.concurrency_limit - self._in_flight))
+
+    async def call_async(self, create_raw: Callable, request: dict):
+        """
+        Awaits create_raw(**request) (an AsyncOpenAI ...with_raw_response.create)
+        with gating and retries, and returns the parsed response.
+        """
+        attempt = 0
+        while True:
+            await self.acquire()
+            try:
+                raw = await create_raw(**request)
+                error = None
+            except Exception as exc:
+                error = exc
+            finally:
+                await self.release()
+            if error is None:
+                response = raw.parse()
+                self.on_success(raw.headers, _total_tokens(response))
+                return response
+            await asyncio.sleep(self._handle_failure(error, attempt))
+            attempt += 1
+
+    # ----- synchronous gate -----
+
+    def acquire_sync(self):
+        with self._sync_condition:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    self._sync_condition.wait(pause)
+                    continue
+                if self._in_flight < self.concurrency_limit:
+                    self._in_flight += 1
+                    return
+                self._sync_condition.wait(SLOT_POLL_SECONDS)
+
+    def release_sync(self):
+        with self._sync_condition:
+            self._in_flight -= 1
+            self._sync_condition.notify_all()
+
+    def call(self, create_raw: Callable, request: dict):
+        """
+        Calls create_raw(**request) (an OpenAI ...with_raw_response.create)
+        with gating and retries, and returns the parsed response.
+        """
+        attempt = 0
+        while True:
+            self.acquire_sync()
+            try:
+                raw = create_raw(**request)
+                error = None
+            except Exception as exc:
+                error = exc
+            finally:
+                self.release_sync()
+            if error is None:
+                response = raw.parse()
+                self.on_success(raw.headers, _total_tokens(response))
+                return response
+            time.sleep(self._handle_failure(error, attempt))
+            attempt += 1
+
+
+def _total_tokens(response) -> int:
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", 0) or 0
+
+
+_default_controller = None
+_default_controller_lock = threading.Lock()
+
+
+def get_default_controller() -> AdaptiveRateController:
+    """
+    Returns the process-wide controller used by the synchronous page calls.
+    """
+    global _default_controller
+    with _default_controller_lock:
+        if _default_controller is None:
+            _default_controller = AdaptiveRateController()
+        return _default_controller
+
+
+def resilient_create(client, controller: Optional[AdaptiveRateController] = None) -> Callable:
+    """
+    Returns a create(**request) callable for a synchronous OpenAI client that
+    retries throttled and transient failures. Build the client with
+    max_retries=0 so the controller sees every error.
+    """
+    controller = controller or get_default_controller()
+    return lambda **request: controller.call(client.chat.completions.with_raw_response.create, request)
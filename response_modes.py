@@ -0,0 +1,229 @@
+"""
+Output formats the model can use to report themes for one text.
+
+- full: every theme with a 0/1 value and a justification (the original format).
+- present: only the labels of themes that are present.
+- present_justified: present labels, each with a justification.
+- boolean: an object of theme -> true/false, as in
+  codebook_generator.generate_function_call_schema.
+
+The sparse modes cut completion tokens, which dominate latency and cost.
+Every mode is converted back to the full [{label, value, justification}] list,
+with absent themes filled in locally as zeros.
+"""
+import math
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Sequence
+
+from codebook_generator import generate_function_call_schema
+
+FULL_MODE = "full"
+PRESENT_MODE = "present"
+PRESENT_JUSTIFIED_MODE = "present_justified"
+BOOLEAN_MODE = "boolean"
+
+# Share of themes we expect to be present in a typical answer, for output-token estimates.
+EXPECTED_PRESENT_FRACTION = 0.2
+# Completion tokens for the braces and keys around one result.
+TOKENS_PER_RESULT_OVERHEAD = 10
+
+
+@dataclass(frozen=True)
+class ResponseMode:
+    name: str
+    title: str
+    # Properties of the JSON object returned for one text.
+    build_properties: Callable[[Sequence[str]], dict]
+    example: str
+    instructions: str
+    # Converts one text's result object to the full theme list; None if malformed.
+    to_themes: Callable[[dict, Sequence[str]], Optional[List[dict]]]
+    tokens_per_theme: int
+    tokens_per_present_theme: int
+
+
+def _expected_present(theme_count: int) -> int:
+    return math.ceil(theme_count * EXPECTED_PRESENT_FRACTION)
+
+
+def expected_result_tokens(mode: ResponseMode, theme_count: int) -> int:
+    """
+    Estimated completion tokens for one text's result.
+    """
+    return (TOKENS_PER_RESULT_OVERHEAD + theme_count * mode.tokens_per_theme
+            + _expected_present(theme_count) * mode.tokens_per_present_theme)
+
+
+def _theme(label: str, value: int, justification: str = "") -> dict:
+    return {"label": label, "value": value, "justification": justification}
+
+
+# ----- full -----
+
+def _full_properties(theme_labels: Sequence[str]) -> dict:
+    return {
+        "themes": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "label": {"type": "string", "enum": list(theme_labels), "description": "The theme label from the theme book."},
+                    "value": {"type": "integer", "enum": [0, 1], "description": "1 if theme is present, 0 if not."},
+                    "justification": {"type": "string", "description": "A brief explanation of why the theme was assigned 0 or 1."}
+                },
+                "required": ["label", "value", "justification"],
+                "additionalProperties": False
+            }
+        }
+    }
+
+
+def _full_to_themes(result: dict, theme_labels: Sequence[str]) -> Optional[List[dict]]:
+    themes = result.get("themes")
+    if not isinstance(themes, list):
+        return None
+    seen = set()
+    for t_obj in themes:
+        if not isinstance(t_obj, dict) or t_obj.get("value") not in (0, 1):
+            return None
+        seen.add(str(t_obj.get("label", "")).strip())
+    if not set(theme_labels) <= seen:
+        return None
+    return themes
+
+
+# ----- present -----
+
+def _present_properties(theme_labels: Sequence[str]) -> dict:
+    return {
+        "present": {
+            "type": "array",
+            "description": "Labels of the themes present in the text; empty if none apply.",
+            "items": {"type": "string", "enum": list(theme_labels)}
+        }
+    }
+
+
+def _present_to_themes(result: dict, theme_labels: Sequence[str]) -> Optional[List[dict]]:
+    present = result.get("present")
+    if not isinstance(present, list):
+        return None
+    present = {str(label).strip() for label in present}
+    return [_theme(label, 1 if label in present else 0) for label in theme_labels]
+
+
+# ----- present_justified -----
+
+def _present_justified_properties(theme_labels: Sequence[str]) -> dict:
+    return {
+        "present": {
+            "type": "array",
+            "description": "The themes present in the text; empty if none apply.",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "label": {"type": "string", "enum": list(theme_labels), "description": "The theme label from the theme book."},
+                    "justification": {"type": "string", "description": "A brief explanation of why the theme is present."}
+                },
+                "required": ["label", "justification"],
+                "additionalProperties": False
+            }
+        }
+    }
+
+
+def _present_justified_to_themes(result: dict, theme_labels: Sequence[str]) -> Optional[List[dict]]:
+    present = result.get("present")
+    if not isinstance(present, list) or not all(isinstance(item, dict) for item in present):
+        return None
+    justifications = {str(item.get("label", "")).strip(): str(item.get("justification", "")) for item in present}
+    return [_theme(label, 1 if label in justifications else 0, justifications.get(label, ""))
+            for label in theme_labels]
+
+
+# ----- boolean -----
+
+def _boolean_properties(theme_labels: Sequence[str]) -> dict:
+    return generate_function_call_schema(list(theme_labels))["parameters"]["properties"]
+
+
+def _boolean_to_themes(result: dict, theme_labels: Sequence[str]) -> Optional[List[dict]]:
+    codes = result.get("codes")
+    if not isinstance(codes, dict) or not all(isinstance(codes.get(label), bool) for label in theme_labels):
+        return None
+    return [_theme(label, int(codes[label])) for label in theme_labels]
+
+
+RESPONSE_MODES = {
+    FULL_MODE: ResponseMode(
+        name=FULL_MODE,
+        title="Every theme with a value and justification",
+        build_properties=_full_properties,
+        example="""{
+  "themes": [
+    {
+      "label": "<ThemeLabel>",
+      "value": 0 or 1,
+      "justification": "Short reason"
+    },
+    ...
+  ]
+}""",
+        instructions="Make sure to include each theme from the theme book exactly once.",
+        to_themes=_full_to_themes,
+        tokens_per_theme=30,
+        tokens_per_present_theme=0
+    ),
+    PRESENT_MODE: ResponseMode(
+        name=PRESENT_MODE,
+        title="Present theme labels only (fastest)",
+        build_properties=_present_properties,
+        example="""{
+  "present": ["<ThemeLabel>", ...]
+}""",
+        instructions="List only the themes from the theme book that are present; leave the list empty if none apply.",
+        to_themes=_present_to_themes,
+        tokens_per_theme=0,
+        tokens_per_present_theme=6
+    ),
+    PRESENT_JUSTIFIED_MODE: ResponseMode(
+        name=PRESENT_JUSTIFIED_MODE,
+        title="Present themes with justifications",
+        build_properties=_present_justified_properties,
+        example="""{
+  "present": [
+    {
+      "label": "<ThemeLabel>",
+      "justification": "Short reason"
+    },
+    ...
+  ]
+}""",
+        instructions="List only the themes from the theme book that are present, each with a short justification; leave the list empty if none apply.",
+        to_themes=_present_justified_to_themes,
+        tokens_per_theme=0,
+        tokens_per_present_theme=26
+    ),
+    BOOLEAN_MODE: ResponseMode(
+        name=BOOLEAN_MODE,
+        title="True/false for every theme",
+        build_properties=_boolean_properties,
+        example="""{
+  "codes": {
+    "<ThemeLabel>": true or false,
+    ...
+  }
+}""",
+        instructions="Include every theme from the theme book exactly once.",
+        to_themes=_boolean_to_themes,
+        tokens_per_theme=8,
+        tokens_per_present_theme=0
+    ),
+}
+
+
+def get_response_mode(name: str) -> ResponseMode:
+    try:
+        return RESPONSE_MODES[name]
+    except KeyError:
+        raise ValueError(f"Unknown response mode {name!r}; expected one of {list(RESPONSE_MODES)}")
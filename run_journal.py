@@ -0,0 +1,104 @@
+"""
+Append-only journal of completed work items, so long coding runs can resume.
+
+Each completed item (a coded answer, a cell's extracted codes, ...) is written
+to a SQLite file as soon as it finishes. Reopening the journal with the same
+run id returns everything already done, so only the remaining items are sent.
+Items are keyed by a hash of their text, so resuming does not depend on the
+data being in the same order. Callers pass what else determines an item's
+result (theme book, response mode, model) as the key's context, so a run
+resumed with different settings does not reuse stale results.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_JOURNAL_PATH = ".run_journal.sqlite3"
+
+
+def new_run_id(kind: str) -> str:
+    return f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+
+def item_key(text: str, context: str = "") -> str:
+    """
+    Hash of text, salted with the settings that determine its result.
+    """
+    salted = f"{context}\x00{text}" if context else str(text)
+    return hashlib.sha256(salted.encode("utf-8")).hexdigest()
+
+
+def settings_context(**settings: Any) -> str:
+    """
+    A stable digest of settings for item_key's context.
+    """
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS items ("
+        "run_id TEXT NOT NULL, key TEXT NOT NULL, payload TEXT NOT NULL, recorded_at REAL NOT NULL, "
+        "PRIMARY KEY (run_id, key))"
+    )
+    conn.commit()
+    return conn
+
+
+class RunJournal:
+    """
+    Completed items of one run. Safe to share between threads.
+    """
+
+    def __init__(self, run_id: str, path: str = DEFAULT_JOURNAL_PATH):
+        self.run_id = run_id
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+        rows = self._conn.execute("SELECT key, payload FROM items WHERE run_id = ?", (run_id,)).fetchall()
+        self._completed = {key: json.loads(payload) for key, payload in rows}
+
+    def completed(self) -> Dict[str, Any]:
+        """
+        Returns {key: payload} for every item already recorded in this run.
+        """
+        with self._lock:
+            return dict(self._completed)
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            return self._completed.get(key)
+
+    def record(self, key: str, payload: Any):
+        with self._lock:
+            self._completed[key] = payload
+            self._conn.execute(
+                "INSERT OR REPLACE INTO items (run_id, key, payload, recorded_at) VALUES (?, ?, ?, ?)",
+                (self.run_id, key, json.dumps(payload), time.time())
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def list_runs(kind: str = "", path: str = DEFAULT_JOURNAL_PATH, limit: int = 20) -> List[Tuple[str, int]]:
+    """
+    Returns (run_id, completed item count) for the most recent runs, optionally of one kind.
+    """
+    conn = _connect(path)
+    try:
+        return conn.execute(
+            "SELECT run_id, COUNT(*) FROM items WHERE run_id LIKE ? "
+            "GROUP BY run_id ORDER BY MAX(recorded_at) DESC LIMIT ?",
+            (f"{kind}%", limit)
+        ).fetchall()
+    finally:
+        conn.close()
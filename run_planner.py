@@ -0,0 +1,273 @@
+"""
+Pre-run planner: tokens, cost and wall-clock time of a theme coding run.
+
+Walks the same cells the encoder and the batch builder would send (after
+trivial/duplicate short-circuiting), counts prompt tokens with a pluggable
+tokenizer, estimates completion tokens for the response mode, and compares the
+sync, packed and batch strategies side by side.
+"""
+import json
+import math
+from dataclasses import asdict, dataclass
+from typing import List, Optional, Sequence, Tuple, Union
+
+import pandas as pd
+
+from answer_preprocessing import DEFAULT_TRIVIAL_PATTERNS, plan_dispatch
+from response_modes import FULL_MODE, expected_result_tokens, get_response_mode
+from survey_cells import iter_text_cells
+from theme_packing import TOKENS_PER_CELL_ID, build_packed_text_message, expected_output_tokens, pack_cells
+from theme_prompts import build_text_message
+from themebook import CompiledThemebook, compile_themebook
+from token_counting import TOKENS_PER_MESSAGE, TokenCounter, get_token_counter
+
+# USD per million (input, output) tokens; unknown models use DEFAULT_PRICING.
+MODEL_PRICING = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4": (30.00, 60.00),
+    "claude-3-haiku-20240307": (0.25, 1.25),
+}
+DEFAULT_PRICING = (2.50, 10.00)
+BATCH_DISCOUNT = 0.5
+BATCH_COMPLETION_WINDOW_HOURS = 24
+
+# Request latency model: fixed overhead plus generation time.
+REQUEST_OVERHEAD_SECONDS = 0.5
+OUTPUT_TOKENS_PER_SECOND = 60.0
+
+# Pack size used for the packed estimates when the run itself is unpacked.
+DEFAULT_PLAN_PACK_SIZE = 10
+
+SYNC_STRATEGY = "sync"
+PACKED_STRATEGY = "sync packed"
+BATCH_STRATEGY = "batch"
+PACKED_BATCH_STRATEGY = "batch packed"
+
+
+@dataclass
+class PlanEstimate:
+    strategy: str
+    requests: int
+    prompt_tokens: int
+    completion_tokens: int
+    cost_usd: float
+    # For batch strategies this is the provider's completion window, an upper bound.
+    minutes: float
+
+
+@dataclass
+class RunShape:
+    """
+    Per-request token counts of a run, from which estimates are derived.
+    """
+    cells: int
+    calls_saved: int
+    single_prompt_tokens: List[int]
+    single_completion_tokens: int
+    packed_prompt_tokens: List[int]
+    packed_completion_tokens: List[int]
+
+
+def get_model_pricing(model_name: str):
+    return MODEL_PRICING.get(model_name, DEFAULT_PRICING)
+
+
+def measure_run(
+    df: pd.DataFrame,
+    themebook: Union[pd.DataFrame, CompiledThemebook],
+    model_name: str = "gpt-4o-mini",
+    response_mode: str = FULL_MODE,
+    pack_size: int = DEFAULT_PLAN_PACK_SIZE,
+    trivial_patterns: Sequence[str] = DEFAULT_TRIVIAL_PATTERNS,
+    count_tokens: Optional[TokenCounter] = None
+) -> RunShape:
+    """
+    Counts the prompt and completion tokens of every request the run would send,
+    one cell per request and packed. A pack_size of 1 plans packs of
+    DEFAULT_PLAN_PACK_SIZE so the strategies can still be compared.
+    """
+    if pack_size <= 1:
+        pack_size = DEFAULT_PLAN_PACK_SIZE
+    count_tokens = count_tokens or get_token_counter(model_name)
+    compiled = compile_themebook(themebook)
+    mode = get_response_mode(response_mode)
+    single_prompt = compiled.prompt(mode.name)
+    packed_prompt = compiled.prompt(mode.name, packed=True)
+
+    cells = list(iter_text_cells(df, compiled.labels))
+    plan = plan_dispatch([text for _, _, text in cells], trivial_patterns)
+
+    def prefix_tokens(prompt) -> int:
+        return TOKENS_PER_MESSAGE + count_tokens(prompt.system_message) + count_tokens(json.dumps(prompt.function_schema))
+
+    single_prefix = prefix_tokens(single_prompt)
+    single_prompt_tokens = [single_prefix + TOKENS_PER_MESSAGE + count_tokens(build_text_message(text))
+                            for text in plan.unique_texts]
+
+    packed_prefix = prefix_tokens(packed_prompt)
+    packs = pack_cells([(str(u), text) for u, text in enumerate(plan.unique_texts)], packed_prefix,
+                       len(compiled.labels), model_name, pack_size, mode)
+    packed_prompt_tokens = [packed_prefix + TOKENS_PER_MESSAGE + count_tokens(build_packed_text_message(pack))
+                            for pack in packs]
+    packed_completion_tokens = [expected_output_tokens(len(pack), len(compiled.labels), mode) for pack in packs]
+
+    return RunShape(
+        cells=len(cells),
+        calls_saved=plan.calls_saved,
+        single_prompt_tokens=single_prompt_tokens,
+        single_completion_tokens=expected_result_tokens(mode, len(compiled.labels)) + TOKENS_PER_CELL_ID,
+        packed_prompt_tokens=packed_prompt_tokens,
+        packed_completion_tokens=packed_completion_tokens
+    )
+
+
+def _sync_minutes(requests: int, prompt_tokens: int, completion_tokens: int,
+                  concurrency: int, requests_per_minute: int, tokens_per_minute: int) -> float:
+    """
+    The slowest of the latency-bound, request-limit-bound and token-limit-bound durations.
+    """
+    if not requests:
+        return 0.0
+    seconds_per_request = REQUEST_OVERHEAD_SECONDS + completion_tokens / requests / OUTPUT_TOKENS_PER_SECOND
+    latency_minutes = math.ceil(requests / concurrency) * seconds_per_request / 60
+    return max(latency_minutes,
+               requests / requests_per_minute,
+               (prompt_tokens + completion_tokens) / tokens_per_minute)
+
+
+def estimate_strategies(
+    shape: RunShape,
+    model_name: str,
+    concurrency: int,
+    requests_per_minute: int,
+    tokens_per_minute: int
+) -> List[PlanEstimate]:
+    """
+    Projects requests, tokens, cost and time for sync, packed and batch runs.
+    """
+    input_price, output_price = get_model_pricing(model_name)
+
+    def cost(prompt_tokens: int, completion_tokens: int, discount: float = 1.0) -> float:
+        return discount * (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+    single_requests = len(shape.single_prompt_tokens)
+    single_prompt = sum(shape.single_prompt_tokens)
+    single_completion = single_requests * shape.single_completion_tokens
+    packed_requests = len(shape.packed_prompt_tokens)
+    packed_prompt = sum(shape.packed_prompt_tokens)
+    packed_completion = sum(shape.packed_completion_tokens)
+    batch_minutes = BATCH_COMPLETION_WINDOW_HOURS * 60.0
+
+    return [
+        PlanEstimate(SYNC_STRATEGY, single_requests, single_prompt, single_completion,
+                     cost(single_prompt, single_completion),
+                     _sync_minutes(single_requests, single_prompt, single_completion,
+                                   concurrency, requests_per_minute, tokens_per_minute)),
+        PlanEstimate(PACKED_STRATEGY, packed_requests, packed_prompt, packed_completion,
+                     cost(packed_prompt, packed_completion),
+                     _sync_minutes(packed_requests, packed_prompt, packed_completion,
+                                   concurrency, requests_per_minute, tokens_per_minute)),
+        PlanEstimate(BATCH_STRATEGY, single_requests, single_prompt, single_completion,
+                     cost(single_prompt, single_completion, BATCH_DISCOUNT), batch_minutes),
+        PlanEstimate(PACKED_BATCH_STRATEGY, packed_requests, packed_prompt, packed_completion,
+                     cost(packed_prompt, packed_completion, BATCH_DISCOUNT), batch_minutes),
+    ]
+
+
+def estimates_to_dataframe(estimates: List[PlanEstimate]) -> pd.DataFrame:
+    plan_df = pd.DataFrame([asdict(estimate) for estimate in estimates])
+    plan_df["cost_usd"] = plan_df["cost_usd"].round(4)
+    plan_df["minutes"] = plan_df["minutes"].round(1)
+    return plan_df
+
+
+# ----- routing -----
+
+SYNC_ROUTE = "sync"
+BATCH_ROUTE = "batch"
+SPLIT_ROUTE = "split"
+
+# Jobs this small go through the sync path unless it breaks the cost ceiling.
+SMALL_JOB_MINUTES = 10.0
+# Share of a batch-routed job coded through the sync path first, so results can be reviewed early.
+DEFAULT_PREVIEW_FRACTION = 0.05
+
+
+@dataclass
+class RouteDecision:
+    route: str
+    # Share of the answers coded through the sync path; the rest go to batch.
+    sync_fraction: float
+    # Predicted minutes until all results, and until the first results, are back.
+    minutes: float
+    first_results_minutes: float
+    cost_usd: float
+    reason: str
+
+    def sync_rows(self, row_count: int) -> int:
+        return min(row_count, math.ceil(self.sync_fraction * row_count))
+
+
+def _mix(sync: PlanEstimate, batch: PlanEstimate, sync_fraction: float) -> Tuple[float, float, float]:
+    """
+    (minutes, first_results_minutes, cost_usd) of coding sync_fraction of the answers sync and the rest in batch.
+    """
+    cost = sync_fraction * sync.cost_usd + (1 - sync_fraction) * batch.cost_usd
+    sync_minutes = sync_fraction * sync.minutes
+    minutes = sync_minutes if sync_fraction >= 1 else max(sync_minutes, batch.minutes)
+    if sync_fraction > 0:
+        first_minutes = (REQUEST_OVERHEAD_SECONDS
+                         + sync.completion_tokens / max(1, sync.requests) / OUTPUT_TOKENS_PER_SECOND) / 60
+    else:
+        first_minutes = batch.minutes
+    return minutes, first_minutes, cost
+
+
+def route_run(
+    estimates: List[PlanEstimate],
+    packed: bool = False,
+    deadline_minutes: Optional[float] = None,
+    max_cost_usd: Optional[float] = None,
+    preview_fraction: float = DEFAULT_PREVIEW_FRACTION
+) -> RouteDecision:
+    """
+    Chooses between the concurrent sync path and batch for a run, from its
+    estimate_strategies estimates, a deadline and a cost ceiling (None for no limit).
+    Small or urgent runs go sync; large runs that can wait go to batch, with a
+    preview_fraction of the answers coded sync first so results arrive quickly.
+    """
+    by_strategy = {estimate.strategy: estimate for estimate in estimates}
+    sync = by_strategy[PACKED_STRATEGY if packed else SYNC_STRATEGY]
+    batch = by_strategy[PACKED_BATCH_STRATEGY if packed else BATCH_STRATEGY]
+
+    def fits(minutes: float, cost: float) -> bool:
+        return ((deadline_minutes is None or minutes <= deadline_minutes)
+                and (max_cost_usd is None or cost <= max_cost_usd))
+
+    def decision(route: str, sync_fraction: float, reason: str) -> RouteDecision:
+        return RouteDecision(route, sync_fraction, *_mix(sync, batch, sync_fraction), reason)
+
+    sync_fits = fits(sync.minutes, sync.cost_usd)
+    batch_fits = fits(batch.minutes, batch.cost_usd)
+    if sync_fits and (sync.minutes <= SMALL_JOB_MINUTES or not batch_fits):
+        reason = ("Small job: the sync path finishes in minutes." if sync.minutes <= SMALL_JOB_MINUTES
+                  else "Only the sync path meets the deadline.")
+        return decision(SYNC_ROUTE, 1.0, reason)
+    if batch_fits:
+        preview_minutes, _, preview_cost = _mix(sync, batch, preview_fraction)
+        if preview_fraction > 0 and fits(preview_minutes, preview_cost):
+            return decision(SPLIT_ROUTE, preview_fraction,
+                            f"Large job that can wait: batch is {batch.cost_usd / max(sync.cost_usd, 1e-9):.0%} "
+                            f"of the sync cost, and a {preview_fraction:.0%} sync preview gives early results.")
+        return decision(BATCH_ROUTE, 0.0, "Large job that can wait: batch is the cheapest route.")
+
+    if max_cost_usd is not None and sync.cost_usd > max_cost_usd:
+        if batch.cost_usd > max_cost_usd:
+            return decision(BATCH_ROUTE, 0.0, "No route meets the cost ceiling: batch is the cheapest.")
+        # Code as much as the budget allows sync; the deadline is missed either way.
+        sync_fraction = (max_cost_usd - batch.cost_usd) / (sync.cost_usd - batch.cost_usd)
+        return decision(SPLIT_ROUTE if sync_fraction > 0 else BATCH_ROUTE, sync_fraction,
+                        "No route meets both limits: the cost ceiling rules out coding everything sync, "
+                        "so as much as the budget allows is coded sync and the rest in batch.")
+    return decision(SYNC_ROUTE, 1.0, "No route meets the deadline: the sync path is the fastest.")
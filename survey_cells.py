@@ -0,0 +1,23 @@
+from typing import Iterator, Sequence, Tuple
+
+import pandas as pd
+
+
+def is_codeable_column(col_name: str, theme_labels: Sequence[str]) -> bool:
+    """
+    Only original columns are coded; theme and justification columns are skipped.
+    """
+    return col_name not in theme_labels and not str(col_name).endswith("_justification")
+
+
+def iter_text_cells(df: pd.DataFrame, theme_labels: Sequence[str]) -> Iterator[Tuple[int, str, str]]:
+    """
+    Yields (row_idx, col_name, text) for every non-empty text cell, row by row.
+    """
+    columns = [(df.columns.get_loc(col), col) for col in df.columns if is_codeable_column(col, theme_labels)]
+    for row_idx in range(len(df)):
+        for col_pos, col_name in columns:
+            cell_value = str(df.iat[row_idx, col_pos])
+            if not cell_value.strip():
+                continue
+            yield row_idx, col_name, cell_value
@@ -0,0 +1,77 @@
+import json
+import os
+
+import pandas as pd
+
+from batch_jsonl import iter_jsonl_sources, write_jsonl_shards
+from batch_orchestrator import ERRORS_DIR, BatchOrchestrator
+from batch_results import ingest_batch_results
+from mock_openai_server import FakeBatchBackend, zero_theme_responder
+from themebook import compile_themebook
+
+THEMEBOOK = pd.DataFrame({"Theme": ["Cost", "Waiting"], "Definition": ["Money", "Time spent waiting"]})
+DATA = pd.DataFrame({"q1": [f"Answer number {i}" for i in range(6)]})
+
+
+def packed_jobs(pack_size: int = 3) -> list:
+    prompt = compile_themebook(THEMEBOOK).prompt(packed=True)
+    cells = [(str(i), text) for i, text in enumerate(DATA["q1"])]
+    return [{"custom_id": f"pack{i // pack_size}", "method": "POST", "url": "/chat/completions",
+             "body": {"model": "gpt-4o-mini", "messages": prompt.packed_messages(cells[i:i + pack_size]),
+                      "tools": prompt.tools, "tool_choice": prompt.tool_choice}}
+            for i in range(0, len(cells), pack_size)]
+
+
+def dropping_responder(dropped_ids: set):
+    """
+    Answers packed requests but leaves the given cells out the first time they are asked for.
+    """
+    respond = zero_theme_responder(list(THEMEBOOK["Theme"]))
+    requested, seen = [], set()
+
+    def drop(body: dict) -> dict:
+        ids = [cell["id"] for cell in json.loads(body["messages"][-1]["content"])]
+        requested.append(ids)
+        result = respond(body)
+        result["results"] = [item for item in result["results"] if item["id"] not in dropped_ids - seen]
+        seen.update(ids)
+        return result
+    drop.requested = requested
+    return drop
+
+
+def run_orchestrator(tmp_path, backend, max_attempts: int = 3) -> BatchOrchestrator:
+    write_jsonl_shards(packed_jobs(), str(tmp_path))
+    orchestrator = BatchOrchestrator(backend, str(tmp_path), max_attempts=max_attempts,
+                                     poll_interval=0, sleep=lambda seconds: None)
+    orchestrator.run()
+    return orchestrator
+
+
+def test_cells_missing_from_a_packed_result_are_retried(tmp_path):
+    responder = dropping_responder({"1"})
+    orchestrator = run_orchestrator(tmp_path, FakeBatchBackend(responder))
+
+    # The retry sends only the missing cell, not the whole pack again.
+    assert responder.requested == [["0", "1", "2"], ["3", "4", "5"], ["1"]]
+    assert orchestrator.summary()["failed_jobs"] == 0
+    sources = [os.path.join(tmp_path, path) for shard in orchestrator.state["shards"] for path in shard["result_paths"]]
+    _, report = ingest_batch_results(DATA, THEMEBOOK, iter_jsonl_sources(sources))
+    assert report.missing_cells == []
+    assert report.failed_ids == []
+
+
+def test_cells_still_missing_after_the_last_attempt_are_reported(tmp_path):
+    orchestrator = run_orchestrator(tmp_path, FakeBatchBackend(dropping_responder({"1"})), max_attempts=1)
+
+    assert orchestrator.state["shards"][0]["failed_ids"] == ["pack0:1"]
+
+
+def test_error_file_is_kept_and_its_messages_reported(tmp_path):
+    orchestrator = run_orchestrator(tmp_path, FakeBatchBackend(failure_rate=1.0), max_attempts=2)
+
+    shard = orchestrator.state["shards"][0]
+    assert shard["failed_ids"] == ["pack0", "pack1"]
+    assert shard["errors"] == {"pack0": "Injected server error", "pack1": "Injected server error"}
+    assert sorted(os.listdir(os.path.join(tmp_path, ERRORS_DIR))) == ["shard-000-attempt0.jsonl",
+                                                                      "shard-000-attempt1.jsonl"]
@@ -0,0 +1,42 @@
+import json
+
+import pandas as pd
+
+from batch_results import ingest_batch_results, job_custom_id
+
+THEMEBOOK = pd.DataFrame({"Theme": ["Cost", "Waiting"], "Definition": ["Money", "Time spent waiting"]})
+DATA = pd.DataFrame({"q1": ["The price was too high", "We had to wait for hours"]})
+
+
+def output_line(custom_id: str, arguments: dict) -> dict:
+    message = {"tool_calls": [{"function": {"arguments": json.dumps(arguments)}}]}
+    return {"custom_id": custom_id, "response": {"status_code": 200, "body": {"choices": [{"message": message}]}}}
+
+
+def full_result(**values) -> dict:
+    return {"themes": [{"label": label, "value": value, "justification": ""} for label, value in values.items()]}
+
+
+def test_single_result_missing_a_theme_is_a_failure():
+    lines = [output_line(job_custom_id(0, "q1"), full_result(Cost=1, Waiting=0)),
+             output_line(job_custom_id(1, "q1"), full_result(Waiting=1))]
+
+    coded_df, report = ingest_batch_results(DATA, THEMEBOOK, lines)
+
+    assert report.failed_ids == [job_custom_id(1, "q1")]
+    assert report.coded_answers == 1
+    assert report.missing_cells == [(1, "q1")]
+    assert coded_df["Cost"].tolist() == [1, 0]
+
+
+def test_packed_results_that_are_empty_or_malformed_are_failures():
+    lines = [output_line("pack0", {"results": []}),
+             output_line("pack1", {"results": [{"id": "0", **full_result(Cost=1, Waiting=0)},
+                                               {"id": "1", "themes": "none"}]})]
+
+    coded_df, report = ingest_batch_results(DATA, THEMEBOOK, lines)
+
+    assert report.failed_ids == ["pack0", "pack1:1"]
+    assert report.unknown_ids == []
+    assert report.missing_cells == [(1, "q1")]
+    assert coded_df["Cost"].tolist() == [1, 0]
@@ -0,0 +1,31 @@
+import json
+
+from codebook_extraction import CodebookBuilder, parse_codes
+
+CELLS = [
+    # (cell_idx, row_idx, col_name, function call arguments)
+    (0, 0, "q1", {"codes": [{"label": "Billing", "definition": "Charges"},
+                            {"label": "Access", "definition": "Getting in"},
+                            {"label": "Billing", "definition": "Repeated"}]}),
+    (1, 1, "q1", {"codes": [{"label": "Access", "definition": "Later"},
+                            {"label": "Parking", "definition": "Car spaces"}]}),
+]
+
+
+def build(order) -> CodebookBuilder:
+    builder = CodebookBuilder(n_rows=2)
+    for cell_idx, row_idx, col_name, arguments in order:
+        builder.add(cell_idx, row_idx, col_name, *parse_codes(json.dumps(arguments)))
+    return builder
+
+
+def test_codebook_and_matrix_follow_first_appearance_whatever_the_arrival_order():
+    for order in (CELLS, CELLS[::-1]):
+        builder = build(order)
+        codebook_df = builder.codebook_dataframe()
+        wide = builder.code_matrix().widen()
+
+        assert codebook_df["Code"].tolist() == ["Billing", "Access", "Parking"]
+        assert codebook_df["Definition"].tolist() == ["Charges", "Getting in", "Car spaces"]
+        assert wide.columns.tolist() == ["q1_Billing", "q1_Access", "q1_Parking"]
+        assert wide.values.tolist() == [[1, 1, 0], [0, 1, 1]]
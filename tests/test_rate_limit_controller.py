@@ -0,0 +1,97 @@
+import asyncio
+import threading
+import time
+
+from openai import AsyncOpenAI
+
+from mock_openai_server import MockChatCompletionsServer, zero_theme_responder
+from rate_limit_controller import AdaptiveRateController
+from themebook import compile_themebook
+import pandas as pd
+
+THEMEBOOK = compile_themebook(pd.DataFrame({"Theme": ["Cost"], "Definition": ["Money"]}))
+
+
+class RecordingController(AdaptiveRateController):
+    """
+    Records the concurrency limit right after every throttle.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limits_after_throttle = []
+
+    def on_throttle(self, headers):
+        super().on_throttle(headers)
+        self.limits_after_throttle.append(self.concurrency_limit)
+
+
+def send_requests(server: MockChatCompletionsServer, controller: AdaptiveRateController, count: int):
+    prompt = THEMEBOOK.prompt()
+    request = {"model": "gpt-4o-mini", "messages": prompt.messages("The price was high"),
+               "tools": prompt.tools, "tool_choice": prompt.tool_choice}
+
+    async def run():
+        client = AsyncOpenAI(api_key="test-key", base_url=server.url, max_retries=0)
+        try:
+            return await asyncio.gather(*(controller.call_async(client.chat.completions.with_raw_response.create,
+                                                                request) for _ in range(count)))
+        finally:
+            await client.close()
+    return asyncio.run(run())
+
+
+def test_throttling_halves_concurrency_pauses_and_recovers():
+    # Generous retries: which waiter wins a freed slot is a race, and an unlucky request must not give up.
+    controller = RecordingController(initial_concurrency=8, max_concurrency=8, base_delay=0.05, max_retries=20)
+    # Two requests per half-second window; the 429s carry a Retry-After until the window frees up.
+    with MockChatCompletionsServer(zero_theme_responder(["Cost"]), requests_per_minute=2,
+                                   window_seconds=0.5) as server:
+        started = time.monotonic()
+        responses = send_requests(server, controller, 8)
+        elapsed = time.monotonic() - started
+        throttled = server.throttled_count
+
+    assert len(responses) == 8
+    # Multiplicative decrease: the first throttle halves the limit.
+    assert controller.limits_after_throttle[0] == 4
+    assert controller.throttle_count == throttled > 0
+    # Waiting out Retry-After: four windows are needed for eight requests, and the pause
+    # keeps the retries from hammering the server (jittered backoff alone would retry within 0.05s).
+    assert elapsed >= 1.4
+    assert throttled <= 12
+
+    # Additive increase: successful requests raise the limit again.
+    lowest = controller.concurrency_limit
+    with MockChatCompletionsServer(zero_theme_responder(["Cost"])) as server:
+        send_requests(server, controller, 40)
+    assert controller.concurrency_limit > lowest
+    assert controller.concurrency_limit == 8
+
+
+def test_synchronous_calls_respect_the_concurrency_limit():
+    controller = AdaptiveRateController(initial_concurrency=2, max_concurrency=2)
+    in_flight, peak = [0], [0]
+    lock = threading.Lock()
+
+    class RawResponse:
+        headers = {}
+
+        def parse(self):
+            return None
+
+    def create_raw(**request):
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        time.sleep(0.05)
+        with lock:
+            in_flight[0] -= 1
+        return RawResponse()
+
+    threads = [threading.Thread(target=controller.call, args=(create_raw, {})) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak[0] == 2
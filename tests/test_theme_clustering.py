@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from embeddings import HashedTfidfEmbedder, normalize_rows
+from theme_clustering import AGGLOMERATIVE_METHOD, KMEANS_METHOD, agglomerate, cluster_vectors
+
+TOPICS = [
+    ["price", "cost", "expensive", "money", "fee"],
+    ["wait", "queue", "slow", "hours", "delay"],
+    ["staff", "rude", "friendly", "nurse", "helpful"],
+    ["parking", "car", "spaces", "lot", "drive"],
+    ["clean", "dirty", "toilet", "smell", "hygiene"],
+    ["food", "meal", "cold", "taste", "menu"],
+    ["website", "online", "booking", "app", "login"],
+    ["noise", "loud", "sleep", "night", "quiet"],
+]
+FILLER = ["the", "was", "very", "really", "and", "a", "it", "we", "i", "too", "quite", "service",
+          "hospital", "visit", "experience", "good", "bad", "ok"]
+TOPIC_SIZES = [1500, 1000, 800, 600, 400, 300, 250, 150]
+
+
+def topic_answers(sizes, seed=0):
+    """
+    Answers made of three words from one topic and eight filler words, and the topic of each.
+    """
+    rng = np.random.default_rng(seed)
+    texts, topics = [], []
+    for topic, size in enumerate(sizes):
+        for _ in range(size):
+            words = list(rng.choice(TOPICS[topic], 3)) + list(rng.choice(FILLER, 8))
+            rng.shuffle(words)
+            texts.append(" ".join(words))
+            topics.append(topic)
+    return texts, np.array(topics)
+
+
+def same_partition(labels: np.ndarray, truth: np.ndarray) -> bool:
+    pairs = set(zip(labels.tolist(), truth.tolist()))
+    return len(pairs) == len(set(labels.tolist())) == len(set(truth.tolist()))
+
+
+def test_agglomerate_does_not_let_merged_groups_absorb_their_neighbours():
+    # Eight groups of six noisy subcluster centroids that share a common direction,
+    # like answers that share filler words. Summed centroids lose their noise as they
+    # grow, so the first merged group used to pull in almost every other centroid.
+    rng = np.random.default_rng(0)
+    dims = 256
+    shared = normalize_rows(rng.normal(size=(1, dims)).astype(np.float32))
+    directions = normalize_rows(shared + normalize_rows(rng.normal(size=(8, dims)).astype(np.float32)))
+    groups = np.repeat(np.arange(8), 6)
+    noise = 1.2 / np.sqrt(dims) * rng.normal(size=(len(groups), dims)).astype(np.float32)
+    centroids = normalize_rows(directions[groups] + noise)
+
+    mapping = agglomerate(centroids, 8)
+
+    assert same_partition(mapping, groups)
+
+
+@pytest.mark.parametrize("method", [KMEANS_METHOD, AGGLOMERATIVE_METHOD])
+def test_uneven_topics_are_recovered(method):
+    texts, topics = topic_answers(TOPIC_SIZES)
+    vectors = HashedTfidfEmbedder().fit(texts).embed(texts)
+
+    labels, centroids = cluster_vectors(vectors, len(TOPICS), method)
+
+    assert len(centroids) == len(TOPICS)
+    # Each cluster's share of its most common topic.
+    purity = sum(np.bincount(topics[labels == cluster]).max() for cluster in np.unique(labels)) / len(topics)
+    if method == AGGLOMERATIVE_METHOD:
+        assert purity > 0.99
+        # Clusters are numbered largest first, so they line up with the topic sizes.
+        assert np.abs(np.bincount(labels) - TOPIC_SIZES).max() <= 0.02 * TOPIC_SIZES[0]
+    else:
+        # k-means tends to split the largest topic and merge small ones, but never collapses.
+        assert purity > 0.9
+    assert np.bincount(labels).max() <= 1.05 * TOPIC_SIZES[0]
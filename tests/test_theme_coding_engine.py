@@ -0,0 +1,110 @@
+import asyncio
+import json
+
+import pandas as pd
+import pytest
+
+from mock_openai_server import MockChatCompletionsServer
+from response_modes import RESPONSE_MODES
+from theme_coding_engine import EngineConfig, code_cells_async, theme_code_dataframe
+from theme_prompts import build_text_message
+
+KEYWORDS = {"Cost": "price", "Waiting": "wait", "Staff": "staff"}
+THEMEBOOK = pd.DataFrame({"Theme": list(KEYWORDS), "Definition": ["Money", "Time spent waiting", "People"]})
+TEXTS = [
+    "The price was too high",
+    "We had to wait for hours",
+    "Friendly staff but a long wait",
+    "Nothing to add",
+    "Staff explained the price",
+    "Great staff, fair price, no wait",
+]
+
+
+def expected_values(text: str) -> list:
+    return [int(keyword in text.lower()) for keyword in KEYWORDS.values()]
+
+
+def keyword_result(properties: dict, text: str) -> dict:
+    """
+    The result for text in whichever response mode the tool schema asks for.
+    """
+    present = [label for label, keyword in KEYWORDS.items() if keyword in text.lower()]
+    if "themes" in properties:
+        return {"themes": [{"label": label, "value": int(label in present), "justification": "keyword"}
+                           for label in KEYWORDS]}
+    if "codes" in properties:
+        return {"codes": {label: label in present for label in KEYWORDS}}
+    if properties["present"]["items"].get("type") == "object":
+        return {"present": [{"label": label, "justification": "keyword"} for label in present]}
+    return {"present": present}
+
+
+def keyword_responder(skip_packed_ids=()):
+    """
+    Marks a theme present when its keyword is in the text, for single and packed requests.
+    Cells whose id is in skip_packed_ids are left out of packed results.
+    """
+    def respond(body: dict) -> dict:
+        properties = body["tools"][0]["function"]["parameters"]["properties"]
+        content = body["messages"][-1]["content"]
+        if "results" not in properties:
+            return keyword_result(properties, content[len(build_text_message("")):])
+        item_properties = properties["results"]["items"]["properties"]
+        return {"results": [{"id": cell["id"], **keyword_result(item_properties, cell["text"])}
+                            for cell in json.loads(content) if cell["id"] not in skip_packed_ids]}
+    return respond
+
+
+def run_engine(server, texts, **config):
+    config = EngineConfig(base_url=server.url, use_cache=False, **config)
+    return asyncio.run(code_cells_async(texts, THEMEBOOK, "test-key", config))
+
+
+@pytest.mark.parametrize("pack_size", [1, 3])
+@pytest.mark.parametrize("response_mode", list(RESPONSE_MODES))
+def test_codes_every_cell_in_every_mode(response_mode, pack_size):
+    with MockChatCompletionsServer(keyword_responder()) as server:
+        run = run_engine(server, TEXTS, response_mode=response_mode, pack_size=pack_size)
+
+    assert run.failures == {}
+    for text, themes in zip(TEXTS, run.results):
+        assert [theme["label"] for theme in themes] == list(KEYWORDS)
+        assert [theme["value"] for theme in themes] == expected_values(text)
+    expected_requests = len(TEXTS) if pack_size == 1 else len(TEXTS) // pack_size
+    assert run.request_count == expected_requests == server.request_count
+    assert sum(metric["cells"] for metric in run.request_metrics) == len(TEXTS)
+
+
+def test_cells_missing_from_a_packed_response_are_coded_individually():
+    with MockChatCompletionsServer(keyword_responder(skip_packed_ids={"1"})) as server:
+        run = run_engine(server, TEXTS, pack_size=3)
+
+    assert run.failures == {}
+    assert [[theme["value"] for theme in themes] for themes in run.results] == [expected_values(t) for t in TEXTS]
+    assert run.request_count == 3
+
+
+def test_malformed_response_is_a_failure():
+    with MockChatCompletionsServer(lambda body: {"themes": [{"label": "Cost", "value": 1}]}) as server:
+        run = run_engine(server, TEXTS[:2])
+
+    assert run.results == [None, None]
+    assert set(run.failures) == {0, 1}
+
+
+def test_duplicate_and_trivial_answers_save_calls():
+    df = pd.DataFrame({
+        "q1": ["The price was too high", "the price  was too HIGH", "N/A", "We had to wait"],
+        "q2": ["-", "Friendly staff", "The price was too high", "nan"],
+    })
+    with MockChatCompletionsServer(keyword_responder()) as server:
+        coded_df, run = theme_code_dataframe(df, THEMEBOOK, "test-key",
+                                             EngineConfig(base_url=server.url, use_cache=False))
+
+    # Three distinct answers; two duplicates and three trivial answers need no request.
+    assert run.request_count == server.request_count == 3
+    assert run.calls_saved == 5
+    assert coded_df["Cost"].tolist() == [1, 1, 1, 0]
+    assert coded_df["Waiting"].tolist() == [0, 0, 0, 1]
+    assert coded_df["Staff"].tolist() == [0, 1, 0, 0]
@@ -0,0 +1,350 @@
+"""
+Hybrid theme discovery: embed, cluster and name.
+
+Responses (or codes extracted by the Generate Codebook page) are embedded in
+batches with a pluggable embedder (see embeddings) and clustered with
+vectorized spherical k-means: every assignment step is one chunked matrix
+product, so 100k responses cluster in seconds on one CPU. With the
+agglomerative method, k-means first over-clusters and the centroids are then
+merged bottom-up by average linkage, which follows uneven cluster shapes more
+closely.
+
+Each cluster is described by its exemplars (the items closest to its
+centroid) and its most distinctive terms. Clusters are named either offline
+from those terms or by the model from the exemplars, giving a theme book
+for the Theme Encoder.
+"""
+import json
+import math
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from answer_preprocessing import TRIVIAL, plan_dispatch
+from embedding_store import EmbeddingStore
+from embeddings import Embedder, HashedTfidfEmbedder, embed_texts, normalize_rows, text_features
+from llm_cache import cached_function_arguments
+from rate_limit_controller import resilient_create
+from survey_cells import iter_text_cells
+from theme_coding_engine import ProgressCallback
+
+KMEANS_METHOD = "kmeans"
+AGGLOMERATIVE_METHOD = "agglomerative"
+DEFAULT_CLUSTERS = 12
+DEFAULT_EXEMPLARS = 5
+KMEANS_ITERATIONS = 30
+# k-means++ seeding runs on a sample; it is quadratic in k and linear in the sample.
+INIT_SAMPLE_SIZE = 10_000
+# Rows per chunk of the assignment step, bounding the (rows x k) similarity block.
+ASSIGN_CHUNK_ROWS = 16_384
+# The agglomerative method over-clusters by this factor before merging.
+OVERCLUSTER_FACTOR = 4
+TERMS_PER_CLUSTER = 5
+# Texts per cluster counted for the distinctive terms.
+TERM_SAMPLE_SIZE = 2_000
+
+THEME_NAME_FUNCTION = "name_theme"
+THEME_NAME_SCHEMA = {
+    "name": THEME_NAME_FUNCTION,
+    "description": "Names the theme shared by a group of survey responses.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "theme": {"type": "string", "description": "A short theme label."},
+            "definition": {"type": "string", "description": "One sentence defining when the theme applies."}
+        },
+        "required": ["theme", "definition"]
+    }
+}
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Nearest centroid by cosine similarity for every row, and that similarity.
+    """
+    labels = np.empty(len(vectors), dtype=np.int64)
+    similarity = np.empty(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), ASSIGN_CHUNK_ROWS):
+        block = vectors[start:start + ASSIGN_CHUNK_ROWS] @ centroids.T
+        labels[start:start + len(block)] = block.argmax(axis=1)
+        similarity[start:start + len(block)] = block.max(axis=1)
+    return labels, similarity
+
+
+def _centroids(vectors: np.ndarray, labels: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Unit-length mean direction and size of each cluster.
+    """
+    sums = np.zeros((k, vectors.shape[1]), dtype=np.float32)
+    clusters = np.arange(k)
+    for start in range(0, len(vectors), ASSIGN_CHUNK_ROWS):
+        # One-hot membership times the rows sums each cluster in a single matrix product.
+        membership = (labels[start:start + ASSIGN_CHUNK_ROWS, None] == clusters).astype(np.float32)
+        sums += membership.T @ vectors[start:start + ASSIGN_CHUNK_ROWS]
+    return normalize_rows(sums), np.bincount(labels, minlength=k)
+
+
+def _kmeans_plus_plus(vectors: np.ndarray, k: int, rng: np.random.Generator) -> np.ndarray:
+    sample = vectors[rng.choice(len(vectors), min(len(vectors), INIT_SAMPLE_SIZE), replace=False)]
+    centroids = [sample[rng.integers(len(sample))]]
+    # Cosine distance to the nearest chosen centroid.
+    distance = 1 - sample @ centroids[0]
+    for _ in range(1, k):
+        weights = np.clip(distance, 0, None) ** 2
+        total = weights.sum()
+        index = rng.choice(len(sample), p=weights / total) if total > 0 else rng.integers(len(sample))
+        centroids.append(sample[index])
+        distance = np.minimum(distance, 1 - sample @ sample[index])
+    return np.array(centroids, dtype=np.float32)
+
+
+def kmeans(vectors: np.ndarray, k: int, iterations: int = KMEANS_ITERATIONS,
+           seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Spherical k-means on unit-length rows. Returns (labels, centroids).
+    Empty clusters are reseeded with the rows farthest from their centroid.
+    """
+    k = max(1, min(k, len(vectors)))
+    rng = np.random.default_rng(seed)
+    centroids = _kmeans_plus_plus(vectors, k, rng)
+    labels = None
+    for _ in range(iterations):
+        new_labels, similarity = _assign(vectors, centroids)
+        if labels is not None and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        centroids, sizes = _centroids(vectors, labels, k)
+        empty = np.flatnonzero(sizes == 0)
+        if len(empty):
+            centroids[empty] = vectors[np.argsort(similarity)[:len(empty)]]
+    return labels, centroids
+
+
+def agglomerate(centroids: np.ndarray, k: int) -> np.ndarray:
+    """
+    Merges unit-length centroids bottom-up with average linkage until k groups
+    remain: two groups are as similar as the mean similarity between their
+    centroids, so a large group does not pull in its neighbours by size alone.
+    Returns the new cluster (0..k-1) of every input cluster.
+    """
+    groups = {index: [index] for index in range(len(centroids))}
+    similarity = (centroids @ centroids.T).astype(np.float64)
+    np.fill_diagonal(similarity, -np.inf)
+    while len(groups) > k:
+        a, b = np.unravel_index(np.argmax(similarity), similarity.shape)
+        a, b = min(a, b), max(a, b)
+        size_a, size_b = len(groups[a]), len(groups[b])
+        # Lance-Williams update for average linkage, weighted by centroids per group.
+        merged = (size_a * similarity[a] + size_b * similarity[b]) / (size_a + size_b)
+        groups[a].extend(groups.pop(b))
+        alive = np.array(sorted(groups))
+        similarity[a, alive] = similarity[alive, a] = merged[alive]
+        similarity[b, :] = similarity[:, b] = -np.inf
+        similarity[a, a] = -np.inf
+    mapping = np.empty(len(centroids), dtype=np.int64)
+    for new_label, members in enumerate(groups.values()):
+        mapping[members] = new_label
+    return mapping
+
+
+def cluster_vectors(vectors: np.ndarray, k: int, method: str = KMEANS_METHOD,
+                    seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Clusters unit-length rows into k clusters. Returns (labels, centroids), with
+    clusters numbered from largest to smallest.
+    """
+    if method == AGGLOMERATIVE_METHOD and len(vectors) > k:
+        labels, centroids = kmeans(vectors, k * OVERCLUSTER_FACTOR, seed=seed)
+        labels = agglomerate(centroids, k)[labels]
+    else:
+        labels, _ = kmeans(vectors, k, seed=seed)
+    k = labels.max() + 1
+    centroids, sizes = _centroids(vectors, labels, k)
+    rank = np.empty(k, dtype=np.int64)
+    rank[np.argsort(-sizes, kind="stable")] = np.arange(k)
+    return rank[labels], centroids[np.argsort(-sizes, kind="stable")]
+
+
+def cluster_exemplars(vectors: np.ndarray, labels: np.ndarray, centroids: np.ndarray,
+                      per_cluster: int = DEFAULT_EXEMPLARS) -> List[List[int]]:
+    """
+    Indices of the rows closest to each cluster's centroid, closest first.
+    """
+    exemplars = []
+    for cluster, centroid in enumerate(centroids):
+        members = np.flatnonzero(labels == cluster)
+        similarity = vectors[members] @ centroid
+        top = np.argsort(-similarity)[:per_cluster]
+        exemplars.append(members[top].tolist())
+    return exemplars
+
+
+def distinctive_terms(texts: Sequence[str], labels: np.ndarray, n_clusters: int,
+                      per_cluster: int = TERMS_PER_CLUSTER, seed: int = 0) -> List[List[str]]:
+    """
+    The terms most over-represented in each cluster (class-based TF-IDF over a sample).
+    """
+    rng = np.random.default_rng(seed)
+    counts: List[Counter] = []
+    for cluster in range(n_clusters):
+        members = np.flatnonzero(labels == cluster)
+        if len(members) > TERM_SAMPLE_SIZE:
+            members = rng.choice(members, TERM_SAMPLE_SIZE, replace=False)
+        counts.append(Counter(feature for index in members for feature in set(text_features(texts[index]))))
+    clusters_with_term = Counter(term for counter in counts for term in counter)
+    terms = []
+    for counter in counts:
+        total = sum(counter.values()) or 1
+        scored = sorted(counter, key=lambda term: -counter[term] / total
+                        * math.log(1 + n_clusters / clusters_with_term[term]))
+        terms.append(scored[:per_cluster])
+    return terms
+
+
+def build_theme_name_request(exemplars: Sequence[str], terms: Sequence[str], model_name: str) -> dict:
+    examples = "\n".join(f"- {text}" for text in exemplars)
+    return {
+        "model": model_name,
+        "messages": [
+            {"role": "system", "content": "You are a qualitative researcher naming themes in survey data."},
+            {"role": "user", "content": f"These responses were grouped together:\n{examples}\n\n"
+                                        f"Frequent terms: {', '.join(terms)}\n\n"
+                                        f"Name the theme they share and define it in one sentence."}
+        ],
+        "tools": [{"type": "function", "function": THEME_NAME_SCHEMA}],
+        "tool_choice": {"type": "function", "function": {"name": THEME_NAME_FUNCTION}}
+    }
+
+
+def parse_theme_name(function_args: str) -> Tuple[str, str]:
+    """
+    Returns the theme and definition of a name_theme call; raises ValueError if malformed.
+    """
+    named = json.loads(function_args)
+    if not isinstance(named, dict) or not str(named.get("theme", "")).strip():
+        raise ValueError("Theme name response has no theme")
+    return str(named["theme"]).strip(), str(named.get("definition", "")).strip()
+
+
+@dataclass
+class ClusterRun:
+    # The distinct texts that were embedded and their cluster (0 = largest).
+    texts: List[str]
+    labels: np.ndarray
+    # One row per cluster: Theme, Definition, Size, Terms, Examples.
+    clusters_df: pd.DataFrame
+    embed_seconds: float = 0.0
+    cluster_seconds: float = 0.0
+    name_seconds: float = 0.0
+    embedder_name: str = ""
+    # Clusters that could not be named by the model and fell back to their terms.
+    naming_failures: Dict[int, str] = field(default_factory=dict)
+
+    @property
+    def themebook_df(self) -> pd.DataFrame:
+        return self.clusters_df[["Theme", "Definition"]].copy()
+
+    def throughput(self) -> dict:
+        """
+        Texts per second for each stage.
+        """
+        n = len(self.texts)
+        return {"embed": n / self.embed_seconds if self.embed_seconds else float("inf"),
+                "cluster": n / self.cluster_seconds if self.cluster_seconds else float("inf")}
+
+
+def cluster_themes(
+    texts: Sequence[str],
+    embedder: Optional[Embedder] = None,
+    n_clusters: int = DEFAULT_CLUSTERS,
+    method: str = KMEANS_METHOD,
+    client=None,
+    model_name: str = "gpt-4o-mini",
+    exemplars_per_cluster: int = DEFAULT_EXEMPLARS,
+    seed: int = 0,
+    on_progress: Optional[ProgressCallback] = None,
+    store: Optional[EmbeddingStore] = None
+) -> ClusterRun:
+    """
+    Embeds texts, clusters them and proposes one theme per cluster. Without an
+    embedder, a HashedTfidfEmbedder fitted on texts is used. Themes are named by
+    the model when a client is given, otherwise from each cluster's terms.
+    With a store, only texts it does not hold yet are embedded.
+    """
+    texts = list(texts)
+    started = time.monotonic()
+    if embedder is None:
+        embedder = HashedTfidfEmbedder().fit(texts)
+    if store is not None:
+        vectors = store.embed(embedder, texts, on_progress)
+    else:
+        vectors = embed_texts(embedder, texts, on_progress)
+    embedded = time.monotonic()
+    labels, centroids = cluster_vectors(vectors, n_clusters, method, seed)
+    exemplars = cluster_exemplars(vectors, labels, centroids, exemplars_per_cluster)
+    terms = distinctive_terms(texts, labels, len(centroids), seed=seed)
+    clustered = time.monotonic()
+
+    sizes = np.bincount(labels, minlength=len(centroids))
+    run = ClusterRun(texts=texts, labels=labels, clusters_df=pd.DataFrame(), embedder_name=embedder.name,
+                     embed_seconds=embedded - started, cluster_seconds=clustered - embedded)
+    rows = []
+    for cluster, (members, cluster_terms) in enumerate(zip(exemplars, terms)):
+        examples = [texts[index] for index in members]
+        theme = " / ".join(cluster_terms[:3]).capitalize() or f"Cluster {cluster + 1}"
+        definition = f"Responses about {', '.join(cluster_terms)}."
+        if client is not None:
+            request = build_theme_name_request(examples, cluster_terms, model_name)
+            try:
+                arguments = cached_function_arguments(resilient_create(client), request, validate=parse_theme_name)
+                theme, definition = parse_theme_name(arguments)
+            except Exception as exc:
+                run.naming_failures[cluster] = str(exc)
+        rows.append({"Theme": theme, "Definition": definition, "Size": int(sizes[cluster]),
+                     "Terms": ", ".join(cluster_terms), "Examples": "\n".join(examples)})
+    run.clusters_df = pd.DataFrame(rows, columns=["Theme", "Definition", "Size", "Terms", "Examples"])
+    run.name_seconds = time.monotonic() - clustered
+    return run
+
+
+def response_texts(df: pd.DataFrame) -> Tuple[List[str], List[Tuple[int, str, str]], List[int]]:
+    """
+    The distinct non-trivial answers in df, every text cell, and the index of each
+    cell's answer in the distinct answers (TRIVIAL for trivial answers).
+    """
+    cells = list(iter_text_cells(df, ()))
+    plan = plan_dispatch([text for _, _, text in cells])
+    return list(plan.unique_texts), cells, list(plan.cell_to_unique)
+
+
+def code_texts(codebook_df: pd.DataFrame) -> List[str]:
+    """
+    'Code: definition' for every row of a codebook from the Generate Codebook page.
+    """
+    codes = codebook_df.iloc[:, 0].astype(str)
+    if codebook_df.shape[1] < 2:
+        return codes.tolist()
+    definitions = codebook_df.iloc[:, 1].fillna("").astype(str)
+    return [f"{code}: {definition}" if definition else code for code, definition in zip(codes, definitions)]
+
+
+def label_responses(df: pd.DataFrame, run: ClusterRun, cells: Sequence[Tuple[int, str, str]],
+                    cell_to_text: Sequence[int]) -> pd.DataFrame:
+    """
+    Returns df with a '<col>_theme' column holding the proposed theme of each answer.
+    """
+    text_themes = run.clusters_df["Theme"].to_numpy(dtype=object)[run.labels]
+    rows = np.fromiter((row_idx for row_idx, _, _ in cells), dtype=np.int64, count=len(cells))
+    col_names = pd.Series([col_name for _, col_name, _ in cells], dtype="object")
+    text_indices = np.asarray(cell_to_text, dtype=np.int64)
+    labeled = df.copy()
+    for col_name in col_names.unique():
+        selected = (col_names == col_name).to_numpy() & (text_indices != TRIVIAL)
+        values = np.full(len(df), "", dtype=object)
+        values[rows[selected]] = text_themes[text_indices[selected]]
+        labeled[f"{col_name}_theme"] = values
+    return labeled
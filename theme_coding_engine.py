@@ -0,0 +1,380 @@
+"""
+Concurrent theme coding engine.
+
+Codes many text cells against a theme book with bounded concurrency and
+requests-per-minute / tokens-per-minute limits. Throttled and transient
+failures are retried, and concurrency adapts to throttling (see
+rate_limit_controller). Usable from the Streamlit pages
+(via `code_cells`) and headlessly:
+
+    python theme_coding_engine.py data.csv themebook.csv coded.csv --concurrency 16
+
+With pack_size > 1 several cells share one request (see theme_packing); cells
+missing or malformed in a packed response are retried one by one. With a run_id,
+every coded cell is journaled as it completes (see run_journal) and a rerun with
+the same run_id only codes what is left.
+"""
+import argparse
+import asyncio
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import pandas as pd
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+
+from answer_preprocessing import DEFAULT_TRIVIAL_PATTERNS, plan_dispatch, zero_themes
+from llm_cache import LLMCache, extract_function_arguments, get_default_cache, make_cache_key
+from rate_limit_controller import AdaptiveRateController
+from run_journal import RunJournal, item_key, settings_context
+from survey_cells import iter_text_cells
+from response_modes import FULL_MODE, RESPONSE_MODES, get_response_mode
+from theme_packing import expected_output_tokens, pack_cells, parse_packed_results
+from theme_prompts import validate_themes
+from theme_results import MERGED_VIEW, PER_COLUMN_VIEW, ThemeResultStore
+from themebook import CompiledThemebook, compile_themebook
+from token_counting import estimate_message_tokens
+
+RATE_WINDOW_SECONDS = 60.0
+ProgressCallback = Callable[[int, int], None]
+
+
+@dataclass
+class EngineConfig:
+    model_name: str = "gpt-4o-mini"
+    # Upper bound; the rate controller lowers it while the API is throttling.
+    max_concurrency: int = 8
+    requests_per_minute: int = 500
+    tokens_per_minute: int = 200_000
+    base_url: Optional[str] = None
+    # Maximum cells per request; 1 sends every cell on its own.
+    pack_size: int = 1
+    use_cache: bool = True
+    # Answers that normalize to the same text share one request.
+    deduplicate: bool = True
+    # Regexes for answers that resolve to all-zero codes without a request.
+    trivial_patterns: List[str] = field(default_factory=lambda: list(DEFAULT_TRIVIAL_PATTERNS))
+    # Journal completed cells under this id and skip cells it already holds.
+    run_id: Optional[str] = None
+    # Attempts per request on 429s, transient 5xx errors and connection failures.
+    max_retries: int = 6
+    # Output format the model uses (see response_modes); sparse modes cut completion tokens.
+    response_mode: str = FULL_MODE
+
+
+@dataclass
+class CodingRun:
+    """
+    Results of a run, index-aligned with the input cells.
+    Failed cells have a result of None and an entry in failures.
+    """
+    results: List[Optional[List[dict]]]
+    failures: Dict[int, str] = field(default_factory=dict)
+    elapsed_seconds: float = 0.0
+    request_count: int = 0
+    cache_hits: int = 0
+    # Cells resolved by preprocessing (trivial answers and duplicates) rather than a request.
+    calls_saved: int = 0
+    # Cells restored from the run journal.
+    resumed: int = 0
+    # Achieved requests/tokens per minute, final concurrency, throttles and retries.
+    rate_stats: dict = field(default_factory=dict)
+    # One entry per API request: cells, latency_seconds, prompt_tokens, completion_tokens.
+    request_metrics: List[dict] = field(default_factory=list)
+
+    def metrics_summary(self) -> dict:
+        """
+        Per-cell latency and token averages over the requests sent to the API.
+        """
+        cells = sum(m["cells"] for m in self.request_metrics)
+        if not cells:
+            return {}
+        return {
+            "requests": len(self.request_metrics),
+            "cells": cells,
+            "seconds_per_cell": sum(m["latency_seconds"] for m in self.request_metrics) / cells,
+            "prompt_tokens_per_cell": sum(m["prompt_tokens"] for m in self.request_metrics) / cells,
+            "completion_tokens_per_cell": sum(m["completion_tokens"] for m in self.request_metrics) / cells,
+        }
+
+
+class RateLimiter:
+    """
+    Sliding one-minute window limiting both request count and token volume.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._window = deque()  # (timestamp, tokens)
+        self._window_tokens = 0
+        self._lock = asyncio.Lock()
+
+    def _purge(self, now: float):
+        while self._window and now - self._window[0][0] >= RATE_WINDOW_SECONDS:
+            _, tokens = self._window.popleft()
+            self._window_tokens -= tokens
+
+    def _has_capacity(self, tokens: int) -> bool:
+        if not self._window:
+            # A single oversized request must still be allowed through.
+            return True
+        return (len(self._window) < self.requests_per_minute
+                and self._window_tokens + tokens <= self.tokens_per_minute)
+
+    async def acquire(self, tokens: int):
+        """
+        Waits until a request of the given token size fits in the window, then records it.
+        """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._purge(now)
+                if self._has_capacity(tokens):
+                    self._window.append((now, tokens))
+                    self._window_tokens += tokens
+                    return
+                await asyncio.sleep(RATE_WINDOW_SECONDS - (now - self._window[0][0]))
+
+
+async def request_function_arguments(
+    client: AsyncOpenAI,
+    request: dict,
+    expected_completion_tokens: int,
+    controller: AdaptiveRateController,
+    limiter: RateLimiter
+) -> Tuple[str, dict]:
+    """
+    Returns the function call arguments and the request's latency and token usage.
+    """
+    await limiter.acquire(estimate_message_tokens(request["messages"]) + expected_completion_tokens)
+    started = time.monotonic()
+    response = await controller.call_async(client.chat.completions.with_raw_response.create, request)
+    usage = response.usage
+    metrics = {
+        "latency_seconds": time.monotonic() - started,
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+    }
+    return extract_function_arguments(response), metrics
+
+
+async def code_cells_async(
+    texts: Sequence[str],
+    themebook: Union[pd.DataFrame, CompiledThemebook],
+    openai_api_key: str,
+    config: Optional[EngineConfig] = None,
+    on_progress: Optional[ProgressCallback] = None
+) -> CodingRun:
+    """
+    Codes every text concurrently and returns the results in input order.
+    A failing cell is recorded in CodingRun.failures instead of aborting the run.
+    """
+    config = config or EngineConfig()
+    # Retries are left to the controller so it sees every throttling response.
+    client = AsyncOpenAI(api_key=openai_api_key, base_url=config.base_url, max_retries=0)
+    controller = AdaptiveRateController(
+        initial_concurrency=config.max_concurrency,
+        max_concurrency=config.max_concurrency,
+        max_retries=config.max_retries
+    )
+    limiter = RateLimiter(config.requests_per_minute, config.tokens_per_minute)
+    cache: Optional[LLMCache] = get_default_cache() if config.use_cache else None
+    compiled = compile_themebook(themebook)
+    mode = get_response_mode(config.response_mode)
+    single_prompt = compiled.prompt(mode.name)
+    packed_prompt = compiled.prompt(mode.name, packed=True)
+    run = CodingRun(results=[None] * len(texts))
+    completed = 0
+    started = time.monotonic()
+
+    journal = RunJournal(config.run_id) if config.run_id else None
+    context = settings_context(labels=compiled.labels, definitions=compiled.definitions, mode=mode.name,
+                               model=config.model_name) if journal else ""
+    keys = [item_key(text, context) for text in texts] if journal else []
+    if journal:
+        journaled = journal.completed()
+        for index, key in enumerate(keys):
+            if key in journaled:
+                run.results[index] = journaled[key]
+                run.resumed += 1
+    pending = [index for index, result in enumerate(run.results) if result is None]
+
+    def store(index: int, themes: List[dict]):
+        run.results[index] = themes
+        if journal:
+            journal.record(keys[index], themes)
+
+    async def request(prompt, messages, cell_count, parse: Callable[[str], Any]):
+        """
+        Returns parse(arguments) for the request. parse raises on a malformed
+        payload, which is then neither cached nor served from the cache.
+        """
+        request = {"model": config.model_name, "messages": messages, "tools": prompt.tools,
+                   "tool_choice": prompt.tool_choice}
+        key = make_cache_key(request) if cache else None
+        cached = cache.get_valid(key, parse) if cache else None
+        if cached is not None:
+            run.cache_hits += 1
+            return parse(cached)
+        run.request_count += 1
+        arguments, metrics = await request_function_arguments(
+            client, request, expected_output_tokens(cell_count, len(compiled.labels), mode), controller, limiter
+        )
+        run.request_metrics.append({"cells": cell_count, **metrics})
+        result = parse(arguments)
+        if cache:
+            cache.put(key, arguments)
+        return result
+
+    def mark_done(count: int):
+        nonlocal completed
+        completed += count
+        if on_progress:
+            on_progress(completed, len(texts))
+
+    async def code_cell(index: int):
+        try:
+            themes = await request(single_prompt, single_prompt.messages(texts[index]), 1,
+                                   lambda arguments: validate_themes(arguments, mode.name, compiled.labels))
+            store(index, themes)
+        except Exception as exc:
+            run.failures[index] = str(exc)
+        mark_done(1)
+
+    def parse_pack(arguments: str, cell_ids: List[str]) -> Dict[str, List[dict]]:
+        packed_results = parse_packed_results(arguments, cell_ids, compiled.labels, mode)
+        if not packed_results:
+            raise ValueError("Packed response contained no well-formed results")
+        return packed_results
+
+    async def code_pack(pack: List[Tuple[str, str]]):
+        cell_ids = [cell_id for cell_id, _ in pack]
+        try:
+            packed_results = await request(packed_prompt, packed_prompt.packed_messages(pack), len(pack),
+                                           lambda arguments: parse_pack(arguments, cell_ids))
+        except Exception:
+            packed_results = {}
+        for cell_id, themes in packed_results.items():
+            store(int(cell_id), themes)
+        mark_done(len(packed_results))
+        await asyncio.gather(*(code_cell(int(cell_id)) for cell_id in cell_ids if cell_id not in packed_results))
+
+    if config.pack_size > 1:
+        packs = pack_cells([(str(i), texts[i]) for i in pending], packed_prompt.token_count,
+                           len(compiled.labels), config.model_name, config.pack_size, mode)
+        work = [code_pack(pack) for pack in packs]
+    else:
+        work = [code_cell(i) for i in pending]
+
+    if run.resumed:
+        mark_done(run.resumed)
+    try:
+        await asyncio.gather(*work)
+    finally:
+        await client.close()
+        if journal:
+            journal.close()
+    run.elapsed_seconds = time.monotonic() - started
+    run.rate_stats = controller.stats()
+    return run
+
+
+def code_cells(
+    texts: Sequence[str],
+    themebook: Union[pd.DataFrame, CompiledThemebook],
+    openai_api_key: str,
+    config: Optional[EngineConfig] = None,
+    on_progress: Optional[ProgressCallback] = None
+) -> CodingRun:
+    """
+    Blocking wrapper around code_cells_async for Streamlit pages and scripts.
+    """
+    return asyncio.run(code_cells_async(texts, themebook, openai_api_key, config, on_progress))
+
+
+def theme_code_dataframe(
+    df: pd.DataFrame,
+    themebook: Union[pd.DataFrame, CompiledThemebook],
+    openai_api_key: str,
+    config: Optional[EngineConfig] = None,
+    on_progress: Optional[ProgressCallback] = None,
+    view: str = MERGED_VIEW
+) -> Tuple[pd.DataFrame, CodingRun]:
+    """
+    Codes every non-empty text cell in df and adds a 0/1 column and a
+    justification column per theme. Trivial and duplicate answers are
+    resolved by answer_preprocessing instead of separate requests.
+    view selects OR-merged theme columns or one set per source column (see theme_results).
+    Returns the coded DataFrame and the run (for failures and timing).
+    """
+    compiled = compile_themebook(themebook)
+    cells = list(iter_text_cells(df, compiled.labels))
+    config = config or EngineConfig()
+    plan = plan_dispatch([text for _, _, text in cells], config.trivial_patterns, config.deduplicate)
+    run = code_cells(plan.unique_texts, compiled, openai_api_key, config, on_progress)
+    run.calls_saved = plan.calls_saved
+
+    store = ThemeResultStore([(row_idx, col_name) for row_idx, col_name, _ in cells], compiled)
+    for cell_idx, themes_result in enumerate(plan.fan_out(run.results, zero_themes(compiled.labels))):
+        store.record(cell_idx, themes_result)
+    coded_df = store.to_dataframe(df, view)
+
+    return coded_df, run
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Theme-code a survey CSV without the Streamlit UI.")
+    parser.add_argument("data_csv")
+    parser.add_argument("themebook_csv", help="CSV with 'theme' and 'definition' columns")
+    parser.add_argument("output_csv")
+    parser.add_argument("--model", default=EngineConfig.model_name)
+    parser.add_argument("--concurrency", type=int, default=EngineConfig.max_concurrency)
+    parser.add_argument("--rpm", type=int, default=EngineConfig.requests_per_minute)
+    parser.add_argument("--tpm", type=int, default=EngineConfig.tokens_per_minute)
+    parser.add_argument("--pack-size", type=int, default=EngineConfig.pack_size, help="Maximum cells per request")
+    parser.add_argument("--per-column", action="store_true",
+                        help="Write theme columns per source column instead of OR-merging them")
+    parser.add_argument("--response-mode", choices=list(RESPONSE_MODES), default=FULL_MODE,
+                        help="Output format; 'present' and 'boolean' return far fewer tokens than 'full'")
+    parser.add_argument("--run-id", default=None,
+                        help="Journal progress under this id; rerunning with the same id resumes the run")
+    parser.add_argument("--no-cache", action="store_true", help="Always call the API, ignoring cached responses")
+    parser.add_argument("--base-url", default=None, help="Alternative chat completions endpoint, e.g. a local mock server")
+    args = parser.parse_args()
+    load_dotenv()
+
+    config = EngineConfig(
+        model_name=args.model,
+        max_concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        base_url=args.base_url,
+        pack_size=args.pack_size,
+        use_cache=not args.no_cache,
+        run_id=args.run_id,
+        response_mode=args.response_mode
+    )
+    coded_df, run = theme_code_dataframe(
+        pd.read_csv(args.data_csv),
+        pd.read_csv(args.themebook_csv),
+        os.getenv("OPENAI_API_KEY", ""),
+        config,
+        on_progress=lambda done, total: print(f"\r{done}/{total} cells coded", end="", flush=True),
+        view=PER_COLUMN_VIEW if args.per_column else MERGED_VIEW
+    )
+    print()
+    coded_df.to_csv(args.output_csv, index=False)
+    print(f"Coded {len(run.results) - len(run.failures)} unique answers with {run.request_count} requests "
+          f"and {run.cache_hits} cache hits, {run.calls_saved} calls saved by deduplication, "
+          f"{run.resumed} resumed from the journal "
+          f"in {run.elapsed_seconds:.1f}s ({len(run.failures)} failed)")
+    print(f"Rate stats: {run.rate_stats}")
+    print(f"Per-cell metrics: {run.metrics_summary()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""
+Map-reduce theme generation for surveys larger than one prompt.
+
+The unique answers are split into token-budgeted chunks, and themes are
+proposed for every chunk concurrently (map). The proposals are then merged
+hierarchically (reduce): candidate lists are near-duplicate-merged locally
+(see code_canonicalization), packed into prompts that fit the budget, and
+merged by the model, level by level, until one theme set remains.
+A chunk whose request fails is left out and reported rather than failing
+the run; a reduce group that fails keeps its locally merged candidates.
+"""
+import asyncio
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import pandas as pd
+from openai import AsyncOpenAI
+
+from answer_preprocessing import plan_dispatch
+from code_canonicalization import CodeCanonicalizer
+from llm_cache import LLMCache, get_default_cache, make_cache_key
+from rate_limit_controller import AdaptiveRateController
+from survey_cells import iter_text_cells
+from theme_coding_engine import EngineConfig, RateLimiter, request_function_arguments
+from token_counting import TokenCounter, get_token_counter
+
+THEME_SET_SCHEMA_PATH = "analyse_themes_from_data.json"
+THEME_SET_FUNCTION_NAME = "analyse_themes_from_data"
+MAP_SYSTEM_PROMPT = "You are a qualitative researcher identifying themes in survey responses."
+REDUCE_INSTRUCTION = (
+    "These candidate themes were proposed from different parts of the same survey. "
+    "Merge them into one theme set: combine themes that mean the same thing, keep distinct ones, "
+    "and keep the set concise."
+)
+# Prompt tokens per map chunk and per reduce request.
+DEFAULT_CHUNK_TOKENS = 8000
+# Rough completion size of a theme set, used to reserve tokens-per-minute capacity.
+EXPECTED_THEME_SET_TOKENS = 600
+
+
+@dataclass
+class MapReduceResult:
+    codes: List[str]
+    message: str
+    chunk_count: int
+    # Number of reduce levels run; 0 when the data fit in one chunk.
+    reduce_levels: int
+    request_count: int
+    cache_hits: int
+    elapsed_seconds: float
+    # Map chunks whose themes could not be proposed, by chunk index.
+    failures: Dict[int, str] = field(default_factory=dict)
+    # Reduce groups that failed and were merged locally instead.
+    reduce_failures: int = 0
+
+
+def load_theme_set_schema(path: str = THEME_SET_SCHEMA_PATH) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def parse_theme_set(function_args: str) -> Tuple[List[str], str]:
+    """
+    Returns the codes and message of a theme set function call; raises ValueError if malformed.
+    """
+    parsed = json.loads(function_args)
+    if not isinstance(parsed, dict) or not isinstance(parsed.get("codes"), list):
+        raise ValueError("Theme set response has no list of codes")
+    return [str(code).strip() for code in parsed["codes"] if str(code).strip()], str(parsed.get("message", ""))
+
+
+def chunk_texts(texts: Sequence[str], budget_tokens: int, count_tokens: TokenCounter) -> List[List[str]]:
+    """
+    Splits texts, in order, into chunks whose combined token count stays within budget_tokens.
+    A text larger than the budget gets a chunk of its own.
+    """
+    chunks, current, current_tokens = [], [], 0
+    for text in texts:
+        tokens = count_tokens(text) + 2
+        if current and current_tokens + tokens > budget_tokens:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def build_map_messages(user_input: str, answers: Sequence[str]) -> List[dict]:
+    responses = "\n".join(f"- {' '.join(str(answer).split())}" for answer in answers)
+    return [
+        {"role": "system", "content": MAP_SYSTEM_PROMPT},
+        {"role": "user", "content": f"{user_input}\n\nThese are {len(answers)} of the survey responses to be coded:\n\n{responses}"}
+    ]
+
+
+def build_reduce_messages(user_input: str, candidate_codes: Sequence[str]) -> List[dict]:
+    candidates = "\n".join(f"- {code}" for code in candidate_codes)
+    return [
+        {"role": "system", "content": MAP_SYSTEM_PROMPT},
+        {"role": "user", "content": f"{user_input}\n\n{REDUCE_INSTRUCTION}\n\nCandidate themes:\n{candidates}"}
+    ]
+
+
+def dedupe_codes(code_lists: Sequence[Sequence[str]]) -> List[str]:
+    """
+    Flattens candidate theme lists, merging near-duplicate spellings locally before the model sees them.
+    """
+    canonicalizer = CodeCanonicalizer()
+    return list(dict.fromkeys(canonicalizer.canonical(code) for codes in code_lists for code in codes))
+
+
+def group_code_lists(code_lists: List[List[str]], budget_tokens: int, count_tokens: TokenCounter) -> List[List[List[str]]]:
+    """
+    Packs theme lists into reduce groups within budget_tokens, with at least two lists per group
+    so every level shrinks the number of lists.
+    """
+    groups, current, current_tokens = [], [], 0
+    for codes in code_lists:
+        tokens = sum(count_tokens(code) + 2 for code in codes)
+        if len(current) >= 2 and current_tokens + tokens > budget_tokens:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(codes)
+        current_tokens += tokens
+    if current:
+        if len(current) == 1 and groups:
+            groups[-1].extend(current)
+        else:
+            groups.append(current)
+    return groups
+
+
+async def generate_theme_set_async(
+    survey_data: pd.DataFrame,
+    openai_api_key: str,
+    user_input: str = "Generate an initial theme set",
+    config: Optional[EngineConfig] = None,
+    chunk_tokens: int = DEFAULT_CHUNK_TOKENS,
+    schema: Optional[dict] = None
+) -> MapReduceResult:
+    """
+    Proposes a theme set for every answer in survey_data, however large, with map-reduce.
+    """
+    config = config or EngineConfig(model_name="gpt-4o")
+    schema = schema or load_theme_set_schema()
+    count_tokens = get_token_counter(config.model_name)
+    client = AsyncOpenAI(api_key=openai_api_key, base_url=config.base_url, max_retries=0)
+    controller = AdaptiveRateController(
+        initial_concurrency=config.max_concurrency,
+        max_concurrency=config.max_concurrency,
+        max_retries=config.max_retries
+    )
+    limiter = RateLimiter(config.requests_per_minute, config.tokens_per_minute)
+    cache: Optional[LLMCache] = get_default_cache() if config.use_cache else None
+    counts = {"requests": 0, "cache_hits": 0}
+    started = time.monotonic()
+
+    async def propose(messages: List[dict]) -> Tuple[List[str], str]:
+        request = {
+            "model": config.model_name,
+            "messages": messages,
+            "tools": [{"type": "function", "function": schema}],
+            "tool_choice": {"type": "function", "function": {"name": THEME_SET_FUNCTION_NAME}}
+        }
+        key = make_cache_key(request) if cache else None
+        arguments = cache.get_valid(key, parse_theme_set) if cache else None
+        if arguments is None:
+            counts["requests"] += 1
+            arguments, _ = await request_function_arguments(client, request, EXPECTED_THEME_SET_TOKENS,
+                                                            controller, limiter)
+            # Parsed before caching, so a malformed response is requested again next time.
+            result = parse_theme_set(arguments)
+            if cache:
+                cache.put(key, arguments)
+            return result
+        counts["cache_hits"] += 1
+        return parse_theme_set(arguments)
+
+    failures: Dict[int, str] = {}
+    reduce_failures = 0
+
+    async def propose_chunk(chunk_idx: int, chunk: List[str]) -> Optional[Tuple[List[str], str]]:
+        try:
+            return await propose(build_map_messages(user_input, chunk))
+        except Exception as exc:
+            failures[chunk_idx] = str(exc)
+            return None
+
+    async def reduce_group(group: List[List[str]]) -> Tuple[List[str], str]:
+        nonlocal reduce_failures
+        candidates = dedupe_codes(group)
+        try:
+            return await propose(build_reduce_messages(user_input, candidates))
+        except Exception:
+            reduce_failures += 1
+            return candidates, ""
+
+    cells = list(iter_text_cells(survey_data, ()))
+    plan = plan_dispatch([text for _, _, text in cells], config.trivial_patterns)
+    chunks = chunk_texts(plan.unique_texts, chunk_tokens, count_tokens)
+    levels = 0
+    try:
+        proposals = await asyncio.gather(*(propose_chunk(i, chunk) for i, chunk in enumerate(chunks)))
+        proposals = [proposal for proposal in proposals if proposal is not None]
+        code_lists = [codes for codes, _ in proposals]
+        message = proposals[0][1] if proposals else ""
+        while len(code_lists) > 1:
+            levels += 1
+            groups = group_code_lists(code_lists, chunk_tokens, count_tokens)
+            reduced = await asyncio.gather(*(reduce_group(group) for group in groups))
+            code_lists = [codes for codes, _ in reduced]
+            message = reduced[-1][1] or message
+    finally:
+        await client.close()
+
+    return MapReduceResult(
+        codes=code_lists[0] if code_lists else [],
+        message=message,
+        chunk_count=len(chunks),
+        reduce_levels=levels,
+        request_count=counts["requests"],
+        cache_hits=counts["cache_hits"],
+        elapsed_seconds=time.monotonic() - started,
+        failures=failures,
+        reduce_failures=reduce_failures
+    )
+
+
+def generate_theme_set(
+    survey_data: pd.DataFrame,
+    openai_api_key: str,
+    user_input: str = "Generate an initial theme set",
+    config: Optional[EngineConfig] = None,
+    chunk_tokens: int = DEFAULT_CHUNK_TOKENS
+) -> MapReduceResult:
+    """
+    Blocking wrapper around generate_theme_set_async for Streamlit pages and scripts.
+    """
+    return asyncio.run(generate_theme_set_async(survey_data, openai_api_key, user_input, config, chunk_tokens))
@@ -0,0 +1,153 @@
+"""
+Packs many cells into one theme coding request.
+
+The theme book and instructions are sent once per pack; each cell carries a
+stable id (its index in the run) and the model returns one result per id.
+Pack sizes adapt to the model's context window and output-token limit.
+"""
+import json
+from typing import Dict, List, Sequence, Tuple
+
+from response_modes import FULL_MODE, RESPONSE_MODES, ResponseMode, expected_result_tokens
+from token_counting import estimate_tokens
+
+PACKED_FUNCTION_NAME = "extract_themes_from_texts"
+
+PACKED_TOOL_CHOICE = {"type": "function", "function": {"name": PACKED_FUNCTION_NAME}}
+
+# (context window, max output tokens) per model; unknown models use DEFAULT_MODEL_LIMITS.
+MODEL_LIMITS = {
+    "gpt-4o-mini": (128_000, 16_384),
+    "gpt-4o": (128_000, 16_384),
+    "gpt-4": (8_192, 4_096),
+    "claude-3-haiku-20240307": (200_000, 4_096),
+}
+DEFAULT_MODEL_LIMITS = (8_192, 4_096)
+
+# Tokens for a cell's id and its {"id", "text"} / {"id", ...} wrapper.
+TOKENS_PER_CELL_ID = 10
+# Fraction of the output limit we plan to use, leaving room for verbose justifications.
+OUTPUT_BUDGET_FRACTION = 0.7
+DEFAULT_MAX_PACK_SIZE = 20
+
+PackedCell = Tuple[str, str]  # (cell id, text)
+
+
+def get_model_limits(model_name: str) -> Tuple[int, int]:
+    return MODEL_LIMITS.get(model_name, DEFAULT_MODEL_LIMITS)
+
+
+def build_packed_output_instructions(mode: ResponseMode) -> str:
+    return f"""You will be given several texts as a JSON list of {{"id", "text"}} objects.
+Code each text independently against the theme book.
+
+Return JSON as {{"results": [...]}} with one entry per text. Each entry has the text's "id"
+plus the fields of this per-text structure:
+{mode.example}
+{mode.instructions}
+Return exactly one result per text id."""
+
+
+def build_packed_function_schema(theme_labels: Sequence[str], mode: ResponseMode) -> dict:
+    properties = {
+        "id": {
+            "type": "string",
+            "description": "The id of the text this result belongs to."
+        },
+        **mode.build_properties(theme_labels)
+    }
+    return {
+        "name": PACKED_FUNCTION_NAME,
+        "description": "Given several texts, identify for each text which themes in the theme book apply.",
+        "strict": True,
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "results": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": properties,
+                        "required": list(properties),
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["results"],
+            "additionalProperties": False
+        }
+    }
+
+
+def build_packed_text_message(cells: Sequence[PackedCell]) -> str:
+    return json.dumps([{"id": cell_id, "text": text} for cell_id, text in cells], ensure_ascii=False)
+
+
+def expected_output_tokens(cell_count: int, theme_count: int, mode: ResponseMode) -> int:
+    return cell_count * (TOKENS_PER_CELL_ID + expected_result_tokens(mode, theme_count))
+
+
+def parse_packed_results(
+    function_args: str,
+    expected_ids: Sequence[str],
+    theme_labels: Sequence[str],
+    mode: ResponseMode
+) -> Dict[str, List[dict]]:
+    """
+    Returns the full theme list for every expected id that came back complete and well formed.
+    Ids that are missing, duplicated or malformed are left out so the caller can retry them.
+    """
+    try:
+        parsed = json.loads(function_args)
+    except (TypeError, ValueError):
+        return {}
+    results = parsed.get("results") if isinstance(parsed, dict) else None
+    if not isinstance(results, list):
+        return {}
+
+    expected = set(expected_ids)
+    valid, duplicated = {}, set()
+    for item in results:
+        if not isinstance(item, dict):
+            continue
+        cell_id = str(item.get("id", ""))
+        themes = mode.to_themes(item, theme_labels) if cell_id in expected else None
+        if themes is None:
+            continue
+        if cell_id in valid:
+            duplicated.add(cell_id)
+        valid[cell_id] = themes
+    return {cell_id: themes for cell_id, themes in valid.items() if cell_id not in duplicated}
+
+
+def pack_cells(
+    cells: Sequence[PackedCell],
+    prefix_tokens: int,
+    theme_count: int,
+    model_name: str,
+    max_pack_size: int = DEFAULT_MAX_PACK_SIZE,
+    mode: ResponseMode = RESPONSE_MODES[FULL_MODE]
+) -> List[List[PackedCell]]:
+    """
+    Greedily groups consecutive cells into packs that fit the model's context
+    window and output-token limit, with at most max_pack_size cells each.
+    prefix_tokens is the size of the shared system message and tool schema.
+    """
+    context_window, max_output = get_model_limits(model_name)
+    output_budget = int(max_output * OUTPUT_BUDGET_FRACTION)
+    input_budget = context_window - max_output - prefix_tokens
+
+    packs, current, current_tokens = [], [], 0
+    for cell_id, text in cells:
+        cell_tokens = estimate_tokens(text) + TOKENS_PER_CELL_ID
+        fits = (len(current) < max_pack_size
+                and current_tokens + cell_tokens <= input_budget
+                and expected_output_tokens(len(current) + 1, theme_count, mode) <= output_budget)
+        if current and not fits:
+            packs.append(current)
+            current, current_tokens = [], 0
+        current.append((cell_id, text))
+        current_tokens += cell_tokens
+    if current:
+        packs.append(current)
+    return packs
@@ -0,0 +1,87 @@
+import json
+from typing import List, Sequence
+
+from response_modes import FULL_MODE, ResponseMode, get_response_mode
+
+THEME_SYSTEM_PROMPT = "You are a helpful theme identification assistant."
+
+THEME_FUNCTION_NAME = "extract_themes_from_text"
+
+THEME_TOOL_CHOICE = {"type": "function", "function": {"name": THEME_FUNCTION_NAME}}
+
+
+def build_output_instructions(mode: ResponseMode) -> str:
+    return f"Return JSON in this structure:\n{mode.example}\n{mode.instructions}"
+
+
+def build_theme_function_schema(theme_labels: Sequence[str], mode: ResponseMode) -> dict:
+    properties = mode.build_properties(theme_labels)
+    return {
+        "name": THEME_FUNCTION_NAME,
+        "description": "Given a text, identify which themes in the theme book apply.",
+        "strict": True,
+        "parameters": {
+            "type": "object",
+            "properties": properties,
+            "required": list(properties),
+            "additionalProperties": False
+        }
+    }
+
+
+def render_theme_lines(theme_labels: Sequence[str], theme_definitions: Sequence[str]) -> str:
+    """
+    Renders the theme book as one "- label: definition" line per theme.
+    """
+    return "\n".join(f"- {label}: {definition}" for label, definition in zip(theme_labels, theme_definitions))
+
+
+def build_system_message(themes_str: str, output_instructions: str) -> str:
+    """
+    Everything that is the same for every cell, so all requests share a
+    byte-identical prefix that the provider can prompt-cache.
+    """
+    return f"""{THEME_SYSTEM_PROMPT}
+
+You have a theme book containing:
+{themes_str}
+
+{output_instructions}"""
+
+
+def build_text_message(text: str) -> str:
+    return f"Text to analyze:\n{text}"
+
+
+def validate_themes(function_args: str, mode_name: str = FULL_MODE, theme_labels: Sequence[str] = ()) -> List[dict]:
+    """
+    Like parse_themes, but raises ValueError for a payload that is not valid JSON or
+    does not report every theme (see ResponseMode.to_themes) instead of returning [].
+    """
+    try:
+        parsed = json.loads(function_args)
+    except (TypeError, ValueError):
+        raise ValueError("Function call arguments are not valid JSON")
+    themes = get_response_mode(mode_name).to_themes(parsed, theme_labels) if isinstance(parsed, dict) else None
+    if themes is None:
+        raise ValueError(f"Function call arguments are not a well-formed {mode_name} result")
+    return themes
+
+
+def parse_themes(function_args: str, mode_name: str = FULL_MODE, theme_labels: Sequence[str] = ()) -> List[dict]:
+    """
+    Parses the function call arguments into a list of
+    { "label": ..., "value": 0 or 1, "justification": ... } objects.
+    Sparse modes are expanded to every theme in theme_labels.
+    Returns an empty list if the payload is not valid JSON.
+    """
+    try:
+        parsed = json.loads(function_args)
+    except (TypeError, ValueError):
+        return []
+    if not isinstance(parsed, dict):
+        return []
+    if mode_name == FULL_MODE:
+        themes = parsed.get("themes", [])
+        return themes if isinstance(themes, list) else []
+    return get_response_mode(mode_name).to_themes(parsed, theme_labels) or []
@@ -0,0 +1,122 @@
+"""
+Columnar store for theme coding results.
+
+Presence is kept in an int8 matrix of shape (cells, themes) and justifications
+as ids into an interned string table, so recording a result never touches
+pandas. The coded DataFrame is assembled in one step at the end, either with
+one set of theme columns per source column or OR-merged across columns.
+"""
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from themebook import CompiledThemebook
+
+MERGED_VIEW = "merged"
+PER_COLUMN_VIEW = "per_column"
+
+CellRef = Tuple[int, str]  # (row_idx, col_name)
+
+
+class ThemeResultStore:
+    def __init__(self, cells: Sequence[CellRef], themebook: CompiledThemebook):
+        self.themebook = themebook
+        self.row_idx = np.array([row for row, _ in cells], dtype=np.int64)
+        self.col_names = [col for _, col in cells]
+        self.presence = np.zeros((len(cells), len(themebook.labels)), dtype=np.int8)
+        self.justification_ids = np.zeros((len(cells), len(themebook.labels)), dtype=np.int32)
+        self._strings: List[str] = [""]
+        self._string_ids: Dict[str, int] = {"": 0}
+
+    def _intern(self, text: str) -> int:
+        string_id = self._string_ids.get(text)
+        if string_id is None:
+            string_id = len(self._strings)
+            self._strings.append(text)
+            self._string_ids[text] = string_id
+        return string_id
+
+    def record(self, cell_idx: int, themes: Optional[List[dict]]):
+        """
+        Stores one cell's [{label, value, justification}, ...] result; unknown labels are ignored.
+        """
+        label_index = self.themebook.label_index
+        for t_obj in themes or []:
+            theme_idx = label_index.get(str(t_obj.get("label", "")).strip())
+            if theme_idx is None:
+                continue
+            self.presence[cell_idx, theme_idx] = 1 if t_obj.get("value") == 1 else 0
+            self.justification_ids[cell_idx, theme_idx] = self._intern(str(t_obj.get("justification", "")).strip())
+
+    def take(self, rows: np.ndarray, cells: Sequence[CellRef]) -> "ThemeResultStore":
+        """
+        Returns a store for cells whose results are the given rows of this store,
+        e.g. to fan results per unique answer out to every cell in one step.
+        """
+        taken = ThemeResultStore(cells, self.themebook)
+        taken.presence = self.presence[rows]
+        taken.justification_ids = self.justification_ids[rows]
+        taken._strings = self._strings
+        taken._string_ids = self._string_ids
+        return taken
+
+    def _justifications(self, ids: np.ndarray) -> np.ndarray:
+        return np.asarray(self._strings, dtype=object)[ids]
+
+    def _theme_frame(self, presence: np.ndarray, justification_ids: np.ndarray, prefix: str = "") -> pd.DataFrame:
+        justifications = self._justifications(justification_ids)
+        columns = {}
+        for theme_idx, label in enumerate(self.themebook.labels):
+            columns[f"{prefix}{label}"] = presence[:, theme_idx]
+            columns[f"{prefix}{label}_justification"] = justifications[:, theme_idx]
+        return pd.DataFrame(columns)
+
+    def merged_view(self, n_rows: int) -> pd.DataFrame:
+        """
+        One 0/1 and justification column per theme; a theme is present in a row
+        if it is present in any of the row's cells, and a present cell's
+        justification is preferred.
+        """
+        theme_count = len(self.themebook.labels)
+        presence = np.zeros((n_rows, theme_count), dtype=np.int8)
+        np.maximum.at(presence, self.row_idx, self.presence)
+
+        justification_ids = np.zeros((n_rows, theme_count), dtype=np.int32)
+        # Where no cell has the theme, the row's first cell's justification is kept.
+        rows, first_cells = np.unique(self.row_idx, return_index=True)
+        justification_ids[rows] = self.justification_ids[first_cells]
+        # Otherwise the first present cell's, assigned once per (row, theme).
+        cell_idx, theme_idx = np.nonzero(self.presence)
+        _, first_present = np.unique(self.row_idx[cell_idx] * theme_count + theme_idx, return_index=True)
+        cell_idx, theme_idx = cell_idx[first_present], theme_idx[first_present]
+        justification_ids[self.row_idx[cell_idx], theme_idx] = self.justification_ids[cell_idx, theme_idx]
+        return self._theme_frame(presence, justification_ids)
+
+    def per_column_view(self, n_rows: int) -> pd.DataFrame:
+        """
+        '<col>_<theme>' and '<col>_<theme>_justification' columns for every coded source column.
+        """
+        col_names = np.array(self.col_names, dtype=object)
+        frames = []
+        for col_name in dict.fromkeys(self.col_names):
+            mask = col_names == col_name
+            presence = np.zeros((n_rows, len(self.themebook.labels)), dtype=np.int8)
+            justification_ids = np.zeros_like(presence, dtype=np.int32)
+            presence[self.row_idx[mask]] = self.presence[mask]
+            justification_ids[self.row_idx[mask]] = self.justification_ids[mask]
+            frames.append(self._theme_frame(presence, justification_ids, prefix=f"{col_name}_"))
+        return pd.concat(frames, axis=1) if frames else pd.DataFrame(index=range(n_rows))
+
+    def to_dataframe(self, df: pd.DataFrame, view: str = MERGED_VIEW) -> pd.DataFrame:
+        """
+        Returns df with the theme columns of the chosen view appended.
+        """
+        if view == PER_COLUMN_VIEW:
+            themes_df = self.per_column_view(len(df))
+        elif view == MERGED_VIEW:
+            themes_df = self.merged_view(len(df))
+        else:
+            raise ValueError(f"Unknown view {view!r}; expected '{MERGED_VIEW}' or '{PER_COLUMN_VIEW}'")
+        themes_df.index = df.index
+        return pd.concat([df.drop(columns=[c for c in themes_df.columns if c in df.columns]), themes_df], axis=1)
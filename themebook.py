@@ -0,0 +1,115 @@
+"""
+Compiled theme book shared by the theme encoder, the batch builder and the engines.
+
+Compiling renders the theme book prompt and the strict function schemas once, so
+per-cell work is just string formatting, and every request for a theme book
+starts with a byte-identical prefix the provider can prompt-cache.
+"""
+import json
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Sequence, Tuple, Union
+
+import pandas as pd
+
+from response_modes import FULL_MODE, RESPONSE_MODES
+from theme_packing import (PACKED_TOOL_CHOICE, PackedCell, build_packed_function_schema,
+                           build_packed_output_instructions, build_packed_text_message)
+from theme_prompts import (THEME_TOOL_CHOICE, build_output_instructions, build_system_message,
+                           build_text_message, build_theme_function_schema, render_theme_lines)
+from token_counting import estimate_tokens
+
+THEME_COLUMN = "theme"
+DEFINITION_COLUMN = "definition"
+
+
+@dataclass(frozen=True)
+class CompiledPrompt:
+    """
+    The fixed part of a request for one response mode, single-cell or packed.
+    """
+    system_message: str
+    function_schema: dict
+    tool_choice: dict
+    packed: bool
+    # Estimated tokens of the shared prefix (system message and tool schema).
+    token_count: int
+
+    @property
+    def tools(self) -> List[dict]:
+        return [{"type": "function", "function": self.function_schema}]
+
+    def messages(self, text: str) -> List[dict]:
+        return [
+            {"role": "system", "content": self.system_message},
+            {"role": "user", "content": build_text_message(text)}
+        ]
+
+    def packed_messages(self, cells: Sequence[PackedCell]) -> List[dict]:
+        return [
+            {"role": "system", "content": self.system_message},
+            {"role": "user", "content": build_packed_text_message(cells)}
+        ]
+
+
+@dataclass(frozen=True)
+class CompiledThemebook:
+    labels: Tuple[str, ...]
+    definitions: Tuple[str, ...]
+    label_index: Dict[str, int]
+    # (response mode, packed) -> prompt
+    prompts: Dict[Tuple[str, bool], CompiledPrompt]
+
+    def prompt(self, mode: str = FULL_MODE, packed: bool = False) -> CompiledPrompt:
+        return self.prompts[(mode, packed)]
+
+
+def _find_column(themebook: pd.DataFrame, name: str) -> str:
+    for column in themebook.columns:
+        if str(column).strip().lower() == name:
+            return column
+    raise KeyError(f"Theme book needs a '{name}' column; found {list(themebook.columns)}")
+
+
+def _compile_prompt(system_message: str, function_schema: dict, tool_choice: dict, packed: bool) -> CompiledPrompt:
+    return CompiledPrompt(
+        system_message=system_message,
+        function_schema=function_schema,
+        tool_choice=tool_choice,
+        packed=packed,
+        token_count=estimate_tokens(system_message) + estimate_tokens(json.dumps(function_schema))
+    )
+
+
+@lru_cache(maxsize=32)
+def _compile(labels: Tuple[str, ...], definitions: Tuple[str, ...]) -> CompiledThemebook:
+    themes_str = render_theme_lines(labels, definitions)
+    prompts = {}
+    for mode_name, mode in RESPONSE_MODES.items():
+        prompts[(mode_name, False)] = _compile_prompt(
+            build_system_message(themes_str, build_output_instructions(mode)),
+            build_theme_function_schema(labels, mode), THEME_TOOL_CHOICE, packed=False
+        )
+        prompts[(mode_name, True)] = _compile_prompt(
+            build_system_message(themes_str, build_packed_output_instructions(mode)),
+            build_packed_function_schema(labels, mode), PACKED_TOOL_CHOICE, packed=True
+        )
+    return CompiledThemebook(
+        labels=labels,
+        definitions=definitions,
+        label_index={label: i for i, label in enumerate(labels)},
+        prompts=prompts
+    )
+
+
+def compile_themebook(themebook: Union[pd.DataFrame, CompiledThemebook]) -> CompiledThemebook:
+    """
+    Compiles a theme book DataFrame (columns 'theme' and 'definition', any case).
+    Compiled theme books are returned unchanged, and identical theme books share
+    one compiled object.
+    """
+    if isinstance(themebook, CompiledThemebook):
+        return themebook
+    labels = themebook[_find_column(themebook, THEME_COLUMN)].astype(str).str.strip()
+    definitions = themebook[_find_column(themebook, DEFINITION_COLUMN)].fillna("").astype(str)
+    return _compile(tuple(labels), tuple(definitions))
@@ -0,0 +1,55 @@
+"""
+Token counting for prompts and plans.
+
+Uses tiktoken when it is installed and its encodings are available, and falls
+back to a cheap characters-per-token estimate otherwise, so planning also works
+offline.
+"""
+from functools import lru_cache
+from typing import Callable, List, Optional
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+TokenCounter = Callable[[str], int]
+
+# Rough average for English text with OpenAI tokenizers.
+CHARS_PER_TOKEN = 4
+# Per-message framing overhead added by the chat format.
+TOKENS_PER_MESSAGE = 4
+FALLBACK_ENCODING = "o200k_base"
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap offline estimate of the number of tokens in text.
+    """
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def estimate_message_tokens(messages: List[dict], count_tokens: TokenCounter = estimate_tokens) -> int:
+    """
+    Estimates the prompt tokens of a list of chat messages.
+    """
+    return sum(TOKENS_PER_MESSAGE + count_tokens(str(m.get("content", ""))) for m in messages)
+
+
+@lru_cache(maxsize=8)
+def get_token_counter(model_name: Optional[str] = None) -> TokenCounter:
+    """
+    Returns an exact counter for the model's tokenizer if tiktoken can load it,
+    otherwise the offline estimate.
+    """
+    if tiktoken is None:
+        return estimate_tokens
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model_name or "")
+        except KeyError:
+            encoding = tiktoken.get_encoding(FALLBACK_ENCODING)
+    except Exception:
+        # tiktoken downloads encodings on first use, which fails offline.
+        return estimate_tokens
+    return lambda text: len(encoding.encode(text, disallowed_special=()))